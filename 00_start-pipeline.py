@@ -8,6 +8,15 @@ start the pipeline.
 #                     [--rm_paralogs]
 #                     [--rm_repeats]
 #                     [--translate]
+#                     [--bedfile_mode {length,depth,balanced}]
+#                     [--chain]
+#                     [--resume]
+#                     [--balance_mode {even,fairshare}]
+#                     [--stream_mapping]
+#                     [--dedup_engine {picard,samtools}]
+#                     [--scatter_realign NUM]
+#                     [--adaptive_resources]
+#                     [--chunked_trimming]
 ###
 
 ### assumes
@@ -20,19 +29,65 @@ start the pipeline.
 # use @functools.wraps(function) for handling [--rm_repeats/paralogs, --translate] to simplify code
 """
 
-import os, sys, distutils.spawn, subprocess, shutil, argparse, pandas as pd
-import balance_queue, create_bedfiles
+import os, sys, zlib, distutils.spawn, subprocess, shutil, argparse, pandas as pd
+import balance_queue, create_bedfiles, manifest
+from executor import get_executor
 from os import path as op
-from subprocess import PIPE
-from subprocess import Popen
 from collections import OrderedDict
-from coadaptree import fs, pkldump, uni, makedir, askforinput, Bcolors, luni
+from concurrent.futures import ThreadPoolExecutor
+from coadaptree import fs, pkldump, pklload, uni, makedir, askforinput, Bcolors, luni
+
+def read_first_line(gzfile, blocksize=65536):
+    """Get the first line of gzfile, decompressing only as much of the file as needed."""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    text = b''
+    with open(gzfile, 'rb') as o:
+        while b'\n' not in text:
+            block = o.read(blocksize)
+            if not block:
+                break
+            text += decompressor.decompress(block)
+    return text.split(b'\n')[0].decode('utf-8')
+
 
 def get_rgid(r1):
-    """If RGID is blank, print out the output that the pipeline would otherwise use."""
-    p1 = Popen(['zcat',r1], stdout=PIPE)
-    p2 = Popen(['head', '-n1'], stdin=p1.stdout, stdout=PIPE)
-    return '_'.join(p2.communicate()[0].split()[0].decode('utf-8').split('\n')[0].split(":")[:4])
+    """Get the RGID the pipeline assigns to reads in r1 if RGID is blank in the datatable.
+
+    Same as `zcat r1 | head -n1 | sed 's/:/_/g' | cut -d "_" -f1,2,3,4`.
+    """
+    return '_'.join(read_first_line(r1).replace(':', '_').split('_')[:4])
+
+
+def try_get_rgid(r1):
+    """Get (RGID, None) for r1, or (None, error) if r1 could not be read (eg corrupt or not gzipped)."""
+    try:
+        return get_rgid(r1), None
+    except (zlib.error, OSError, UnicodeDecodeError) as e:
+        return None, e
+
+
+def get_rgids(r1files, procs=16):
+    """Get the RGID of each R1 file, reading procs files at a time. Exit if any can't be read.
+
+    Returns:
+    rgids - dict with key = path to R1 file, val = RGID (None if the file does not exist)
+    """
+    r1files = [r1 for r1 in r1files if op.exists(r1)]
+    with ThreadPoolExecutor(max_workers=procs) as pool:
+        results = dict(zip(r1files, pool.map(try_get_rgid, r1files)))
+    fails = [(r1, e) for r1, (rgid, e) in results.items() if e is not None]
+    if len(fails) > 0:
+        print(Bcolors.FAIL + 'FAIL: could not read the first read (to get RGID) of the following R1 files.' + Bcolors.ENDC)
+        for r1, e in fails:
+            print(Bcolors.FAIL + 'FAIL: %s (%s)' % (r1, e) + Bcolors.ENDC)
+        print('exiting 00_start-pipeline.py')
+        exit()
+    return dict((r1, rgid) for r1, (rgid, e) in results.items())
+
+
+def get_file_key(r1):
+    """Key for the read group info of an R1 file (02_bwa finds it from the trimmed file name)."""
+    return op.basename(r1).split(".fastq")[0]
 
 
 def create_sh(pooldirs, poolref, parentdir):
@@ -57,6 +112,98 @@ def create_sh(pooldirs, poolref, parentdir):
     balance_queue.main('balance_queue.py', 'trim', parentdir)
 
 
+def get_chain_shfiles(pooldir, samp):
+    """Get the .sh file of each stage for samp, in the order the stages need to run."""
+    pool = op.basename(pooldir)
+    shdir = op.join(pooldir, 'shfiles')
+    return [op.join(shdir, '01_trimmed_shfiles', '%s-%s-trim.sh' % (pool, samp)),
+            op.join(shdir, '02_bwa_shfiles', '%s-%s-bwa.sh' % (pool, samp)),
+            op.join(shdir, '03_mark_build_shfiles', '%s-%s-mark.sh' % (pool, samp)),
+            op.join(shdir, '04_realignTarget_shfiles', '%s-%s-realign.sh' % (pool, samp)),
+            op.join(shdir, '05_indelRealign_shfiles', '%s-%s-indelRealign.sh' % (pool, samp))]
+
+
+def get_scatter_shfiles(shfile):
+    """Get the .sh files that must finish before shfile can start (see --scatter_realign)."""
+    prefix = op.basename(shfile).replace('.sh', '-scatter_')
+    return [f for f in fs(op.dirname(shfile)) if op.basename(f).startswith(prefix) and f.endswith('.sh')]
+
+
+def sbatch_chain(shfiles):
+    """Sbatch shfiles so that each job can only start once the previous job finished without error.
+
+    If a stage was scattered across chunks of the reference, its chunk jobs follow the previous
+    job, and the stage's own job follows all of its chunk jobs.
+
+    Returns a list of slurm job ids, one for each shfile.
+    """
+    executor = get_executor()
+    pids = []
+    for sh in shfiles:
+        scatterpids = [executor.submit(f, dependencies=pids[-1:]) for f in get_scatter_shfiles(sh)]
+        pids.append(executor.submit(sh, dependencies=scatterpids if len(scatterpids) > 0 else pids[-1:]))
+    return pids
+
+
+def create_chains(pooldirs, poolref, parentdir, resume=False):
+    """Write the .sh files for every stage of every sample, then sbatch them as dependency chains.
+
+    When the pipeline is started with --chain, each stage script (01-05) writes its .sh file
+    without sbatching it or calling the next stage - so the stage scripts are run here, one after
+    another, for each sample. Slurm can then start each stage as soon as the previous one is done.
+
+    Positional arguments:
+    pooldirs - a list of subdirectories in parentdir for groups of pools
+    poolref - dictionary with key = pool, val = /path/to/ref
+
+    Keyword arguments:
+    resume - if True, only sbatch each sample's stages from the first one that is missing from
+             the manifest or is stale (see manifest.py)
+    """
+    print(Bcolors.BOLD + '\nwriting sh files for all stages' + Bcolors.ENDC)
+    firststages = []
+    pipeline = op.join(os.environ['HOME'], 'pipeline')
+    poolsamps = pklload(op.join(parentdir, 'poolsamps.pkl'))
+    for pooldir in pooldirs:
+        pool = op.basename(pooldir)
+        print(Bcolors.BOLD + '\npool = %s' % pool + Bcolors.ENDC)
+        ref = poolref[pool]
+        subprocess.call([shutil.which('python'), op.join(pipeline, '01_trim-fastq.py'), pooldir, ref])
+        for samp in poolsamps[pool]:
+            dupfile = op.join(pooldir, '03_dedup_rg_filtered_indexed_sorted_bamfiles', '%s_rd.bam' % samp)
+            for script, args in [('02_bwa-map_view_sort_index_flagstat.py', [parentdir, samp]),
+                                 ('03_mark_build.py', [pooldir, samp]),
+                                 ('04_realignTargetCreator.py', [pooldir, samp, dupfile]),
+                                 ('05_indelRealign.py', [pooldir, samp, dupfile, ref])]:
+                subprocess.call([shutil.which('python'), op.join(pipeline, script)] + args)
+            shfiles = get_chain_shfiles(pooldir, samp)
+            missing = [sh for sh in shfiles if not op.exists(sh)]
+            if len(missing) > 0:
+                print(Bcolors.FAIL + 'FAIL: could not create the following sh files for %s:' % samp + Bcolors.ENDC)
+                for sh in missing:
+                    print(Bcolors.FAIL + '\t%s' % sh + Bcolors.ENDC)
+                print('exiting 00_start-pipeline.py')
+                exit()
+            first = manifest.first_incomplete(pooldir, samp, shfiles) if resume is True else 0
+            if first is None:
+                print('\tall stages have finished for %s' % samp)
+                continue
+            if first > 0:
+                print('\tresuming %s from %s' % (samp, manifest.STAGES[first]))
+            firststages.append(manifest.STAGES[first])
+            pids = sbatch_chain(shfiles[first:])
+            print('\tsbatched %s: %s' % (samp, ' -> '.join(pids)))
+    print("\n")
+    # balance_queue.main() exits if there are no Priority jobs to balance, so call it in a subprocess
+    if balance_queue.daemon_running():
+        firststages = []
+    for stage in [stage for stage in manifest.STAGES if stage in firststages]:
+        subprocess.call([shutil.which('python'),
+                         op.join(os.environ['HOME'], 'pipeline/balance_queue.py'),
+                         stage,
+                         parentdir])
+
+
 def get_datafiles(parentdir, f2pool, data):
     """Get list of files from datatable, make sure they exist in parentdir.
     Create symlinks in /parentdir/<pool_name>/.
@@ -107,12 +254,15 @@ def get_datafiles(parentdir, f2pool, data):
     # print out RGID if RGID is none
 
 
-def make_pooldirs(data, parentdir):
+def make_pooldirs(data, parentdir, resume=False):
     """Create subdirectories of parentdir.
 
     Positional arguments:
     data - datatable.txt with info for pipeline
     parentdir - directory with datatable.txt and (symlinks to) fastq data
+
+    Keyword arguments:
+    resume - if True, keep existing pooldirs (and the stage outputs within them)
     """
     # make pool dirs
     print(Bcolors.BOLD + "\nmaking pool dirs" + Bcolors.ENDC)
@@ -120,7 +270,9 @@ def make_pooldirs(data, parentdir):
     pooldirs = []
     for p in pools:
         pooldir = op.join(parentdir, p)
-        if op.exists(pooldir):
+        if op.exists(pooldir) and resume is True:
+            print('\tresuming with existing pooldir: %s' % pooldir)
+        elif op.exists(pooldir):
             text = "\tWARN: The pooldir already exists, this WILL overwrite and/or delete previous data: %s" % pooldir
             print(Bcolors.WARNING + text + Bcolors.ENDC)
             askforinput(tab='\t', newline='')
@@ -134,16 +286,26 @@ def make_pooldirs(data, parentdir):
     return pooldirs
 
 
-def create_all_bedfiles(poolref, numpools):
-    """For each unique ref.fa in datatable.txt, create bedfiles for varscan.
+def create_all_bedfiles(poolref, numpools, mode, parentdir, resume=False):
+    """For each unique ref.fa in datatable.txt, create (or reuse cached) bedfiles for varscan.
 
     Positional arguments:
     poolref - dictionary with key = pool, val = /path/to/ref
+    mode - 'length' or 'balanced' (see --bedfile_mode)
+    parentdir - directory with the job budget used to size bedfiles, where bedfiles are pinned
+
+    Keyword arguments:
+    resume - if True, keep using bedfiles already pinned for this run
     """
     # create bedfiles for varscan
     print(Bcolors.BOLD + "\ncreating bedfiles" + Bcolors.ENDC)
     for ref in uni(poolref.values()):
-        create_bedfiles.main(ref, numpools)
+        pinned = create_bedfiles.get_pinned(parentdir, ref)
+        if resume is True and pinned is not None and op.exists(pinned):
+            print('\tkeeping bedfiles for %s in %s' % (ref, pinned))
+            create_bedfiles.pin_beddir(parentdir, ref, pinned)  # mark as in use (see create_bedfiles.prune_cache)
+            continue
+        create_bedfiles.main(ref, numpools, mode=mode, parentdir=parentdir)
 
 def choose_file(files, pool, purpose, keep=None):
     """Choose which repeat/paralog file to use if multiple exist."""
@@ -318,7 +480,7 @@ def handle_dict_fails(pool2repeatsfile, pool2translate, pool2paralogfile, repeat
         exit()
 
 
-def handle_rg_fails(failing, warning, parentdir, data):
+def handle_rg_fails(failing, warning, parentdir, data, rginfo):
     if len(failing) > 0:
         print(Bcolors.FAIL + 'FAIL: The following samples have blank RG info.' + Bcolors.ENDC)
         for fail in failing:
@@ -330,8 +492,8 @@ def handle_rg_fails(failing, warning, parentdir, data):
         for row in data.index:
             samp = data.loc[row, 'sample_name']
             if samp in warning:
-                r1 = op.join(parentdir, data.loc[row, 'file_name_r1'])
-                outputs.append("\t\t%s\t%s" % (samp, get_rgid(r1)))
+                key = get_file_key(data.loc[row, 'file_name_r1'])
+                outputs.append("\t\t%s\t%s" % (samp, rginfo[samp]['rgids'].get(key)))
         print(Bcolors.WARNING + '\n\n\tWARN: at least one of the samples has a blank RGID in the datatable.\n' +
               '\tWARN: If RGPU is also blank, the pipeline will assign RGPU as: $RGID.$RGLB\n' +
               '\tWARN: The pipeline will automatically assign the following RGIDs.\n' +
@@ -473,8 +635,24 @@ different pool assignments: %s' % samp + Bcolors.ENDC)
     # handle fails for rm_repeats/translate/rm_paralogs
     handle_dict_fails(pool2repeatsfile, pool2translate, pool2paralogfile, repeats, translate, paralogs, data, parentdir)
 
+    # read group of each file (RGID from the first read of files with a blank RGID, all files at once)
+    r1files = [op.join(parentdir, data.loc[row, 'file_name_r1']) for row in data.index
+               if data.loc[row, 'rgid'] != data.loc[row, 'rgid']]
+    rgids = get_rgids(r1files)
+    for row in data.index:
+        samp = data.loc[row, 'sample_name']
+        r1 = op.join(parentdir, data.loc[row, 'file_name_r1'])
+        rgid = data.loc[row, 'rgid'] if data.loc[row, 'rgid'] == data.loc[row, 'rgid'] else rgids.get(r1)
+        rgpu = data.loc[row, 'rgpu'] if data.loc[row, 'rgpu'] == data.loc[row, 'rgpu'] else None
+        if rgpu is None and rgid is not None:
+            rgpu = '%s.%s' % (rgid, rginfo[samp]['rglb'])
+        for col, val in [('rgids', rgid), ('rgpus', rgpu)]:
+            if col not in rginfo[samp]:
+                rginfo[samp][col] = {}
+            rginfo[samp][col][get_file_key(r1)] = val
+
     # RG info failing/warnings
-    handle_rg_fails(failing, warning, parentdir, data)
+    handle_rg_fails(failing, warning, parentdir, data, rginfo)
 
     pkldump(pool2repeatsfile, op.join(parentdir, 'repeat_regions.pkl'))
     pkldump(pool2paralogfile, op.join(parentdir, 'paralog_snps.pkl'))
@@ -654,6 +832,119 @@ hyphen-separated CHROM-POS sites for paralogs. These
 sites should be found in the current ref.fa being
 used to call SNPs (otherwise SNPs cannot be filtered
 by these sites). (default: False)''')
+    parser.add_argument('--bedfile_mode',
+                        required=False,
+                        default='length',
+                        choices=['length', 'depth', 'balanced'],
+                        dest='bedfile_mode',
+                        help='''How to spread the reference across the bedfiles
+used to parallelize varscan. With 'length', bedfiles
+are created from the reference at the start of the
+pipeline and each has ~equal numbers of base pairs.
+With 'depth', bedfiles are created for each pool once
+all of its samples have been realigned, and each
+bedfile has ~equal numbers of mapped reads (contigs
+are split if needed). 'depth' is useful for capture
+data where reads pile up on few contigs. With
+'balanced', bedfiles are created from the reference
+at the start of the pipeline, but contigs are split
+into pieces and packed so that each bedfile has
+~equal numbers of base pairs even if the reference
+has a few very large chromosomes.
+(default: length)''')
+    parser.add_argument('--chain',
+                        required=False,
+                        action='store_true',
+                        dest='chain',
+                        help='''Boolean: true if used, false otherwise. Write the .sh
+files for every stage (trim through indelRealign) of
+every sample at startup, and sbatch them all at once
+with --dependency=afterok chains. Otherwise each stage
+creates and sbatches the next stage when it finishes.
+(default: False)''')
+    parser.add_argument('--resume',
+                        required=False,
+                        action='store_true',
+                        dest='resume',
+                        help='''Boolean: true if used, false otherwise. Restart a
+previous run in PARENTDIR without deleting its pool
+directories. Each sample is sbatched from its first
+stage whose outputs are missing or have changed since
+they were recorded, or whose commands have changed
+(see manifest.py). Implies --chain. (default: False)''')
+    parser.add_argument('--balance_mode',
+                        required=False,
+                        default='even',
+                        choices=['even', 'fairshare'],
+                        dest='balance_mode',
+                        help='''How balance_queue.py spreads Priority jobs across
+the slurm accounts chosen at startup. With 'even',
+each account gets the same number of jobs. With
+'fairshare', each account gets jobs in proportion to
+its FairShare (from sshare), so accounts that schedule
+faster get more jobs. To see the plan without moving
+jobs: python balance_queue.py plan keyword parentdir
+(default: even)''')
+    parser.add_argument('--stream_mapping',
+                        required=False,
+                        action='store_true',
+                        dest='stream_mapping',
+                        help='''Boolean: true if used, false otherwise. Pipe bwa
+output through samtools view and samtools sort (which
+spills to $SLURM_TMPDIR) straight to the sorted
+bamfile, without writing the intermediate .sam and
+.bam files for each lane. (default: False)''')
+    parser.add_argument('--dedup_engine',
+                        required=False,
+                        default='picard',
+                        choices=['picard', 'samtools'],
+                        dest='dedup_engine',
+                        help='''The program used to remove duplicate reads. 'picard'
+runs MarkDuplicates (30GB, single-threaded). 'samtools'
+streams name-collated reads through samtools fixmate
+and markdup (16GB, 8 threads). Either way the
+deduplicated bamfile, its index, and duplicate stats
+have the same names. (default: picard)''')
+    parser.add_argument('--scatter_realign',
+                        required=False,
+                        default=0,
+                        type=int,
+                        metavar='NUM',
+                        dest='scatter_realign',
+                        help='''Split the reference into NUM chunks of whole contigs
+(with ~equal numbers of base pairs) and run GATK
+RealignerTargetCreator and IndelRealigner for each
+chunk of each sample as separate short jobs instead
+of one 7-day job per sample for each. The targets of
+each chunk are concatenated in reference order, and
+the realigned reads of each chunk are merged into the
+usual realigned bamfile. Requires ref.fa.fai.
+(default: 0, no scatter)''')
+    parser.add_argument('--adaptive_resources',
+                        required=False,
+                        action='store_true',
+                        dest='adaptive_resources',
+                        help='''Boolean: true if used, false otherwise. Size the
+--mem and --time of each job from the number of reads
+(or fastq.gz bytes) of its samples and the usage of
+previous jobs of the same stage in PARENTDIR (from
+sacct), instead of each stage's fixed requests. Until
+a stage has enough finished jobs, its usual requests
+are used (see resources.py). (default: False)''')
+    parser.add_argument('--chunked_trimming',
+                        required=False,
+                        action='store_true',
+                        dest='chunked_trimming',
+                        help='''Boolean: true if used, false otherwise. Split each
+pair of fastq.gz files whose R1 is larger than 2GB
+into chunks of 10M reads (R1 and R2 chunks have the
+same reads) and trim 4 chunks at a time with fastp,
+then concatenate the trimmed chunks and merge their
+fastp stats into the usual outfiles. Useful when the
+deepest libraries time out during trimming. The
+whole pair is uncompressed into $SLURM_TMPDIR, which
+needs ~5x the size of the two fastq.gz files free (see
+parallel_trim.py). (default: False)''')
     parser.add_argument('-h', '--help',
                         action='help',
                         default=argparse.SUPPRESS,
@@ -662,6 +953,9 @@ by these sites). (default: False)''')
     # trim path
     if args.parentdir.endswith('/'):
         args.parentdir = args.parentdir[:-1]
+    # resumed runs sbatch each sample's remaining stages as a dependency chain
+    if args.resume:
+        args.chain = True
     # save command
     pkldump(args, op.join(args.parentdir, 'pipeline_start_command.pkl'))
     # assess arguments
@@ -730,7 +1024,7 @@ def main():
     data = read_datatable(args.parentdir)
     
     # create directories for each group of pools to be combined
-    pooldirs = make_pooldirs(data, args.parentdir)
+    pooldirs = make_pooldirs(data, args.parentdir, args.resume)
     
     # parse the datatable
     f2pool, poolref = parse_datatable(data,
@@ -739,14 +1033,21 @@ def main():
                                       args.repeats,
                                       args.paralogs)
 
-    # create bedfiles to parallelize varscan later on
-    create_all_bedfiles(poolref, len(pooldirs))
+    # find how many jobs the scheduler will take (used to size bedfiles for this run)
+    create_bedfiles.get_job_budget(args.parentdir, refresh=True)
+
+    # create bedfiles to parallelize varscan later on (depth-balanced bedfiles are made after realignment)
+    if args.bedfile_mode != 'depth':
+        create_all_bedfiles(poolref, len(pooldirs), args.bedfile_mode, args.parentdir, args.resume)
 
     # assign fq files to pooldirs for visualization (good to double check)
     get_datafiles(args.parentdir, f2pool, data)
 
     # create and sbatch sh files
-    create_sh(pooldirs, poolref, args.parentdir)
+    if args.chain is True:
+        create_chains(pooldirs, poolref, args.parentdir, args.resume)
+    else:
+        create_sh(pooldirs, poolref, args.parentdir)
 
 
 if __name__ == '__main__':
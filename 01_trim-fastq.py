@@ -2,6 +2,9 @@
 
 ### purpose
 # trim fastq files with fastp
+# if the pipeline was started with `--chunked_trimming`, pairs whose R1 is larger than
+#    parallel_trim.CHUNK_MIN_BYTES are split into chunks that are trimmed in parallel (see
+#    parallel_trim.py) - outfiles have the same names either way
 ###
 
 ### execution
@@ -10,9 +13,12 @@
 """
 
 
-import os, sys, time, shutil, subprocess
+import os, sys, time
 from os import path as op
-from coadaptree import fs, pklload, pkldump, get_email_info
+from coadaptree import fs, pklload, pkldump, get_email_info, get_start_opt
+from executor import get_executor
+from resources import get_resources
+from parallel_trim import CHUNK_MIN_BYTES
 
 # args
 thisfile, pooldir, ref = sys.argv
@@ -21,6 +27,8 @@ pool = op.basename(pooldir)
 f2samp = pklload(op.join(parentdir, 'f2samp.pkl'))
 adaptors = pklload(op.join(parentdir, 'adaptors.pkl'))
 bash_variables = op.join(parentdir, 'bash_variables')
+chain = get_start_opt(parentdir, 'chain', False)  # if True, 00_start sbatches all stages itself
+chunked = get_start_opt(parentdir, 'chunked_trimming', False)
 for arg, path in [('pooldir', pooldir), ('ref', ref)]:
     if not op.exists(path):
         print("The argument does not exist in the specified path:\narg = %s\npath =%s" % (arg, path))
@@ -79,14 +87,19 @@ email_text = get_email_info(parentdir, '01')
 samp2_r1r2out = {}
 for samp, pairs in seq_pairs.items():
     samp2_r1r2out[samp] = []
+    mem, walltime = get_resources(parentdir, 'trim', '%(pool)s-%(samp)s-trim' % locals(), [samp],
+                                  '5000M', '02:59:00')
     header = '''#!/bin/bash
 #SBATCH --job-name=%(pool)s-%(samp)s-trim
-#SBATCH --time=02:59:00
-#SBATCH --mem=5000M
+#SBATCH --time=%(walltime)s
+#SBATCH --mem=%(mem)s
 #SBATCH --cpus-per-task=16
 #SBATCH --output=%(pool)s-%(samp)s-trim_%%j.out
 %(email_text)s
 
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
 source %(bash_variables)s
 
 module load fastp/0.19.5
@@ -107,7 +120,16 @@ module load fastp/0.19.5
         logfile = r1out.replace("R1", "").replace(".fastq.gz", "_R1_R2_stats.log")
         samp2_r1r2out[samp].append((r1out, r2out))
 
-        text = '''fastp -i %(r1)s -o %(r1out)s -I %(r2)s -O %(r2out)s \
+        if chunked is True and op.getsize(r1) > CHUNK_MIN_BYTES:
+            options = '''-g --cut_window_size 5 --cut_mean_quality 30 --n_base_limit 20 --length_required 75 \
+--cut_by_quality3 %(adaptor_cmd)s''' % locals()
+            text = '''# trim in chunks, several at a time
+python $HOME/pipeline/parallel_trim.py %(r1)s %(r2)s %(r1out)s %(r2out)s \
+%(json)s.json %(html)s.html %(logfile)s "%(options)s"
+
+''' % locals()
+        else:
+            text = '''fastp -i %(r1)s -o %(r1out)s -I %(r2)s -O %(r2out)s \
 -g --cut_window_size 5 --cut_mean_quality 30 --n_base_limit 20 --length_required 75 \
 -h %(html)s.html --cut_by_quality3 --thread 16 --json %(json)s.json \
 %(adaptor_cmd)s > %(logfile)s
@@ -115,14 +137,26 @@ module load fastp/0.19.5
 ''' % locals()
         newtext = newtext + text
 
-    suffix = '''# once finished, map using bwa mem
+    filE = op.join(shtrimDIR, '%(pool)s-%(samp)s-trim.sh' % locals())
+    outputs = ' '.join([f for r1r2out in samp2_r1r2out[samp] for f in r1r2out])
+    record = '''# record outputs so a resumed run can skip this stage (only reached if every command above succeeded)
+python $HOME/pipeline/manifest.py %(pooldir)s %(samp)s trim %(filE)s %(outputs)s
+
+''' % locals()
+
+    if chain is True:
+        suffix = '''# the bwa job was sbatched with this job as a dependency, balance it now that it can schedule
+python $HOME/pipeline/balance_queue.py bwa %(parentdir)s
+
+''' % locals()
+    else:
+        suffix = '''# once finished, map using bwa mem
 python $HOME/pipeline/02_bwa-map_view_sort_index_flagstat.py %(parentdir)s %(samp)s
 
 ''' % locals()
 
-    text = header + newtext + suffix
+    text = header + newtext + record + suffix
 
-    filE = op.join(shtrimDIR, '%(pool)s-%(samp)s-trim.sh' % locals())
     shfiles.append(filE)
     with open(filE, 'w') as o:
         o.write("%s" % text)
@@ -131,9 +165,11 @@ pkldump(samp2_r1r2out, op.join(pooldir, 'samp2_r1r2out.pkl'))
 
 print('\tshcount =', len(shfiles))
 print('\tshdir = ', shtrimDIR)
+if chain is True:
+    # 00_start-pipeline.py will sbatch the files along with the rest of each sample's stages
+    exit()
 # qsub the files
 for sh in shfiles:
-    os.chdir(op.dirname(sh))     # want sbatch outfiles in same folder as sh file
     print('\tshfile=', sh)
-    subprocess.call([shutil.which('sbatch'), sh])
+    get_executor().submit(sh)  # sbatch from the sh dir so outfiles are in same folder as sh file
     time.sleep(2)
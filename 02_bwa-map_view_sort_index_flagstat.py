@@ -1,13 +1,21 @@
-"""Create and sbatch mapping, samtools, and bedtools command files.
+"""Create and sbatch mapping and samtools command files.
 
 ### purpose
 # map with bwa, view/sort/index with samtools
+# summarize coverage of each sorted bamfile (reads and bases per window) with covsummary.py
 ###
 
 ### usage
 # 02_bwa-map_view_sort_index_flagstat.py parentdir samp
 ###
 
+### stream mapping
+# if the pipeline was started with --stream_mapping, bwa output is piped through samtools view
+#    and samtools sort (which spills to $SLURM_TMPDIR) straight to the sorted bamfile, without
+#    writing sam/bam files to 02a_samfiles and 02b_bamfiles. flagstat and covsummary.py read the
+#    same stream (through fifos) instead of re-reading the sorted bamfile
+###
+
 ### assumes
 # outfiles from "bwa index ref.fasta"
 #
@@ -15,9 +23,12 @@
 ###
 """
 
-import sys, os, subprocess, shutil
+import sys, os, shlex, subprocess
 from os import path as op
-from coadaptree import pklload, pkldump, get_email_info, makedir
+from coadaptree import pklload, pkldump, get_email_info, makedir, get_start_opt
+from executor import get_executor
+from resources import get_resources
+from balance_queue import daemon_running
 
 # get argument inputs
 thisfile, parentdir, samp = sys.argv
@@ -27,13 +38,15 @@ shdir = op.join(pooldir, 'shfiles')
 ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
 r1r2outs = pklload(op.join(pooldir, 'samp2_r1r2out.pkl'))[samp]
 bash_variables = op.join(parentdir, 'bash_variables')
+chain = get_start_opt(parentdir, 'chain', False)  # if True, 00_start sbatches all stages itself
+stream = get_start_opt(parentdir, 'stream_mapping', False)  # if True, no intermediate sam/bam files
 
 # create dirs
 bwashdir = op.join(shdir, '02_bwa_shfiles')
 samdir = op.join(pooldir, '02a_samfiles')
 bamdir = op.join(pooldir, '02b_bamfiles')
 sortdir = op.join(pooldir, '02c_sorted_bamfiles')
-for d in [bwashdir, samdir, bamdir, sortdir]:
+for d in [bwashdir, sortdir] if stream is True else [bwashdir, samdir, bamdir, sortdir]:
     makedir(d)
 
 # get rginfo - THIS CAN STAY EVEN WITH SAMPS SEQUENCED MULTIPLE TIMES - RGID and RGPU are defined with file
@@ -45,6 +58,8 @@ rgpl = rginfo[samp]['rgpl']
 rgsm = rginfo[samp]['rgsm']
 rgid = rginfo[samp]['rgid']
 rgpu = rginfo[samp]['rgpu']
+rgids = rginfo[samp].get('rgids', {})  # key = basename of R1 file without .fastq*
+rgpus = rginfo[samp].get('rgpus', {})
 
 
 def getbwatext(r1out, r2out):
@@ -58,25 +73,27 @@ def getbwatext(r1out, r2out):
     sort = op.basename(bamfile).replace('.bam', '_sorted.bam')
     sortfile = op.join(sortdir, sort)
     flagfile = sortfile.replace('.bam', '.bam.flagstats')
-    coordfile = sortfile.replace('.bam', 'bam.coord')
+    covfile = sortfile.replace('.bam', '.bam.cov')
     
-    if rgid is None:
-        rgidcmd = f'''RGID=$(zcat {r1out} | head -n1 | sed 's/:/_/g' | cut -d "_" -f1,2,3,4)'''
+    # read group of this file, found by 00_start-pipeline.py (runs started before then look it up here)
+    # values are quoted for bash - eg SRA headers (@SRR5364424.1 1 length=151) have spaces
+    key = op.basename(r1out).replace("_trimmed.fastq.gz", "")
+    if rgids.get(key) is not None:
+        rgidcmd = f'''RGID={shlex.quote(rgids[key])}'''
+    elif rgid is None:
+        # head closes the pipe before zcat finishes, so pipefail is turned off in this subshell
+        rgidcmd = f'''RGID=$(set +o pipefail; zcat {r1out} | head -n1 | sed 's/:/_/g' | cut -d "_" -f1,2,3,4)'''
     else:
-        rgidcmd = f'''RGID={rgid}'''
-    if rgpu is None:
+        rgidcmd = f'''RGID={shlex.quote(rgid)}'''
+    if rgpus.get(key) is not None:
+        rgpucmd = f'''RGPU={shlex.quote(rgpus[key])}'''
+    elif rgpu is None:
         rgpucmd = f'''RGPU=$RGID.{rglb}'''
     else:
-        rgpucmd = f'''RGPU={rgid}'''
+        rgpucmd = f'''RGPU={shlex.quote(rgpu)}'''
 
-    if rgid is None:
-        rgidcmd = f'''RGID=$(zcat {r1out} | head -n1 | sed 's/:/_/g' | cut -d "_" -f1,2,3,4)'''
-    else:
-        rgidcmd = f'''RGID={rgid}'''
-    if rgpu is None:
-        rgpucmd = f'''RGPU=$RGID.{rglb}'''
-    else:
-        rgpucmd = f'''RGPU={rgid}'''
+    if stream is True:
+        return (sortfile, getstreamtext(r1out, r2out, sortfile, flagfile, covfile, rgidcmd, rgpucmd))
 
     return (sortfile, f'''# get RGID and RGPU
 {rgidcmd}
@@ -95,13 +112,50 @@ samtools index {sortfile}
 samtools flagstat {sortfile} > {flagfile}
 module unload samtools
 
-module load bedtools/2.27.1
-bedtools bamtobed -i {sortfile} > {coordfile}
-module unload bedtools
+# summarize coverage
+source {bash_variables}
+python $HOME/pipeline/covsummary.py {sortfile} {covfile}
 
 ''')
 
 
+def getstreamtext(r1out, r2out, sortfile, flagfile, covfile, rgidcmd, rgpucmd):
+    """Map, filter, and sort in one pipe; flagstat and covsummary.py read the filtered stream from fifos."""
+    tmp = f'$SLURM_TMPDIR/{op.basename(sortfile).replace(".bam", "")}'
+    return f'''# get RGID and RGPU
+{rgidcmd}
+{rgpucmd}
+
+# map, filter, sort by coordinate in one stream (sort spills to $SLURM_TMPDIR), then index
+module load bwa/0.7.17
+module load samtools/1.9
+source {bash_variables}
+# (pipefail: the job stops if any command in the pipe fails, `wait $pid` does the same for the
+# background readers, and quickcheck makes sure the sorted bam is complete before it is indexed)
+set -o pipefail
+# (fifos left by a killed or requeued run are replaced, and removed however this job ends)
+rm -f {tmp}.flagstat.fifo {tmp}.cov.fifo
+trap 'rm -f {tmp}.flagstat.fifo {tmp}.cov.fifo' EXIT
+mkfifo {tmp}.flagstat.fifo {tmp}.cov.fifo
+samtools flagstat {tmp}.flagstat.fifo > {flagfile} &
+flagstat_pid=$!
+python $HOME/pipeline/covsummary.py {tmp}.cov.fifo {covfile} &
+cov_pid=$!
+bwa mem -t 32 -M -R "@RG\\tID:$RGID\\tSM:{rgsm}\\tPL:{rgpl}\\tLB:{rglb}\\tPU:$RGPU" \
+{ref} {r1out} {r2out} | \
+samtools view -@ 4 -u -q 20 -F 0x0004 -f 0x0002 - | \
+tee {tmp}.flagstat.fifo {tmp}.cov.fifo | \
+samtools sort -@ 8 -m 2G -T {tmp} -o {sortfile} -
+wait $flagstat_pid
+wait $cov_pid
+rm {tmp}.flagstat.fifo {tmp}.cov.fifo
+samtools quickcheck {sortfile}
+samtools index {sortfile}
+module unload bwa samtools
+
+'''
+
+
 # get bwatext
 bwatext = ''''''
 sortfiles = []
@@ -112,10 +166,23 @@ for r1, r2 in r1r2outs:
 pkldump(sortfiles, op.join(pooldir, '%s_sortfiles.pkl' % samp))
 
 # send it off
+qsubfile = op.join(bwashdir, f'{pool}-{samp}-bwa.sh')
+outputs = ' '.join([f for sortfile in sortfiles
+                    for f in [sortfile, f'{sortfile}.bai', sortfile.replace('.bam', '.bam.flagstats'),
+                              sortfile.replace('.bam', '.bam.cov')]])
 email_text = get_email_info(parentdir, '02')
+if chain is True:
+    nextstep = f'''# balance the mark job (sbatched with this job as a dependency)
+source {bash_variables}
+python $HOME/pipeline/balance_queue.py mark {parentdir}'''
+else:
+    nextstep = f'''# mark and build
+source {bash_variables}
+python $HOME/pipeline/03_mark_build.py {pooldir} {samp}'''
+mem, walltime = get_resources(parentdir, 'bwa', f'{pool}-{samp}-bwa', [samp], '55000M', '23:59:00')
 text = f'''#!/bin/bash
-#SBATCH --time=23:59:00
-#SBATCH --mem=55000M
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
 #SBATCH --nodes=1
 #SBATCH --ntasks=32
 #SBATCH --cpus-per-task=1
@@ -123,23 +190,32 @@ text = f'''#!/bin/bash
 #SBATCH --output={pool}-{samp}-bwa_%j.out
 {email_text}
 
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
 {bwatext}
 
-# mark and build
+# record outputs so a resumed run can skip this stage (only reached if every command above succeeded)
 source {bash_variables}
-python $HOME/pipeline/03_mark_build.py {pooldir} {samp}
+python $HOME/pipeline/manifest.py {pooldir} {samp} bwa {qsubfile} {outputs}
+
+{nextstep}
 '''
 
 # create shfile
-qsubfile = op.join(bwashdir, f'{pool}-{samp}-bwa.sh')
 with open(qsubfile, 'w') as o:
     o.write("%s" % text)
 
+if chain is True:
+    # 00_start-pipeline.py will sbatch the file along with the rest of the sample's stages
+    exit()
+
 # sbatch file
-os.chdir(bwashdir)
 print('shdir = ', shdir)
-subprocess.call([shutil.which('sbatch'), qsubfile])
+get_executor().submit(qsubfile)
 
-balance_queue = op.join(os.environ['HOME'], 'pipeline/balance_queue.py')
-subprocess.call([sys.executable, balance_queue, 'bwa', parentdir])
-subprocess.call([sys.executable, balance_queue, 'trim', parentdir])
+# balance queue (unless the balance_queue.py daemon is running)
+if not daemon_running():
+    balance_queue = op.join(os.environ['HOME'], 'pipeline/balance_queue.py')
+    subprocess.call([sys.executable, balance_queue, 'bwa', parentdir])
+    subprocess.call([sys.executable, balance_queue, 'trim', parentdir])
@@ -2,6 +2,9 @@
 
 ### purpose
 # use picard to mark/remove duplicates, build bam index for GATK
+# if the pipeline was started with `--dedup_engine samtools`, instead remove duplicates with
+#    samtools (merge -> collate -> fixmate -> sort -> markdup, streamed and multi-threaded),
+#    which needs far less memory than picard. Outfiles have the same names with either engine
 ###
 
 ### usage
@@ -9,13 +12,18 @@
 ###
 """
 
-import sys, os, balance_queue, subprocess, shutil
+import sys, os, balance_queue, subprocess
 from os import path as op
-from coadaptree import makedir, get_email_info, pklload
+from coadaptree import makedir, get_email_info, pklload, get_start_opt
+from executor import get_executor
+from resources import get_resources
+from balance_queue import daemon_running
 
 thisfile, pooldir, samp = sys.argv
 parentdir = op.dirname(pooldir)
 bash_variables = op.join(parentdir, 'bash_variables')
+chain = get_start_opt(parentdir, 'chain', False)  # if True, 00_start sbatches all stages itself
+engine = get_start_opt(parentdir, 'dedup_engine', 'picard')
 sortfiles = pklload(op.join(pooldir, '%s_sortfiles.pkl' % samp))
 joined = " I=".join(sortfiles)
 
@@ -25,18 +33,43 @@ pool = op.basename(pooldir)
 dupfile = op.join(dupdir, "%s_rd.bam" % samp)
 dupflag = dupfile.replace(".bam", ".bam.flagstats")
 dupstat = op.join(dupdir, "%s_rd_dupstat.txt" % samp)
+dupindex = dupfile.replace(".bam", ".bai")
 
 # create sh file
+shdir = op.join(pooldir, 'shfiles/03_mark_build_shfiles')
+file = op.join(shdir, '%(pool)s-%(samp)s-mark.sh' % locals())
 email_text = get_email_info(op.dirname(pooldir), '03')
-text = f'''#!/bin/bash
-#SBATCH --time=11:59:00
-#SBATCH --mem=30000M
+if chain is True:
+    nextstep = f'''# balance the realign job (sbatched with this job as a dependency)
+python $HOME/pipeline/balance_queue.py realign {parentdir}'''
+else:
+    nextstep = f'''python $HOME/pipeline/04_realignTargetCreator.py {pooldir} {samp} {dupfile}'''
+if engine == 'samtools':
+    mem, walltime = get_resources(parentdir, 'mark-samtools', f'{pool}-{samp}-mark', [samp], '16000M', '11:59:00')
+    resources = f'''#SBATCH --mem={mem}
 #SBATCH --ntasks=1
-#SBATCH --job-name={pool}-{samp}-mark
-#SBATCH --output={pool}-{samp}-mark_%j.out 
-{email_text}
+#SBATCH --cpus-per-task=8'''
+    # lanes are merged in $SLURM_TMPDIR, collate then groups read pairs for fixmate
+    if len(sortfiles) == 1:
+        merged, merge = sortfiles[0], ''
+    else:
+        merged = f'$SLURM_TMPDIR/{samp}_merged.bam'
+        merge = f'''samtools merge -@ 8 -f {merged} {" ".join(sortfiles)}\n'''
+    dedup = f'''# remove dups (name-collate -> fixmate -> coordinate sort -> markdup, with markdup stats in dupstat)
+module load samtools/1.10
+{merge}samtools collate -@ 8 -O -u {merged} $SLURM_TMPDIR/{samp}_collate | \
+samtools fixmate -@ 8 -m -u - - | \
+samtools sort -@ 8 -m 1500M -u -T $SLURM_TMPDIR/{samp}_sort - | \
+samtools markdup -@ 8 -r -s -T $SLURM_TMPDIR/{samp}_markdup - {dupfile} 2> {dupstat}
 
-# remove dups
+# Build bam index for GATK
+samtools index -@ 8 {dupfile} {dupindex}
+module unload samtools'''
+else:
+    mem, walltime = get_resources(parentdir, 'mark', f'{pool}-{samp}-mark', [samp], '30000M', '11:59:00')
+    resources = f'''#SBATCH --mem={mem}
+#SBATCH --ntasks=1'''
+    dedup = f'''# remove dups
 module load java
 module load picard/2.18.9
 export _JAVA_OPTIONS="-Xms256m -Xmx27g"
@@ -46,34 +79,49 @@ M={dupstat} REMOVE_DUPLICATES=true
 
 # Build bam index for GATK
 java -jar $EBROOTPICARD/picard.jar BuildBamIndex I={dupfile}
-module unload picard
+module unload picard'''
+text = f'''#!/bin/bash
+#SBATCH --time={walltime}
+{resources}
+#SBATCH --job-name={pool}-{samp}-mark
+#SBATCH --output={pool}-{samp}-mark_%j.out 
+{email_text}
+
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
+{dedup}
 
 # get more dup stats
 module load samtools/1.9
 samtools flagstat {dupfile} > {dupflag}
 module unload samtools
 
-# call next step
+# record outputs so a resumed run can skip this stage (only reached if every command above succeeded)
 source {bash_variables}
+python $HOME/pipeline/manifest.py {pooldir} {samp} mark {file} {dupfile} {dupindex} {dupflag}
 
-python $HOME/pipeline/04_realignTargetCreator.py {pooldir} {samp} {dupfile}
+# call next step
+{nextstep}
 
 '''
 
 # create shdir and file
-shdir = op.join(pooldir, 'shfiles/03_mark_build_shfiles')
 for d in [shdir, dupdir]:
     makedir(d)
-file = op.join(shdir, '%(pool)s-%(samp)s-mark.sh' % locals())
 with open(file, 'w') as o:
     o.write("%s" % text)
 
+if chain is True:
+    # 00_start-pipeline.py will sbatch the file along with the rest of the sample's stages
+    exit()
+
 # sbatch file
-os.chdir(shdir)
 print('shdir = ', shdir)
-subprocess.call([shutil.which('sbatch'), file])
+get_executor().submit(file)
 
-# balance queue
-balance_queue = op.join(os.environ['HOME'], 'pipeline/balance_queue.py')
-subprocess.call([sys.executable, balance_queue, 'mark', parentdir])
-subprocess.call([sys.executable, balance_queue, 'bwa', parentdir])
+# balance queue (unless the balance_queue.py daemon is running)
+if not daemon_running():
+    balance_queue = op.join(os.environ['HOME'], 'pipeline/balance_queue.py')
+    subprocess.call([sys.executable, balance_queue, 'mark', parentdir])
+    subprocess.call([sys.executable, balance_queue, 'bwa', parentdir])
@@ -2,6 +2,10 @@
 
 ### purpose
 # use the GATK to create target intervals for realignment around indels
+# if the pipeline was started with `--scatter_realign N`, the reference is split into N
+#    chunks of whole contigs (see create_bedfiles.make_interval_lists) and targets are created
+#    for each chunk in a separate short job. The sample's realign job then only concatenates
+#    the chunks' .list files (in reference order) into the usual listfile for 05_indelRealign.py
 ###
 
 ### usage
@@ -9,9 +13,13 @@
 ###
 """
 
-import os, sys, subprocess, shutil
+import os, sys, subprocess
 from os import path as op
-from coadaptree import makedir, pklload, get_email_info
+from coadaptree import fs, makedir, pklload, get_email_info, get_start_opt
+from create_bedfiles import make_interval_lists
+from executor import get_executor
+from resources import get_resources
+from balance_queue import daemon_running
 
 thisfile, pooldir, samp, dupfile = sys.argv
 
@@ -24,11 +32,77 @@ parentdir = op.dirname(pooldir)
 pool = op.basename(pooldir)
 ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
 bash_variables = op.join(parentdir, 'bash_variables')
+chain = get_start_opt(parentdir, 'chain', False)  # if True, 00_start sbatches all stages itself
+nscatter = get_start_opt(parentdir, 'scatter_realign', 0)
 
+shdir = op.join(pooldir, 'shfiles/04_realignTarget_shfiles')
+file = op.join(shdir, f'{pool}-{samp}-realign.sh')
 email_text = get_email_info(parentdir, '04')
-text = f'''#!/bin/bash
-#SBATCH --time=7-00:00:00
-#SBATCH --mem=30000M
+if chain is True:
+    nextstep = f'''# balance the indelRealign job (sbatched with this job as a dependency)
+python $HOME/pipeline/balance_queue.py indelRealign {parentdir}'''
+else:
+    nextstep = f'''python $HOME/pipeline/05_indelRealign.py {pooldir} {samp} {dupfile} {ref}'''
+
+
+def getscattertext(intfile, chunkfile, num):
+    """Create targets for the contigs in intfile."""
+    mem, walltime = get_resources(parentdir, 'realign-scatter', f'{pool}-{samp}-realign-scatter_{num}', [samp],
+                                  '16000M', '1-00:00:00')
+    return f'''#!/bin/bash
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
+#SBATCH --nodes=1
+#SBATCH --ntasks=8
+#SBATCH --cpus-per-task=1
+#SBATCH --job-name={pool}-{samp}-realign-scatter_{num}
+#SBATCH --output={pool}-{samp}-realign-scatter_{num}_%j.out 
+{email_text}
+
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
+# realign using the GATK, for the contigs in {op.basename(intfile)}
+module load java
+module load gatk/3.8
+export _JAVA_OPTIONS="-Xms256m -Xmx14g"
+java -Djava.io.tmpdir=$SLURM_TMPDIR -jar $EBROOTGATK/GenomeAnalysisTK.jar \
+-T RealignerTargetCreator -R {ref} --num_threads 8 -I {dupfile} -L {intfile} -o {chunkfile}
+module unload gatk
+
+'''
+
+
+def getgathertext(chunkfiles):
+    """Concatenate the targets of each chunk, in reference order."""
+    chunks = ' \\\n'.join(chunkfiles)
+    # the realign job's resources are saved again here, as a gather job
+    mem, walltime = get_resources(parentdir, 'realign-gather', f'{pool}-{samp}-realign', [samp], '1000M', '00:30:00')
+    return f'''#!/bin/bash
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=1
+#SBATCH --job-name={pool}-{samp}-realign
+#SBATCH --output={pool}-{samp}-realign_%j.out 
+{email_text}
+
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
+# gather targets from each chunk of the reference
+cat \\
+{chunks} \\
+> {listfile}
+
+'''
+
+
+mem, walltime = get_resources(parentdir, 'realign', f'{pool}-{samp}-realign', [samp], '30000M', '7-00:00:00')
+realigntext = f'''#!/bin/bash
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
 #SBATCH --nodes=1
 #SBATCH --ntasks=32
 #SBATCH --cpus-per-task=1
@@ -36,6 +110,9 @@ text = f'''#!/bin/bash
 #SBATCH --output={pool}-{samp}-realign_%j.out 
 {email_text}
 
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
 # realign using the GATK
 module load java
 module load gatk/3.8
@@ -44,26 +121,54 @@ java -Djava.io.tmpdir=$SLURM_TMPDIR -jar $EBROOTGATK/GenomeAnalysisTK.jar \
 -T RealignerTargetCreator -R {ref} --num_threads 32 -I {dupfile} -o {listfile}
 module unload gatk
 
-# next step
+'''
+tailtext = f'''# record outputs so a resumed run can skip this stage (only reached if every command above succeeded)
 source {bash_variables}
-python $HOME/pipeline/05_indelRealign.py {pooldir} {samp} {dupfile} {ref}
+python $HOME/pipeline/manifest.py {pooldir} {samp} realign {file} {listfile}
+
+# next step
+{nextstep}
 
 '''
 
 # create shdir and shfile
-shdir = op.join(pooldir, 'shfiles/04_realignTarget_shfiles')
 for d in [aligndir, shdir]:
     makedir(d)
-file = op.join(shdir, f'{pool}-{samp}-realign.sh')
+# remove scatter files from a previous attempt (00_start-pipeline.py sbatches any that exist)
+for f in fs(shdir):
+    if op.basename(f).startswith(f'{pool}-{samp}-realign-scatter_') and f.endswith('.sh'):
+        os.remove(f)
+text = realigntext + tailtext
+scatterfiles = []
+if nscatter > 0:
+    scatterdir = makedir(op.join(aligndir, 'scatter'))
+    intfiles = make_interval_lists(ref, op.join(scatterdir, f'intervals_{nscatter}'), nscatter)
+    chunkfiles = []
+    for intfile in intfiles:
+        num = intfile.split("_")[-1].replace(".list", "")
+        chunkfile = op.join(scatterdir, f'{samp}_realingment_targets_{num}.list')
+        scatterfile = op.join(shdir, f'{pool}-{samp}-realign-scatter_{num}.sh')
+        with open(scatterfile, 'w') as o:
+            o.write("%s" % getscattertext(intfile, chunkfile, num))
+        chunkfiles.append(chunkfile)
+        scatterfiles.append(scatterfile)
+    # the realign job only gathers the targets of each chunk
+    text = getgathertext(chunkfiles) + tailtext
 with open(file, 'w') as o:
     o.write("%s" % text)
 
+if chain is True:
+    # 00_start-pipeline.py will sbatch the file along with the rest of the sample's stages
+    exit()
+
 # sbatch file
-os.chdir(shdir)
 print('shdir =', shdir)
-subprocess.call([shutil.which('sbatch'), file])
+executor = get_executor()
+pids = [executor.submit(f) for f in scatterfiles]
+executor.submit(file, dependencies=pids)
 
-# balance queue
-balance_queue = op.join(os.environ['HOME'], 'pipeline/balance_queue.py')
-subprocess.call([sys.executable, balance_queue, 'realign', parentdir])
-subprocess.call([sys.executable, balance_queue, 'mark', parentdir])
+# balance queue (unless the balance_queue.py daemon is running)
+if not daemon_running():
+    balance_queue = op.join(os.environ['HOME'], 'pipeline/balance_queue.py')
+    subprocess.call([sys.executable, balance_queue, 'realign', parentdir])
+    subprocess.call([sys.executable, balance_queue, 'mark', parentdir])
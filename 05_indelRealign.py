@@ -3,16 +3,28 @@ Start varscan if all realigned bamfiles have been made.
 
 ### purpose
 # use the GATK to realign around indels
+# if the pipeline was started with `--scatter_realign N`, each of the N chunks of the reference
+#    used by 04_realignTargetCreator.py is realigned in a separate job. The sample's indelRealign
+#    job then merges the chunks' bamfiles (in coordinate order) into the usual realigned bamfile
+#    and index, and starts varscan as usual
 ###
 
 ### usage
 # python 05_indelRealign.py /path/to/pooldir/ sampID
 ###
+
+### assumes
+# with --scatter_realign, reads are sharded by whole contigs. There are no unmapped reads to
+#    lose (02_bwa filters reads to mapped proper pairs)
+###
 """
 
-import os, sys, balance_queue, subprocess, shutil
+import os, sys, balance_queue
 from os import path as op
-from coadaptree import makedir, get_email_info
+from coadaptree import fs, makedir, get_email_info, get_start_opt
+from create_bedfiles import make_interval_lists
+from executor import get_executor
+from resources import get_resources
 
 
 thisfile, pooldir, samp, dupfile, ref = sys.argv
@@ -24,17 +36,86 @@ parentdir = op.dirname(pooldir)
 aligndir = op.join(pooldir, '04_realign')
 listfile = op.join(aligndir, f'{samp}_realingment_targets.list')
 realbam = op.join(aligndir, f'{samp}_realigned_reads.bam')
+realbai = realbam.replace('.bam', '.bai')
 bash_variables = op.join(parentdir, 'bash_variables')
+shdir = op.join(pooldir, 'shfiles/05_indelRealign_shfiles')
+file = op.join(shdir, f'{pool}-{samp}-indelRealign.sh')
+nscatter = get_start_opt(parentdir, 'scatter_realign', 0)
 
 email_text = get_email_info(parentdir, '05')
-text = f'''#!/bin/bash
-#SBATCH --time=7-00:00:00
-#SBATCH --mem=8000M
+
+
+def getscattertext(intfile, chunkbam, num):
+    """Realign reads on the contigs in intfile."""
+    mem, walltime = get_resources(parentdir, 'indelRealign-scatter', f'{pool}-{samp}-indelRealign-scatter_{num}',
+                                  [samp], '8000M', '2-00:00:00')
+    return f'''#!/bin/bash
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
 #SBATCH --ntasks=1
+#SBATCH --job-name={pool}-{samp}-indelRealign-scatter_{num}
+#SBATCH --output={pool}-{samp}-indelRealign-scatter_{num}_%j.out 
+{email_text}
+
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
+# realign the contigs in {op.basename(intfile)}
+module load java
+module load gatk/3.8
+export _JAVA_OPTIONS="-Xms256m -Xmx7g"
+java -Djava.io.tmpdir=$SLURM_TMPDIR -jar $EBROOTGATK/GenomeAnalysisTK.jar \
+-T IndelRealigner -R {ref} -I {dupfile} -targetIntervals {listfile} -L {intfile} -o {chunkbam}
+module unload gatk
+
+'''
+
+
+def getgathertext(chunkbams):
+    """Merge the realigned reads of each chunk, in coordinate order."""
+    chunks = ' \\\n'.join(chunkbams)
+    chunkfiles = ' '.join(chunkbams + [chunkbam.replace('.bam', '.bai') for chunkbam in chunkbams])
+    # the indelRealign job's resources are saved again here, as a gather job
+    mem, walltime = get_resources(parentdir, 'indelRealign-gather', f'{pool}-{samp}-indelRealign', [samp],
+                                  '8000M', '1-00:00:00')
+    return f'''#!/bin/bash
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
+#SBATCH --ntasks=8
 #SBATCH --job-name={pool}-{samp}-indelRealign
 #SBATCH --output={pool}-{samp}-indelRealign_%j.out 
 {email_text}
 
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
+# gather realigned reads from each chunk of the reference
+module load samtools/1.10
+samtools merge -f -c -p -@ 8 {realbam} \\
+{chunks}
+samtools index -@ 8 {realbam} {realbai}
+module unload samtools
+
+# remove chunks once the realigned bamfile is indexed
+if [ -f {realbai} ]; then
+    rm -f {chunkfiles}
+fi
+
+'''
+
+
+mem, walltime = get_resources(parentdir, 'indelRealign', f'{pool}-{samp}-indelRealign', [samp], '8000M', '7-00:00:00')
+realigntext = f'''#!/bin/bash
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
+#SBATCH --ntasks=1
+#SBATCH --job-name={pool}-{samp}-indelRealign
+#SBATCH --output={pool}-{samp}-indelRealign_%j.out 
+{email_text}
+
+# stop at the first failed command (or pipe) so failed work is not recorded or passed on to the next stage
+set -eo pipefail
+
 module load java
 module load gatk/3.8
 export _JAVA_OPTIONS="-Xms256m -Xmx7g"
@@ -42,24 +123,53 @@ java -Djava.io.tmpdir=$SLURM_TMPDIR -jar $EBROOTGATK/GenomeAnalysisTK.jar \
 -T IndelRealigner -R {ref} -I {dupfile} -targetIntervals {listfile} -o {realbam}
 module unload gatk
 
-# sbatch varscan jobs if all pooled bamfiles have been created
+'''
+tailtext = f'''# record outputs so a resumed run can skip this stage (only reached if every command above succeeded)
 source {bash_variables}
+python $HOME/pipeline/manifest.py {pooldir} {samp} indelRealign {file} {realbam} {realbai}
+
+# sbatch varscan jobs if all pooled bamfiles have been created
 python $HOME/pipeline/start_varscan.py {parentdir} {pool}
 python $HOME/pipeline/balance_queue.py bedfile {parentdir}
 
 '''
 
 # create shdir and shfile
-shdir = op.join(pooldir, 'shfiles/05_indelRealign_shfiles')
 makedir(shdir)
-file = op.join(shdir, f'{pool}-{samp}-indelRealign.sh')
+# remove scatter files from a previous attempt (00_start-pipeline.py sbatches any that exist)
+for f in fs(shdir):
+    if op.basename(f).startswith(f'{pool}-{samp}-indelRealign-scatter_') and f.endswith('.sh'):
+        os.remove(f)
+text = realigntext + tailtext
+scatterfiles = []
+if nscatter > 0:
+    scatterdir = makedir(op.join(aligndir, 'scatter'))
+    intfiles = make_interval_lists(ref, op.join(scatterdir, f'intervals_{nscatter}'), nscatter)
+    chunkbams = []
+    for intfile in intfiles:
+        num = intfile.split("_")[-1].replace(".list", "")
+        chunkbam = op.join(scatterdir, f'{samp}_realigned_reads_{num}.bam')
+        scatterfile = op.join(shdir, f'{pool}-{samp}-indelRealign-scatter_{num}.sh')
+        with open(scatterfile, 'w') as o:
+            o.write("%s" % getscattertext(intfile, chunkbam, num))
+        chunkbams.append(chunkbam)
+        scatterfiles.append(scatterfile)
+    # the indelRealign job only gathers the realigned reads of each chunk
+    text = getgathertext(chunkbams) + tailtext
 with open(file, 'w') as o:
     o.write("%s" % text)
 
-os.chdir(shdir)
+if get_start_opt(parentdir, 'chain', False) is True:
+    # 00_start-pipeline.py will sbatch the file along with the rest of the sample's stages
+    exit()
+
 print('shdir = ', shdir)
-subprocess.call([shutil.which('sbatch'), file])
+executor = get_executor()
+pids = [executor.submit(f) for f in scatterfiles]
+executor.submit(file, dependencies=pids)
 
 
-balance_queue.main('balance_queue.py', 'indelRealign', parentdir)
-balance_queue.main('balance_queue.py', 'realign', parentdir)
+# balance queue (unless the balance_queue.py daemon is running)
+if not balance_queue.daemon_running():
+    balance_queue.main('balance_queue.py', 'indelRealign', parentdir)
+    balance_queue.main('balance_queue.py', 'realign', parentdir)
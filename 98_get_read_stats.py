@@ -4,11 +4,17 @@ Count reads in bamfiles from throughout pipeline.
 
 # usage
 # module load samtools/1.9
-# python 99_get_read_stats.py parentdir 32
+# python 98_get_read_stats.py parentdir 32
 #
 
 # purpose
 # get counts for trimmed, bams
+# bam counts (same as `samtools view -c`) come from the .bai index of each bamfile, or the
+#    .flagstats file written by 02_bwa/03_mark, when either is newer than the bamfile -
+#    otherwise `samtools view -c` reads the bamfile. Files are read by a pool of `engines` threads
+# bamfiles that samtools can't read (eg still being written, or truncated) are reported as NA
+# stats of each file are saved in parentdir/readinfo_cache.pkl with the file's size and mtime,
+#    so that later runs only read files that are new or have changed since the last run
 #
 
 # TODO
@@ -17,15 +23,87 @@ Count reads in bamfiles from throughout pipeline.
 """
 
 # imports
-import os, sys, json, pandas as pd
+import os, sys, json, struct, subprocess, pandas as pd
 from tqdm import tqdm
 from os import path as op
 from collections import OrderedDict
-from coadaptree import fs, uni, pklload, Bcolors
+from concurrent.futures import ThreadPoolExecutor
+from bamstats import count_records
+from coadaptree import fs, uni, pklload, pkldump, Bcolors
+
+
+def read_json(jsonfile):
+    """Keep only the parts of a fastp .json file used for readinfo.txt (so the cache stays small)."""
+    with open(jsonfile, 'r') as o:
+        data = json.load(o)
+    return {'summary': data['summary'], 'command': data['command']}
+
+
+def read_flagstat(flagfile):
+    """Get the total number of records (QC-passed + QC-failed) from `samtools flagstat` output."""
+    with open(flagfile, 'r') as o:
+        splits = o.readline().split()
+    # eg: 1234 + 0 in total (QC-passed reads + QC-failed reads)
+    if len(splits) < 4 or splits[1] != '+' or splits[3] != 'in':
+        return None
+    return int(splits[0]) + int(splits[2])
+
+
+def count_reads(bamfile):
+    """Count records in bamfile from its index or flagstat file if either is exact, else with samtools.
+
+    Returns:
+    num - number of records, None if samtools could not read bamfile (eg still being written)
+    source - 'index', 'flagstat', 'samtools', or 'failed'
+    """
+    try:
+        num = count_records(bamfile)
+    except (OSError, ValueError, EOFError, struct.error):
+        # eg an index that is still being written (or was truncated)
+        num = None
+    if num is not None:
+        return num, 'index'
+    flagfile = bamfile + '.flagstats'
+    if op.exists(flagfile) and op.getmtime(flagfile) >= op.getmtime(bamfile):
+        num = read_flagstat(flagfile)
+        if num is not None:
+            return num, 'flagstat'
+    try:
+        output = subprocess.check_output(['samtools', 'view', '-c', bamfile]).decode('utf-8')
+        return int(output.strip()), 'samtools'
+    except (subprocess.CalledProcessError, ValueError):
+        return None, 'failed'
+
+
+def fingerprint(f):
+    st = os.stat(f)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def get_stats(files, func, cache, engines):
+    """Get func(f) for each of files, reusing results in cache for files that have not changed.
+
+    Positional arguments:
+    files - list of paths
+    func - function that reads stats from a path
+    cache - dict with key = path, val = (fingerprint, stats) - updated in place
+    engines - number of files read at a time
+
+    Returns:
+    stats - list of func(f) for each of files
+    """
+    prints = {f: fingerprint(f) for f in files}  # before reading, so files changed meanwhile are redone next run
+    todo = [f for f in files if f not in cache or cache[f][0] != prints[f]]
+    print('\t%s of %s files are new or changed since the last run' % (len(todo), len(files)))
+    with ThreadPoolExecutor(max_workers=engines) as pool:
+        for f, result in zip(todo, tqdm(pool.map(func, todo), total=len(todo))):
+            cache[f] = (prints[f], result)
+    return [cache[f][1] for f in files]
 
 
 # args
 thisfile, parentdir, engines = sys.argv
+engines = int(engines)
 if parentdir.endswith("/"):
     parentdir = parentdir[:-1]
 
@@ -36,6 +114,11 @@ samp2pool = pklload(op.join(parentdir, 'samp2pool.pkl'))
 pools = uni(list(samp2pool.values()))
 
 
+# stats of files from previous runs
+cachefile = op.join(parentdir, 'readinfo_cache.pkl')
+cache = pklload(cachefile) if op.exists(cachefile) else {}
+
+
 # get a list of subdirectory pool dirs created earlier in pipeline
 print('getting pooldirs')
 pooldirs = []
@@ -47,15 +130,11 @@ for p in pools:
 # TRIMMING DATA
 # get the json data from trimming
 print(Bcolors.BOLD + '\nGetting trim data ...' + Bcolors.ENDC)
-data = {}
-count = 0
+jsons = []
 for p in pooldirs:
     trimdir = op.join(p, '01_trimmed')
-    jsons = [f for f in fs(trimdir) if f.endswith('.json')]
-    count += len(jsons)
-    for j in jsons:
-        with open(j,'r') as f:
-            data[op.basename(j)] = json.load(f)
+    jsons.extend([f for f in fs(trimdir) if f.endswith('.json')])
+data = dict(zip([op.basename(j) for j in jsons], get_stats(jsons, read_json, cache, engines)))
 
 
 # put data into a dataframe, and sort columns
@@ -84,15 +163,14 @@ print(Bcolors.BOLD + '\nGetting bam counts ...' + Bcolors.ENDC)
 key = ['mapped_bamfile', 'dedup_bamfile', 'realigned_bamfile']
 for k in key:
     readinfo[k] = OrderedDict()
+jobs = []  # (key, samp, bamfile)
 for p in pooldirs:
-    print(p)
     for i,d in enumerate(['02c_sorted_bamfiles',
                           '03_dedup_rg_filtered_indexed_sorted_bamfiles',
                           '04_realign']):
-        print(d)
         DIR = op.join(p, d)
         bams = [f for f in fs(DIR) if f.endswith('.bam')]
-        for b in tqdm(bams):
+        for b in bams:
             if d == '02c_sorted_bamfiles':
                 splits = op.basename(b).split("_R1R2")[0].split(".")
                 samp = '.'.join([splits[-1]] + splits[:-1])
@@ -100,8 +178,27 @@ for p in pooldirs:
                 samp = op.basename(b).replace("_rd.bam", "")
             else:
                 samp = op.basename(b).split("_realigned")[0]
-            num = os.popen('samtools view -@ %(engines)s -c %(b)s' % locals()).read().replace("\n", "")
-            readinfo[key[i]][samp] = num
+            jobs.append((key[i], samp, b))
+sources = {}
+failed = []
+counts = get_stats([b for k, samp, b in jobs], count_reads, cache, engines)
+for (k, samp, b), (num, source) in zip(jobs, counts):
+    readinfo[k][samp] = num if num is not None else 'NA'
+    sources[source] = sources.get(source, 0) + 1
+    if source == 'failed':
+        # not cached, so the file is counted again next run (eg once it is finished being written)
+        del cache[b]
+        failed.append(b)
+print('\tcounted %s bamfiles: %s' % (len(jobs), ', '.join('%s from %s' % (n, s) for s, n in sorted(sources.items()))))
+if len(failed) > 0:
+    print(Bcolors.WARNING + '\tWARNING: could not count reads in %s bamfiles (reported as NA):\n\t\t%s'
+          % (len(failed), '\n\t\t'.join(failed)) + Bcolors.ENDC)
+
+# save stats of files that still exist for the next run (write then rename so the cache is never partial)
+current = set(jsons + [b for k, samp, b in jobs])
+tmp = '%s.%s.tmp' % (cachefile, os.getpid())
+pkldump({f: val for f, val in cache.items() if f in current}, tmp)
+os.replace(tmp, cachefile)
 
 
 # make the dataframe
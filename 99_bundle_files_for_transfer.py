@@ -108,13 +108,13 @@ for p in pooldirs:
         cmds.extend(get_cmds(srcfiles, md5files, remoted, False))
 
 
-# get bedtools coords and samtools flagstat
-print(Bcolors.BOLD + '\nBundling bedtools coords and samtools flagstats ...' + Bcolors.ENDC)
+# get coverage summaries (or bedtools coords from older runs) and samtools flagstat
+print(Bcolors.BOLD + '\nBundling coverage summaries and samtools flagstats ...' + Bcolors.ENDC)
 for p in pooldirs:
     bwadir = op.join(p, '02c_sorted_bamfiles')
     remotebwadir = op.join(remote, f'{op.basename(p)}/bedcoords_samflagstats')
     newdirs.append(remotebwadir)
-    coords = [f for f in fs(bwadir) if 'coord' in f]
+    coords = [f for f in fs(bwadir) if 'coord' in f or f.endswith('.cov')]
     flags = [f for f in fs(bwadir) if 'flagstat' in f]
     cmds.extend(get_cmds(coords, [], remotebwadir, False))
     cmds.extend(get_cmds(flags, [], remotebwadir, False))
@@ -10,7 +10,7 @@ Distribute priority jobs among accounts.
 ###
 # usage: python balance_queue.py [keyword] [parentdir]
 #
-# keyword is used to search across column data in queue
+# keyword is used to search job names in the queue ($USER for all jobs)
 # parentdir is used to either find a previously saved list of accounts
 #    or is set to 'choose' so the user can run from command line
 #    and manually choose which accounts are used
@@ -30,6 +30,19 @@ Distribute priority jobs among accounts.
 # because of possible exit() commands in balance_queue, this should be run
 #    as a main program, or as a subprocess when run inside another python
 #    script.
+#
+# to balance every pipeline stage from one long-running process (one per user):
+#    python balance_queue.py daemon [parentdir] [interval_in_seconds]
+#    (parentdir is used to find accounts.pkl as above; default interval = 300)
+#    while the daemon is running, `python balance_queue.py keyword parentdir` exits
+#    without balancing, and stage scripts skip balancing. The daemon logs its
+#    decisions to $HOME/.balance_queue_daemon.log (along with any errors, after which it
+#    tries again the next round)
+#
+# if the pipeline was started with `--balance_mode fairshare`, jobs are given to each
+#    account in proportion to its FairShare (from `sshare`, cached in parentdir/fairshare.pkl
+#    for an hour) instead of evenly. To see the fairshare plan without moving any jobs:
+#    python balance_queue.py plan keyword [parentdir]
 ###
 
 ### assumes
@@ -37,10 +50,26 @@ Distribute priority jobs among accounts.
 ###
 """
 
-import os, shutil, sys, math, subprocess, time
-from random import shuffle
-from collections import Counter
-from coadaptree import Bcolors, pklload, pkldump
+import os, sys, math, time, heapq, socket, signal, traceback
+from os import path as op
+from random import Random
+from collections import defaultdict, namedtuple
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from coadaptree import Bcolors, pklload, pkldump, get_start_opt
+from executor import get_executor, SQUEUE_FIELDS, SQUEUE_DELIM
+
+# keywords for the priority jobs of each pipeline stage, balanced by the daemon - each job
+# is balanced with the first keyword it matches (eg 'indelRealign' jobs before 'realign')
+STAGES = ['trim', 'bwa', 'mark', 'indelRealign', 'realign', 'bedfile']
+DAEMON_LOCK = op.join(os.environ['HOME'], '.balance_queue_daemon')
+DAEMON_LOG = op.join(os.environ['HOME'], '.balance_queue_daemon.log')
+MOVE_BATCHSIZE = 100  # max number of jobs moved with one scontrol call
+MOVE_PROCS = 4  # max number of scontrol calls running at once
+FAIRSHARE_MAXAGE = 3600  # seconds before a saved fairshare snapshot is queried again
+
+# a job in the queue, with the fields of SQUEUE_FORMAT (so job[0] = jobid, job[2] = account)
+SqJob = namedtuple('SqJob', [field for field, code in SQUEUE_FIELDS])
 
 
 def announceacctlens(accounts, fin):
@@ -51,8 +80,6 @@ def announceacctlens(accounts, fin):
     fin - True if this is the final job announcement, otherwise the first announcement
     """
     print('\t%s job announcement' % ('final' if fin is True else 'first'))
-    if fin is True:
-        time.sleep(1)
     for account in accounts:
         print('\t%s jobs with Priority status on %s' % (str(len(accounts[account])), account))
 
@@ -61,8 +88,8 @@ def checksq(sq):
     """Make sure queue slurm command worked. Sometimes it doesn't.
     
     Positional arguments:
-    sq - list of squeue slurm command jobs, each line is str.split()
-       - slurm_job_id is zeroth element of str.split()
+    sq - list of lines of delimited squeue output (see executor.SQUEUE_FIELDS)
+       - slurm_job_id is the first field
     """
     exitneeded = False
     if not isinstance(sq, list):
@@ -72,8 +99,8 @@ def checksq(sq):
         if 'socket' in s.lower():
             print("\tsocket in sq return, exiting %(thisfile)s" % globals())
             exitneeded = True
-        if not int(s.split()[0]) == float(s.split()[0]):
-            print("\tcould not assert int == float, %s" % (s[0]))
+        elif not s.split(SQUEUE_DELIM)[0].isdigit() or len(s.split(SQUEUE_DELIM)) < len(SQUEUE_FIELDS):
+            print("\tcould not parse squeue output: %s" % s)
             exitneeded = True
     if exitneeded is True:
         print('\tslurm screwed something up for %(thisfile)s, lame' % globals())
@@ -96,66 +123,127 @@ def getsq_exit(balancing):
         return []
 
 
-def getsq(grepping=None, states=[], balancing=False):
+def parsesq(line):
+    """Parse a line of delimited squeue output into an SqJob (with nodes and cpus as int)."""
+    values = line.split(SQUEUE_DELIM)
+    # the job name is the only field set by the user, rejoin it if it contains the delimiter
+    extra = len(values) - len(SQUEUE_FIELDS)
+    if extra > 0:
+        values = values[:3] + [SQUEUE_DELIM.join(values[3:4+extra])] + values[4+extra:]
+    job = SqJob(*values)
+    return job._replace(nodes=int(job.nodes), cpus=int(job.cpus))
+
+
+def getsq(grepping=None, states=[], balancing=False, reason=None):
     """
     Get jobs from squeue slurm command matching crieteria.
 
     Positional arguments:
-    grepping - list of key words to look for in each column of job info
+    grepping - list of key words that must all be in the job name (None for all of the user's jobs)
     states - list of states {pending, running} wanted in squeue jobs
     balancing - bool: True if using to balance priority jobs, else for other queue queries
+    reason - only keep pending jobs with this reason (eg 'Priority'), all jobs if None
 
     Returns:
-    grepped - list of tuples where tuple elements are line.split() for each line of squeue \
-slurm command that matched grepping queries
+    grepped - list of SqJob namedtuples (job[0] = jobid, job[2] = account) for each job in \
+squeue that matched grepping and reason
     """
     if grepping is None:
-        grepping = [os.environ['USER']]
+        grepping = []
     if isinstance(grepping, str):
         # in case I pass a single str instead of a list of strings
         grepping = [grepping]
 
     # get the queue, without a header
-    cmd = [shutil.which('squeue'),
-           '-u',
-           os.environ['USER'],
-           '-h']
-    if 'running' in states:
-        cmd.extend(['-t', 'RUNNING'])
-    elif 'pending' in states:
-        cmd.extend(['-t', 'PD'])
-    sqout = subprocess.check_output(cmd).decode('utf-8').split('\n')
+    sqout = get_executor().squeue(states, delimited=True)
 
     sq = [s for s in sqout if s != '']
     checksq(sq)  # make sure slurm gave me something useful
 
     # look for the things I want to grep
-    grepped = []
-    if len(sq) > 0:
-        for q in sq:  # for each job in queue
-            splits = q.split()
-            if 'CG' not in splits:  # grep -v 'CG' = skip jobs that are closing
-                keepit = 0
-                if len(grepping) > 0:  # see if all necessary greps are in the job
-                    for grep in grepping:
-                        for split in splits:
-                            if grep.lower() in split.lower():
-                                keepit += 1
-                                break
-                if keepit == len(grepping) and len(grepping) != 0:
-                    grepped.append(tuple(splits))
-
-        if len(grepped) > 0:
-            return grepped
+    grepped = grepsq([parsesq(q) for q in sq], grepping, reason)
+    if len(grepped) > 0:
+        return grepped
     return getsq_exit(balancing)
 
 
-def adjustjob(acct, jobid):
-    """Move job from one account to another."""
-    subprocess.Popen([shutil.which('scontrol'),
-                      'update',
-                      'Account=%s_cpu' % acct,
-                      'JobId=%s' % str(jobid)])
+def grepsq(sq, grepping, reason=None):
+    """Get jobs from sq whose names contain all of the key words in grepping.
+
+    Positional arguments:
+    sq - list of SqJob namedtuples
+    grepping - list of key words to look for in each job name (case-insensitive)
+
+    Keyword arguments:
+    reason - only keep jobs with this reason (eg 'Priority'), all jobs if None
+    """
+    grepping = [grep.lower() for grep in grepping]
+    return [job for job in sq
+            if job.state != 'CG'  # skip jobs that are closing
+            and (reason is None or job.reason == reason)
+            and all(grep in job.name.lower() for grep in grepping)]
+
+
+def adjustjobs(acct, jobids):
+    """Move jobs to acct with one scontrol call. If it fails, move jobs one at a time.
+
+    Returns:
+    moved - list of jobids that were moved
+    failed - list of jobids that could not be moved (eg jobs that started in the meantime)
+    calls - number of scontrol calls
+    """
+    account = '%s_cpu' % acct
+    if get_executor().update_accounts(account, jobids) == 0:
+        return jobids, [], 1
+    if len(jobids) == 1:
+        return [], jobids, 1
+    moved, failed = [], []
+    for jobid in jobids:
+        (moved if get_executor().update_accounts(account, [jobid]) == 0 else failed).append(jobid)
+    return moved, failed, 1 + len(jobids)
+
+
+def move_jobs(moves, batchsize=MOVE_BATCHSIZE, procs=MOVE_PROCS):
+    """Move jobs to new accounts in batches, with at most procs scontrol calls at once.
+
+    Positional arguments:
+    moves - dict with key = account, val = list of jobids to move to account
+
+    Returns:
+    summary - dict with keys:
+              moved - dict with key = account, val = list of jobids moved to account
+              failed - dict with key = account, val = list of jobids that could not be moved to account
+              calls - number of scontrol calls
+    """
+    batches = [(acct, jobids[i:i+batchsize])
+               for acct, jobids in moves.items()
+               for i in range(0, len(jobids), batchsize)]
+    summary = {'moved': defaultdict(list), 'failed': defaultdict(list), 'calls': 0}
+    with ThreadPoolExecutor(max_workers=procs) as pool:
+        for (acct, jobids), (moved, failed, calls) in zip(batches,
+                                                         pool.map(lambda batch: adjustjobs(*batch), batches)):
+            summary['moved'][acct].extend(moved)
+            summary['failed'][acct].extend(failed)
+            summary['calls'] += calls
+    return summary
+
+
+def apply_moves(accounts, summary):
+    """Get per-account jobs after the moves in summary (from move_jobs), without querying slurm.
+
+    Positional arguments:
+    accounts - dict: key = account, value = dict with key = pid, value = squeue output
+    summary - output from move_jobs()
+    """
+    final = dict((account, dict(jobs)) for account, jobs in accounts.items())
+    for taker, pids in summary['moved'].items():
+        for pid in pids:
+            for account in list(final.keys()):
+                if pid in final[account]:
+                    job = final[account].pop(pid)
+                    final.setdefault(taker, {})[pid] = job
+                    break
+    return dict((account, jobs) for account, jobs in final.items() if len(jobs) > 0)
 
 
 def getaccounts(sq, stage, user_accts):
@@ -171,14 +259,18 @@ def getaccounts(sq, stage, user_accts):
     # get accounts with low priority
     accounts = {}
     for q in sq:
-        pid = q[0]
-        account = q[2].split("_")[0]
-        if account not in accounts and account in user_accts:
+        pid = q.jobid
+        account = q.account.split("_")[0]
+        if account not in user_accts:
+            # eg an account that is no longer in accounts.pkl
+            continue
+        if account not in accounts:
             accounts[account] = {}
         accounts[account][pid] = q
 
     # if all user_accts have low priority, exit()
-    if len(accounts.keys()) == len(user_accts) and stage != 'final':
+    # (fairshare targets are uneven, so accounts can need balancing even if they all have jobs)
+    if len(accounts.keys()) == len(user_accts) and stage not in ['final', 'fairshare']:
         print('\tall accounts have low priority, leaving queue as-is')
         announceacctlens(accounts, True)
         exit()
@@ -199,6 +291,120 @@ def getbalance(accounts, num):
     return bal
 
 
+def get_balance_mode(parentdir):
+    """Get the --balance_mode chosen with 00_start-pipeline.py (even when run outside of the pipeline)."""
+    if parentdir in [None, 'choose']:
+        return 'even'
+    return get_start_opt(parentdir, 'balance_mode', 'even')
+
+
+def get_fairshare(user_accts, parentdir=None):
+    """Get the FairShare (0-1, higher schedules sooner) of each account from sshare.
+
+    The values are saved in parentdir/fairshare.pkl, and reused for FAIRSHARE_MAXAGE seconds
+    so that balancing many times in a row doesn't query slurm each time.
+
+    Returns:
+    fairshare - dict with key = account, val = FairShare (0 if sshare did not report the account)
+    """
+    pkl = op.join(parentdir, 'fairshare.pkl') if parentdir not in [None, 'choose'] else None
+    if pkl is not None and op.exists(pkl) and time.time() - op.getmtime(pkl) < FAIRSHARE_MAXAGE:
+        fairshare = pklload(pkl)
+    else:
+        fairshare = {}
+        for line in get_executor().sshare(['Account', 'FairShare']):
+            splits = line.split()
+            if len(splits) == 2 and '_cpu' in splits[0]:
+                try:
+                    fairshare[splits[0].split("_")[0]] = float(splits[1])
+                except ValueError:
+                    pass
+        if pkl is not None:
+            pkldump(fairshare, pkl)
+    return dict((acct, fairshare.get(acct, 0.0)) for acct in user_accts)
+
+
+def get_targets(accounts, user_accts, fairshare):
+    """Determine how many priority jobs each account should have, in proportion to its fairshare.
+
+    Positional arguments:
+    accounts - dictionary with key = account_name, val = dict of jobs (squeue output)
+    user_accts - list of slurm accounts to use in balancing
+    fairshare - dict with key = account, val = FairShare
+
+    Returns:
+    targets - dict with key = account, val = number of jobs (sums to number of jobs in accounts)
+    """
+    total = sum(len(jobs) for jobs in accounts.values())
+    weights = dict((acct, max(fairshare[acct], 0)) for acct in user_accts)
+    if sum(weights.values()) == 0:
+        weights = dict((acct, 1) for acct in user_accts)
+    exact = dict((acct, total * weight / sum(weights.values())) for acct, weight in weights.items())
+    targets = dict((acct, math.floor(num)) for acct, num in exact.items())
+    # give the jobs lost to rounding down to the accounts that lost the most
+    leftover = total - sum(targets.values())
+    for acct in sorted(user_accts, key=lambda acct: exact[acct] - targets[acct], reverse=True)[:leftover]:
+        targets[acct] += 1
+    return targets
+
+
+def plan_moves(accounts, user_accts, targets):
+    """Determine which jobs to move so that each account has its target number of jobs.
+
+    Accounts with more than their target give up their newest jobs (hopefully old will schedule),
+    accounts furthest below their target are given jobs first.
+
+    Returns:
+    moves - dict with key = account, val = list of jobids to move to account
+    """
+    moveable = []
+    for account in user_accts:
+        pids = list(accounts.get(account, {}).keys())
+        if len(pids) > targets[account]:
+            moveable.extend(pids[targets[account]:])
+    moves = defaultdict(list)
+    for account in sorted(user_accts, key=lambda acct: targets[acct] - len(accounts.get(acct, {})), reverse=True):
+        need = targets[account] - len(accounts.get(account, {}))
+        while need > 0 and len(moveable) > 0:
+            moves[account].append(moveable.pop())
+            need -= 1
+    return moves
+
+
+def redistribute_by_fairshare(accounts, user_accts, parentdir=None, dryrun=False):
+    """Redistribute priority jobs among user_accts in proportion to each account's fairshare.
+
+    Positional arguments:
+    accounts - dict: key = account, value = dict with key = pid, value = squeue output
+    user_accts - list of all available slurm accounts
+
+    Keyword arguments:
+    parentdir - used to cache fairshare (see get_fairshare)
+    dryrun - if True, print the plan without moving any jobs
+
+    Returns:
+    summary - dict of moved and failed jobs per account (see move_jobs), with planned moves if dryrun
+    """
+    fairshare = get_fairshare(user_accts, parentdir)
+    targets = get_targets(accounts, user_accts, fairshare)
+    moves = plan_moves(accounts, user_accts, targets)
+    print('\tfairshare plan%s:' % (' (dry run, no jobs will be moved)' if dryrun is True else ''))
+    print('\t\t%-20s %10s %8s %8s %8s' % ('account', 'fairshare', 'jobs', 'target', 'change'))
+    for acct in user_accts:
+        njobs = len(accounts.get(acct, {}))
+        print('\t\t%-20s %10.4f %8s %8s %+8d' % (acct, fairshare[acct], njobs, targets[acct], targets[acct] - njobs))
+    if dryrun is True:
+        return {'moved': moves, 'failed': defaultdict(list), 'calls': 0}
+    summary = move_jobs(moves)
+    for taker in moves:
+        print('\t%s has taken %s jobs' % (taker, len(summary['moved'][taker])))
+        if len(summary['failed'][taker]) > 0:
+            print('\t\tcould not move %s jobs to %s: %s' % (len(summary['failed'][taker]),
+                                                           taker,
+                                                           ','.join(summary['failed'][taker])))
+    return summary
+
+
 def choose_accounts(accts):
     print(Bcolors.BOLD + '\nDetermining which slurm accounts are available for use by balance_queue.py' + Bcolors.ENDC)
     if len(accts) > 1:
@@ -246,11 +452,7 @@ def get_avail_accounts(parentdir=None, save=False):
             return pklload(pkl)
 
     # get a list of all available accounts
-    acctout = subprocess.check_output([shutil.which('sshare'),
-                                       '-U',
-                                       '--user',
-                                       os.environ['USER'],
-                                       '--format=Account']).decode('utf-8').split('\n')
+    acctout = get_executor().sshare()
     accts = [acct.split()[0].split("_")[0] for acct in acctout if '_cpu' in acct]
     
     # for running outside of the pipeline:
@@ -272,13 +474,54 @@ def get_avail_accounts(parentdir=None, save=False):
     return accts
 
 
-def redistribute_jobs(accts, user_accts, balance):
+def assign_jobs(loads, moveable, balance, seed=None):
+    """Give each moveable job to the account with the fewest jobs, until accounts reach balance.
+
+    Accounts are kept in a heap by number of jobs, so assigning n jobs among a accounts takes
+    O(n log a). Jobs are given out from the end of moveable. Ties between accounts with the
+    same number of jobs are broken in a random order, which is the same for the same seed.
+
+    Positional arguments:
+    loads - dict with key = account that can take jobs, val = number of jobs it has now
+    moveable - list of jobids to give away
+    balance - int; max number of jobs any account is given up to
+
+    Keyword arguments:
+    seed - seed for the order of tied accounts (random if None)
+
+    Returns:
+    moves - dict with key = account, val = list of jobids to move to account
+    leftover - list of jobids that no account had room for (these stay where they are)
+    """
+    order = sorted(loads.keys())
+    Random(seed).shuffle(order)
+    heap = [(loads[account], i, account) for i, account in enumerate(order)]
+    heapq.heapify(heap)
+    moves = {}
+    moveable = list(moveable)
+    while len(moveable) > 0 and len(heap) > 0:
+        load, i, account = heapq.heappop(heap)
+        if load >= balance:
+            # the account with the fewest jobs is full, so all accounts are
+            break
+        moves.setdefault(account, []).append(moveable.pop())
+        heapq.heappush(heap, (load + 1, i, account))
+    return moves, moveable
+
+
+def redistribute_jobs(accts, user_accts, balance, seed=None):
     """Redistribute priority jobs to other accounts without high priority.
     
     Positional arguments:
     accts - dict: key = account, value = dict with key = pid, value = squeue output
     user_accts - list of all available slurm accounts
     balance  - int; ceiling number of jobs each account should have after balancing
+
+    Keyword arguments:
+    seed - seed used to break ties between takers (see assign_jobs)
+
+    Returns:
+    summary - dict of moved and failed jobs per account (see move_jobs)
     """
 
     # which jobs can be moved, which accounts need jobs?
@@ -301,36 +544,123 @@ def redistribute_jobs(accts, user_accts, balance):
                 # if numjobs and balance == 1 but not all accounts have low priority, give up the job
                 moveable.append(pids[0])
 
-    # shuffle list(takers) to avoid passing only to accounts that appear early in the list
-    shuffle(takers)
-    # redistribute jobs
-    taken = Counter()
-    while len(moveable) > 0:
-        for taker in takers:
-            # determine numtotake
-            if taker not in accts:
-                pids = []
-            else:
-                pids = accts[taker].keys()
-            numtotake = balance - len(pids)
-            if balance == 1 and len(pids) == 1:
-                numtotake = 1
-            # give numtotake to taker
-            for pid in moveable[-numtotake:]:
-                adjustjob(taker, pid)
-                taken[taker] += 1  # needs to be above .remove because of while()
-                moveable.remove(pid)
-    for taker,count in taken.items():
-        print('\t%s has taken %s jobs' % (taker, count))
-
-
-def main(thisfile, keyword, parentdir):
+    # redistribute jobs, ties are broken randomly to avoid passing only to accounts early in the list
+    moves, leftover = assign_jobs(dict((taker, len(accts.get(taker, {}))) for taker in takers),
+                                  moveable,
+                                  balance,
+                                  seed)
+    if len(leftover) > 0:
+        print('\tno account has room for %s jobs, leaving them as-is' % len(leftover))
+    summary = move_jobs(moves)
+    for taker in moves:
+        print('\t%s has taken %s jobs' % (taker, len(summary['moved'][taker])))
+        if len(summary['failed'][taker]) > 0:
+            print('\t\tcould not move %s jobs to %s: %s' % (len(summary['failed'][taker]),
+                                                           taker,
+                                                           ','.join(summary['failed'][taker])))
+    return summary
+
+
+def daemon_running():
+    """Determine if the user has a balance_queue.py daemon that has checked in recently."""
+    if not op.exists(DAEMON_LOCK):
+        return False
+    try:
+        pid, host, interval = open(DAEMON_LOCK).read().split()
+    except ValueError:
+        # the daemon is writing the file
+        return True
+    # allow the daemon to miss one check-in while slurm is slow
+    return time.time() - op.getmtime(DAEMON_LOCK) < 2 * float(interval) + 60
+
+
+def balance_stages(sq, user_accts, mode='even', parentdir=None):
+    """Balance the priority jobs of each pipeline stage among user_accts.
+
+    Positional arguments:
+    sq - list of tuples, each the str.split() of a line of squeue output for pending jobs
+    user_accts - list of slurm accounts to use in balancing
+
+    Keyword arguments:
+    mode - 'even' or 'fairshare' (see get_balance_mode)
+    parentdir - used to cache fairshare (see get_fairshare)
+    """
+    remaining = grepsq(sq, [], 'Priority')
+    for stage in STAGES:
+        stagesq = grepsq(remaining, [stage])
+        stagepids = set(q.jobid for q in stagesq)
+        remaining = [q for q in remaining if q.jobid not in stagepids]
+        if len(stagesq) == 0:
+            continue
+        print('%s jobs:' % stage)
+        if mode == 'fairshare':
+            accts = getaccounts(stagesq, mode, user_accts)
+            announceacctlens(accts, False)
+            summary = redistribute_by_fairshare(accts, user_accts, parentdir)
+        elif len(set(q.account.split("_")[0] for q in stagesq) & set(user_accts)) == len(user_accts):
+            print('\tall accounts have low priority, leaving queue as-is')
+            continue
+        else:
+            accts = getaccounts(stagesq, stage, user_accts)
+            announceacctlens(accts, False)
+            summary = redistribute_jobs(accts, user_accts, getbalance(accts, len(user_accts)))
+        announceacctlens(apply_moves(accts, summary), True)
+
+
+def daemon(parentdir=None, interval=300):
+    """Balance all pipeline stages every interval seconds until killed.
+
+    A lock file in $HOME lets stage scripts know they don't need to balance the queue.
+    """
+    if daemon_running():
+        print('a balance_queue.py daemon is already running (see %s), exiting' % DAEMON_LOCK)
+        exit()
+    globals().update({'thisfile': 'balance_queue.py daemon'})
+    user_accts = get_avail_accounts(parentdir)
+    mode = get_balance_mode(parentdir)
+    if len(user_accts) == 1:
+        print('\tthere is only one account (%s), no more accounts to balance queue.' % user_accts[0])
+        exit()
+    with open(DAEMON_LOCK, 'w') as o:
+        o.write('%s %s %s' % (os.getpid(), socket.gethostname(), interval))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())  # so that kill removes the lock file
+    print('balancing %s among %s every %s seconds, logging to %s' % (STAGES, user_accts, interval, DAEMON_LOG))
+    try:
+        while True:
+            os.utime(DAEMON_LOCK)  # check in
+            with open(DAEMON_LOG, 'a') as o, redirect_stdout(o):
+                print('\n%s' % time.strftime('%Y-%m-%d %H:%M:%S'))
+                try:
+                    sq = [parsesq(q) for q in checksq([q for q in get_executor().squeue(['pending'], delimited=True)
+                                                       if q != ''])]
+                    balance_stages(sq, user_accts, mode, parentdir)
+                except SystemExit:
+                    # checksq() exits when slurm gives bad output, try again next time
+                    print('skipping this round')
+                except Exception:
+                    # eg squeue/scontrol timed out - keep the daemon (and its lock) for the next round
+                    traceback.print_exc(file=sys.stdout)
+                    print('skipping this round')
+            time.sleep(interval)
+    finally:
+        os.remove(DAEMON_LOCK)
+
+
+def main(thisfile, keyword, parentdir, dryrun=False):
     globals().update({'thisfile': thisfile, 'keyword': keyword})
 
     print(Bcolors.BOLD + '\nStarting balance_queue.py' + Bcolors.ENDC)
+    # leave balancing to the daemon if one is running
+    if parentdir not in [None, 'choose'] and daemon_running() and dryrun is False:
+        print('\ta balance_queue.py daemon is running, exiting balance_queue.py')
+        exit()
+
     # get accounts available for billing
     user_accts = get_avail_accounts(parentdir)
 
+    # balance evenly, or by fairshare (always by fairshare if planning)
+    mode = 'fairshare' if dryrun is True else get_balance_mode(parentdir)
+
     # if only one account, skip balancing
     if len(user_accts) == 1:
         print('\tthere is only one account (%s), no more accounts to balance queue.' % user_accts[0])
@@ -338,27 +668,35 @@ def main(thisfile, keyword, parentdir):
         exit()
 
     # get priority jobs from the queue
-    sq = getsq(grepping=[keyword, 'Priority'], balancing=True)
+    sq = getsq(grepping=[] if keyword == os.environ['USER'] else [keyword], reason='Priority', balancing=True)
 
     # get per-account lists of jobs in Priority pending status, exit if all accounts have low priority
-    accts = getaccounts(sq, '', user_accts)
+    accts = getaccounts(sq, mode if mode == 'fairshare' else '', user_accts)
     announceacctlens(accts, False)  # TODO: announce all accounts, not just accts with priority jobs
 
-    # determine number of jobs to redistribute to each account
-    balance = getbalance(accts, len(user_accts))
+    if mode == 'fairshare':
+        # determine how many jobs each account should have, and redistribute
+        summary = redistribute_by_fairshare(accts, user_accts, parentdir, dryrun)
+    else:
+        # determine number of jobs to redistribute to each account
+        balance = getbalance(accts, len(user_accts))
 
-    # redistribute
-    redistribute_jobs(accts, user_accts, balance)
+        # redistribute
+        summary = redistribute_jobs(accts, user_accts, balance)
 
-    # announce final job counts
-    announceacctlens(getaccounts(getsq(grepping=[keyword, 'Priority'], balancing=True),
-                                 'final',
-                                 user_accts),
-                     True)
+    # announce final job counts (as planned, if dryrun)
+    announceacctlens(apply_moves(accts, summary), True)
 
 
 if __name__ == '__main__':
     # args
+    if len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        daemon(*[arg if i == 0 else int(arg) for i, arg in enumerate(sys.argv[2:])])
+        exit()
+    if len(sys.argv) > 2 and sys.argv[1] == 'plan':
+        thisfile, plan, keyword, *parentdir = sys.argv
+        main(thisfile, keyword, parentdir[0] if len(parentdir) > 0 else None, dryrun=True)
+        exit()
     if len(sys.argv) == 1:
         # so I can run from command line and balance full queue
         thisfile = sys.argv[0]
@@ -0,0 +1,138 @@
+"""Get read counts from bamfile indexes without decompressing any reads.
+
+### purpose
+# read contig names and lengths from the header of a bamfile, and the number of
+# mapped/unmapped reads per contig from its .bai index - the same numbers that
+# `samtools idxstats` reports
+###
+
+### usage
+# from bamstats import idxstats
+# stats = idxstats('/path/to/file.bam')  # [(contig, length, mapped, unmapped), ...]
+# total = count_records('/path/to/file.bam')  # same as `samtools view -c`, None if the index can't say
+###
+
+### assumes
+# that the bamfile is coordinate sorted and indexed (samtools index -> file.bam.bai,
+#    picard BuildBamIndex or gatk -> file.bai)
+# mapped/unmapped counts are None for contigs with reads whose index has no metadata pseudo-bin
+###
+"""
+
+import gzip, struct
+from os import path as op
+
+PSEUDO_BIN = 37450  # bin number the index uses to store per-contig read counts
+
+
+def find_index(bamfile):
+    """Find the .bai index for bamfile, return None if there isn't one."""
+    for bai in [bamfile + '.bai', op.splitext(bamfile)[0] + '.bai']:
+        if op.exists(bai):
+            return bai
+    return None
+
+
+def readbytes(o, size):
+    """Read exactly size bytes from an open file, or raise an error."""
+    data = o.read(size)
+    if len(data) != size:
+        raise EOFError('truncated file: %s' % o.name)
+    return data
+
+
+def read_references(bamfile):
+    """Get contig names and lengths from the header of a bamfile.
+
+    Only the start of the bgzf stream is decompressed.
+
+    Returns:
+    refs - list of tuples (contig, length) in the order of the bamfile header
+    """
+    with gzip.open(bamfile, 'rb') as o:
+        magic, l_text = struct.unpack('<4si', readbytes(o, 8))
+        if magic != b'BAM\x01':
+            raise ValueError('%s is not a bamfile' % bamfile)
+        readbytes(o, l_text)  # skip the SAM text header
+        n_ref = struct.unpack('<i', readbytes(o, 4))[0]
+        refs = []
+        for i in range(n_ref):
+            l_name = struct.unpack('<i', readbytes(o, 4))[0]
+            name = readbytes(o, l_name)[:-1].decode('utf-8')  # drop NUL
+            l_ref = struct.unpack('<i', readbytes(o, 4))[0]
+            refs.append((name, l_ref))
+    return refs
+
+
+def read_index(baifile):
+    """Get the number of mapped and unmapped reads on each contig from a .bai file.
+
+    Returns:
+    counts - list of tuples (mapped, unmapped) in the order of the bamfile header
+    n_no_coor - number of unplaced, unmapped reads
+    """
+    with open(baifile, 'rb') as o:
+        data = o.read()
+    if data[:4] != b'BAI\x01':
+        raise ValueError('%s is not a bam index' % baifile)
+    n_ref = struct.unpack_from('<i', data, 4)[0]
+    offset = 8
+    counts = []
+    for i in range(n_ref):
+        n_bin = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        # contigs without any reads have no bins (samtools idxstats reports 0 for them)
+        mapped, unmapped = (None, None) if n_bin > 0 else (0, 0)
+        for j in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            if bin_id == PSEUDO_BIN:
+                # first chunk is the file span of the contig, second chunk holds the counts
+                mapped, unmapped = struct.unpack_from('<QQ', data, offset + 16)
+            offset += 16 * n_chunk
+        n_intv = struct.unpack_from('<i', data, offset)[0]
+        offset += 4 + 8 * n_intv
+        counts.append((mapped, unmapped))
+    n_no_coor = struct.unpack_from('<Q', data, offset)[0] if len(data) >= offset + 8 else 0
+    return counts, n_no_coor
+
+
+def idxstats(bamfile, baifile=None):
+    """Get per-contig read counts for bamfile, in the same layout as `samtools idxstats`.
+
+    Positional arguments:
+    bamfile - path to a coordinate sorted, indexed bamfile
+
+    Keyword arguments:
+    baifile - path to the index of bamfile; found with find_index() if None
+
+    Returns:
+    stats - list of tuples (contig, length, mapped, unmapped), the last tuple is
+            ('*', 0, 0, number of unplaced unmapped reads)
+    """
+    if baifile is None:
+        baifile = find_index(bamfile)
+        if baifile is None:
+            raise FileNotFoundError('could not find an index for %s' % bamfile)
+    refs = read_references(bamfile)
+    counts, n_no_coor = read_index(baifile)
+    if len(refs) != len(counts):
+        raise ValueError('%s and %s do not have the same number of contigs' % (bamfile, baifile))
+    stats = [(contig, length, mapped, unmapped) for (contig, length), (mapped, unmapped) in zip(refs, counts)]
+    stats.append(('*', 0, 0, n_no_coor))
+    return stats
+
+
+def count_records(bamfile):
+    """Count all records in bamfile (the same number as `samtools view -c`) from its index.
+
+    Returns None if there is no index, the index is older than bamfile, or the index does
+    not have counts for every contig - ie whenever the count would not be exact.
+    """
+    baifile = find_index(bamfile)
+    if baifile is None or op.getmtime(baifile) < op.getmtime(bamfile):
+        return None
+    counts, n_no_coor = read_index(baifile)
+    if any(mapped is None for mapped, unmapped in counts):
+        return None
+    return sum(mapped + unmapped for mapped, unmapped in counts) + n_no_coor
@@ -0,0 +1,180 @@
+"""Measure the pipeline's scheduling code against a fake slurm controller.
+
+### purpose
+# simulate the indelRealign jobs of a pool finishing at about the same time, each running
+#    the tail of its .sh file (start_varscan.py, then balance_queue.py) against mock_slurm.py
+# while the jobs finish, other pools have Priority-pending varscan jobs on one account
+#    so that balance_queue.py has work to do
+# report:
+#    - the number of calls to each slurm command (sbatch, squeue, sshare, seff, scontrol)
+#    - the wall time spent in the tail scripts (time.sleep() is scaled by timescale)
+#    - how many times varscan was started for the pool (should be exactly once)
+###
+
+### usage
+# python benchmark_scheduling.py [numjobs] [concurrency] [numbeds] [numaccounts] [timescale]
+# defaults: 1000 jobs, 100 finishing at the same time, 50 bedfiles, 3 accounts, timescale 0.01
+###
+
+### assumes
+# files are created in a temporary directory, which is removed unless $KEEP_BENCHMARK is set
+###
+"""
+
+import os, sys, io, time, random, shutil, tempfile, subprocess
+from os import path as op
+from collections import Counter
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from coadaptree import makedir, pkldump, Bcolors
+from mock_slurm import MockSlurm, install
+
+POOL = 'benchpool'
+SQUEUE_FORMAT = "%.8i %.8u %.15a %.68j %.3t %16S %.10L %.5D %.4C %.6b %.7m %N (%r)"
+
+
+def make_parentdir(tmpdir, numjobs, numbeds, accounts):
+    """Create the files start_varscan.py and balance_queue.py expect in parentdir."""
+    parentdir = makedir(op.join(tmpdir, 'parentdir'))
+    pooldir = makedir(op.join(parentdir, POOL))
+    samps = ['samp%06d' % i for i in range(numjobs)]
+    # reference and its bedfiles
+    refdir = makedir(op.join(tmpdir, 'ref'))
+    ref = op.join(refdir, 'bench_ref.fasta')
+    open(ref, 'w').close()
+    beddir = makedir(op.join(refdir, 'bedfiles_bench_ref'))
+    for num in range(numbeds):
+        with open(op.join(beddir, 'bench_ref_bedfile_%s.bed' % str(num).zfill(4)), 'w') as o:
+            o.write('contig%s\t0\t1000\n' % num)
+    # pipeline pkls
+    pkldump({POOL: ref}, op.join(parentdir, 'poolref.pkl'))
+    pkldump({POOL: samps}, op.join(parentdir, 'poolsamps.pkl'))
+    pkldump({POOL: dict((samp, 2) for samp in samps)}, op.join(parentdir, 'ploidy.pkl'))
+    pkldump(accounts, op.join(parentdir, 'accounts.pkl'))
+    open(op.join(parentdir, 'bash_variables'), 'w').close()
+    makedir(op.join(pooldir, '04_realign'))
+    makedir(op.join(pooldir, 'shfiles/05_indelRealign_shfiles'))
+    return parentdir, pooldir, samps
+
+
+def write_sh(shfile, jobname):
+    with open(shfile, 'w') as o:
+        o.write('''#!/bin/bash
+#SBATCH --job-name=%s
+#SBATCH --time=02:00:00
+#SBATCH --mem=8000M
+#SBATCH --cpus-per-task=1
+#SBATCH --output=%s_%%j.out
+''' % (jobname, jobname))
+    return shfile
+
+
+def fill_queue(mock, parentdir, pooldir, samps, numpending, account):
+    """Submit a running indelRealign job for each samp, and numpending Priority jobs on account.
+
+    Returns:
+    pids - list of indelRealign job ids
+    """
+    shdir = op.join(pooldir, 'shfiles/05_indelRealign_shfiles')
+    pids = []
+    with redirect_stdout(io.StringIO()):
+        for samp in samps:
+            jobname = '%s-%s-indelRealign' % (POOL, samp)
+            pid = mock.submit(write_sh(op.join(shdir, '%s.sh' % jobname), jobname), account=account)
+            mock.set_state(pid, 'R')
+            open(op.join(shdir, '%s_%s.out' % (jobname, pid)), 'w').close()
+            open(op.join(pooldir, '04_realign/%s_realigned_reads.bai' % samp), 'w').close()
+            pids.append(pid)
+        otherdir = makedir(op.join(parentdir, 'otherpool/shfiles/varscan'))
+        for num in range(numpending):
+            jobname = 'otherpool-varscan_bedfile_%s' % str(num).zfill(4)
+            mock.submit(write_sh(op.join(otherdir, '%s.sh' % jobname), jobname), account=account)
+    return pids
+
+
+def run_tails(mock, env, pid, parentdir, logdir):
+    """Run the tail of job pid's .sh file, then mark the job as completed.
+
+    Returns:
+    elapsed - seconds spent in the tail scripts
+    """
+    env = dict(env, SLURM_JOB_ID=pid)
+    mockfile = op.join(op.dirname(op.abspath(__file__)), 'mock_slurm.py')
+    pipedir = op.dirname(op.abspath(__file__))
+    start = time.time()
+    with open(op.join(logdir, '%s.log' % pid), 'w') as o:
+        for args in [['start_varscan.py', parentdir, POOL], ['balance_queue.py', 'bedfile', parentdir]]:
+            subprocess.call([sys.executable, mockfile, 'tail', op.join(pipedir, args[0])] + args[1:],
+                            env=env, stdout=o, stderr=subprocess.STDOUT, cwd=logdir)
+    elapsed = time.time() - start
+    mock.set_state(pid, 'CD', exit_code=0)
+    return elapsed
+
+
+def report(mock, elapsed, wall, timescale):
+    """Print controller call counts, time spent in tails, and varscan launches for the pool."""
+    calls = Counter(line.split('\t')[0] for line in open(op.join(mock.spooldir, 'calls.log')))
+    jobs = mock.jobs()
+    names = Counter(job['name'] for job in jobs if job['name'].startswith('%s-varscan_bedfile' % POOL))
+    combines = [job for job in jobs if job['name'] == '%s-combine-varscan' % POOL]
+    accounts = Counter(job['account'] for job in jobs if job['name'].startswith('otherpool'))
+    elapsed = sorted(elapsed)
+    print(Bcolors.BOLD + '\nslurm controller calls' + Bcolors.ENDC)
+    for cmd in ['sbatch', 'squeue', 'sshare', 'seff', 'scontrol']:
+        print('\t%-8s %s' % (cmd, calls[cmd]))
+    print('\t%-8s %s' % ('total', sum(calls.values())))
+    print(Bcolors.BOLD + '\ntime in tail scripts (time.sleep scaled by %s)' % timescale + Bcolors.ENDC)
+    print('\ttotal %.1fs, mean %.2fs, median %.2fs, max %.2fs, wall clock %.1fs'
+          % (sum(elapsed), sum(elapsed) / len(elapsed), elapsed[len(elapsed) // 2], elapsed[-1], wall))
+    print(Bcolors.BOLD + '\nvarscan launches for %s' % POOL + Bcolors.ENDC)
+    print('\tcombine jobs submitted: %s (expected 1)' % len(combines))
+    print('\tvarscan bedfile jobs submitted: %s, distinct: %s, duplicates: %s'
+          % (sum(names.values()), len(names), sum(count - 1 for count in names.values())))
+    if len(combines) != 1:
+        print(Bcolors.WARNING + '\tvarscan was started %s times' % len(combines) + Bcolors.ENDC)
+    print(Bcolors.BOLD + '\npending jobs per account after balancing' + Bcolors.ENDC)
+    for account, count in sorted(accounts.items()):
+        print('\t%s %s' % (account, count))
+
+
+def main(numjobs=1000, concurrency=100, numbeds=50, numaccounts=3, timescale=0.01):
+    tmpdir = tempfile.mkdtemp(prefix='benchmark_scheduling_')
+    try:
+        accounts = ['def-bench%s' % i for i in range(numaccounts)]
+        statedir = makedir(op.join(tmpdir, 'slurm'))
+        mock = MockSlurm(statedir)
+        mock.set_accounts(accounts)
+        bindir = install(op.join(tmpdir, 'bin'))
+        env = dict(os.environ,
+                   PATH=bindir + os.pathsep + os.environ['PATH'],
+                   MOCK_SLURM_STATE=statedir,
+                   MOCK_SLURM_TIMESCALE=str(timescale),
+                   PIPELINE_EXECUTOR='slurm',
+                   SQUEUE_FORMAT=SQUEUE_FORMAT,
+                   USER=os.environ.get('USER', 'benchuser'))
+        os.environ['USER'] = env['USER']
+
+        print('creating %s jobs in %s' % (numjobs, tmpdir))
+        parentdir, pooldir, samps = make_parentdir(tmpdir, numjobs, numbeds, accounts)
+        pids = fill_queue(mock, parentdir, pooldir, samps, numjobs // 2, accounts[0])
+
+        # finish jobs in random order, concurrency at a time
+        random.seed(0)
+        random.shuffle(pids)
+        logdir = makedir(op.join(tmpdir, 'logs'))
+        print('finishing jobs, %s at a time' % concurrency)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            elapsed = list(pool.map(lambda pid: run_tails(mock, env, pid, parentdir, logdir), pids))
+        report(mock, elapsed, time.time() - start, timescale)
+    finally:
+        if 'KEEP_BENCHMARK' in os.environ:
+            print('\nbenchmark files are in %s' % tmpdir)
+        else:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    # args
+    thisfile, *args = sys.argv
+    main(*[float(arg) if i == 4 else int(arg) for i, arg in enumerate(args)])
@@ -25,6 +25,18 @@ def pklload(path):
     return pkl
 
 
+def get_start_opt(parentdir, opt, default=None):
+    """Get an option the user chose when running 00_start-pipeline.py.
+
+    Options added to the pipeline after a run was started will not be in
+    pipeline_start_command.pkl, in which case default is returned.
+    """
+    pkl = op.join(parentdir, 'pipeline_start_command.pkl')
+    if not op.exists(pkl):
+        return default
+    return getattr(pklload(pkl), opt, default)
+
+
 def get_email_info(parentdir, stage):
     pkl = op.join(parentdir, 'email_opts.pkl')
     if op.exists(pkl):
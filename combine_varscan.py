@@ -20,7 +20,8 @@ See start_varscan.py::create_combine()
 
 import sys, pandas as pd
 from os import path as op
-from coadaptree import fs, pklload
+from coadaptree import fs
+from create_bedfiles import get_beddir
 from filter_VariantsToTable import main as filtvtt
 from start_varscan import getfiles
 
@@ -36,9 +37,7 @@ def checkjobs():
     print('checking jobs')
     parentdir = op.dirname(pooldir)
     pool = op.basename(pooldir)
-    ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
-    samps = fs(op.join(op.dirname(ref),
-                       'bedfiles_%s' % op.basename(ref).split(".fa")[0]))
+    samps = [f for f in fs(get_beddir(parentdir, pool)) if f.endswith('.bed')]
     shdir = op.join(pooldir, 'shfiles/varscan')
     # files = {f.sh: f.out, ...}
     files = getfiles(samps, shdir, f"{grep}-{program}")
@@ -0,0 +1,176 @@
+"""Summarize the coverage of a sorted bamfile in a small binary file, and read it back.
+
+### purpose
+# replace the `bedtools bamtobed` .coord files of 02_bwa (a line of text for every read, often
+#    larger than the bamfile) with the number of reads that start in, and the number of bases
+#    aligned to, each WINDOW bp window of each contig
+# reads the bamfile (or a stream of uncompressed bam from a fifo) once, from start to end
+# summaries are used for QC (`python covsummary.py show`) and to balance depth bedfiles
+#    (create_bedfiles.make_depth_bedfiles)
+###
+
+### usage
+# to summarize a bamfile (as run by 02_bwa):
+#    python covsummary.py /path/to/sorted.bam /path/to/sorted.bam.cov
+# to print reads and mean depth of each contig:
+#    python covsummary.py show /path/to/sorted.bam.cov
+# from python:
+#    from covsummary import read_summary, get_depths
+#    window, contigs = read_summary('/path/to/sorted.bam.cov')  # contigs = [(contig, length, reads, bases), ...]
+#    depths = get_depths(['/path/to/sorted.bam.cov', ...])  # {contig: reads}
+###
+
+### assumes
+# input is bgzf compressed (as bamfiles and `samtools view -u` output are, -u only skips compression)
+# unmapped reads are not counted, bases are the reference span of the alignment (M/D/N/=/X)
+# file layout (gzip compressed, little-endian):
+#    b'COV\x01', window (uint32), number of contigs (uint32), then for each contig in the order
+#    of the bam header: length of name (uint32), name (utf-8), contig length (uint32), number of
+#    windows (uint32), reads per window (uint32 each), bases per window (uint64 each)
+###
+"""
+
+import sys, gzip, struct
+from array import array
+from bamstats import readbytes
+
+MAGIC = b'COV\x01'
+WINDOW = 10000
+REF_OPS = {0, 2, 3, 7, 8}  # cigar operations that consume the reference (M, D, N, =, X)
+BUFSIZE = 1 << 20
+
+
+def read_header(o):
+    """Read the header of an open (decompressed) bam stream, return a list of (contig, length)."""
+    magic, l_text = struct.unpack('<4si', readbytes(o, 8))
+    if magic != b'BAM\x01':
+        raise ValueError('%s is not a bamfile' % o.name)
+    readbytes(o, l_text)
+    refs = []
+    for i in range(struct.unpack('<i', readbytes(o, 4))[0]):
+        l_name = struct.unpack('<i', readbytes(o, 4))[0]
+        name = readbytes(o, l_name)[:-1].decode('utf-8')
+        refs.append((name, struct.unpack('<i', readbytes(o, 4))[0]))
+    return refs
+
+
+def iter_alignments(o):
+    """Yield (contig index, start, end) of each mapped read in an open bam stream after its header.
+
+    Records are read from large blocks of the stream, so this works on fifos and pipes too.
+    """
+    buf, offset = b'', 0
+    while True:
+        block = o.read(BUFSIZE)
+        buf = buf[offset:] + block
+        offset = 0
+        while offset + 4 <= len(buf):
+            block_size = struct.unpack_from('<i', buf, offset)[0]
+            if offset + 4 + block_size > len(buf):
+                break
+            refid, pos, l_read_name, mapq, bin_, n_cigar, flag = struct.unpack_from('<iiBBHHH', buf, offset + 4)
+            if refid >= 0 and not flag & 4:
+                cigar = struct.unpack_from('<%dI' % n_cigar, buf, offset + 36 + l_read_name)
+                span = sum(op >> 4 for op in cigar if op & 0xf in REF_OPS)
+                yield refid, pos, pos + max(span, 1)
+            offset += 4 + block_size
+        if not block:
+            break
+
+
+def summarize(bamfile, window=WINDOW):
+    """Count reads starting in, and bases aligned to, each window of each contig in bamfile.
+
+    Returns:
+    contigs - list of (contig, length, reads, bases) in the order of the bam header, where reads
+              and bases are arrays with one value per window
+    """
+    with gzip.open(bamfile, 'rb') as o:
+        refs = read_header(o)
+        contigs = [(contig, length, array('I', [0]) * (length // window + 1), array('Q', [0]) * (length // window + 1))
+                   for contig, length in refs]
+        for refid, start, end in iter_alignments(o):
+            contig, length, reads, bases = contigs[refid]
+            end = min(end, length)
+            w = start // window
+            reads[w] += 1
+            while start < end:
+                stop = min(end, (w + 1) * window)
+                bases[w] += stop - start
+                start = stop
+                w += 1
+    return contigs
+
+
+def write_summary(contigs, covfile, window=WINDOW):
+    """Write the output of summarize() to covfile."""
+    with gzip.open(covfile, 'wb') as o:
+        o.write(MAGIC + struct.pack('<II', window, len(contigs)))
+        for contig, length, reads, bases in contigs:
+            name = contig.encode('utf-8')
+            o.write(struct.pack('<I', len(name)) + name + struct.pack('<II', length, len(reads)))
+            for counts in [reads, bases]:
+                if sys.byteorder == 'big':
+                    counts = array(counts.typecode, counts)
+                    counts.byteswap()
+                o.write(counts.tobytes())
+
+
+def read_summary(covfile):
+    """Read a coverage summary.
+
+    Returns:
+    window - size of windows in bp
+    contigs - list of (contig, length, reads, bases), where reads and bases are arrays with one
+              value per window
+    """
+    with gzip.open(covfile, 'rb') as o:
+        if readbytes(o, 4) != MAGIC:
+            raise ValueError('%s is not a coverage summary' % covfile)
+        window, n_ref = struct.unpack('<II', readbytes(o, 8))
+        contigs = []
+        for i in range(n_ref):
+            l_name = struct.unpack('<I', readbytes(o, 4))[0]
+            contig = readbytes(o, l_name).decode('utf-8')
+            length, n_win = struct.unpack('<II', readbytes(o, 8))
+            reads, bases = array('I'), array('Q')
+            reads.frombytes(readbytes(o, 4 * n_win))
+            bases.frombytes(readbytes(o, 8 * n_win))
+            if sys.byteorder == 'big':
+                reads.byteswap()
+                bases.byteswap()
+            contigs.append((contig, length, reads, bases))
+    return window, contigs
+
+
+def get_depths(covfiles):
+    """Sum the number of reads on each contig across coverage summaries.
+
+    Returns:
+    depths - dict with key = contig, val = number of reads
+    """
+    depths = {}
+    for covfile in covfiles:
+        window, contigs = read_summary(covfile)
+        for contig, length, reads, bases in contigs:
+            depths[contig] = depths.get(contig, 0) + sum(reads)
+    return depths
+
+
+def show(covfile):
+    """Print the number of reads and mean depth of each contig with reads."""
+    window, contigs = read_summary(covfile)
+    print('contig\tlength\treads\tmean_depth')
+    for contig, length, reads, bases in contigs:
+        if sum(reads) > 0:
+            print('%s\t%s\t%s\t%.2f' % (contig, length, sum(reads), sum(bases) / length if length > 0 else 0))
+
+
+if __name__ == '__main__':
+    # args
+    thisfile, *args = sys.argv
+    if args[0] == 'show':
+        show(args[1])
+    else:
+        bamfile, covfile = args
+        write_summary(summarize(bamfile), covfile)
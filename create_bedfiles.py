@@ -3,12 +3,34 @@
 ### purpose
 # create bedfiles from reference so that we can parallelize CRISP
 # if an intervals directory exists, use .list files to create bedfiles (for stitched refs)
-#    ELSE: look for .order file, and create bedfiles from this (for stitched refs)
-#    ELSE: look for a .length file (create from ref if none exists) - assumes non-stitched
+#    ELSE: look for .order file, and create bedfiles from this (for stitched refs) with ~equal
+#          base pairs (contig_length column) of whole stitched segments in each bedfile
+#    ELSE: use contig lengths from the ref.fa.fai index (or from a .length file if there is no
+#          .fai, creating one from ref if neither exists) - assumes non-stitched
+# if the pipeline was started with `--bedfile_mode balanced`, contigs from the .fai (or .length)
+#    file are split into pieces of at most 1/PIECES of a bedfile's share of base pairs and
+#    packed longest-first into the bedfile with the fewest base pairs (LPT bin packing), so that
+#    a large chromosome no longer becomes one bedfile (see partition_lpt()). These bedfiles
+#    are zero-based and half-open (varscan uses them with `samtools mpileup -l`), and a report
+#    of base pairs per bedfile is written to the bedfile directory
+# bedfiles made from the reference are cached in bedfiles_<ref>/<ref>_<key> next to ref, where
+#    key is a hash of the file the bedfiles are made from (eg ref.fa.fai), the bedfile mode,
+#    and the number of bedfiles. Runs reuse an existing cache entry (or write a new one to a
+#    temporary dir and rename it), and pin the entry they use in parentdir/beddirs.pkl and with a
+#    marker in the entry's pins dir. Entries that no run still pins or has used for CACHE_DAYS
+#    are removed (see prune_cache())
+# if the pipeline was started with `--bedfile_mode depth`, bedfiles are instead made for each
+#    pool once realignment has finished, so that each bedfile gets ~equal numbers of reads
+#    (see make_depth_bedfiles(), called from start_varscan.py)
+# if the pipeline was started with `--scatter_realign N`, the reference is also split into
+#    N .list files of whole contigs for RealignerTargetCreator (see make_interval_lists(),
+#    called from 04_realignTargetCreator.py)
 #
 
 ### usage
 # python create_bedfiles.py /path/to/reference.fasta
+# python create_bedfiles.py /path/to/reference.fasta balanced
+# python create_bedfiles.py depth /path/to/parentdir pool
 ###
 
 ### fix
@@ -19,9 +41,18 @@
 ###
 """
 
-import sys, os, math, pandas as pd
+import sys, os, math, time, shutil, hashlib, subprocess
 from os import path as op
-from coadaptree import fs, makedir, askforinput, Bcolors
+from array import array
+from bamstats import idxstats, read_references
+from covsummary import get_depths
+from heapq import heapify, heappush, heappop
+from coadaptree import fs, makedir, askforinput, Bcolors, pklload, pkldump, get_start_opt
+from executor import get_executor
+
+PIECES = 8  # with --bedfile_mode balanced, contigs are split into pieces of at most 1/PIECES of a bedfile's share
+MIN_PIECE = 10000  # ... but never into pieces shorter than this (bp)
+CACHE_DAYS = 60  # cached bedfiles that no run pins or has used for this many days are removed (see prune_cache())
 
 
 def openlenfile(lenfile):
@@ -37,10 +68,9 @@ def openlenfile(lenfile):
 
 
 def make_beddir():
-    """Create dir for bedfiles."""
+    """Get the dir that bedfiles are being written to (see main())."""
     bname = op.basename(ref).split(".fa")[0]
-    beddir = makedir(op.join(op.dirname(ref), 'bedfiles_%s' % bname))
-    return bname, beddir
+    return bname, globals()['beddir']
 
 
 def get_prereqs(num):
@@ -84,27 +114,52 @@ def make_bed_from_intervals(intdir):
     print('\t\tcreated %s bedfiles for %s from interval files' % (len(intfiles), ref))
 
 
+def read_orderfile(orderfile):
+    """Get stitched segments and their lengths from a ref.order file.
+
+    Returns:
+    segments - list of (ref_scaff, start_pos, stop_pos) in file order - one-based, inclusive
+    lengths - array of the contig_length of each segment (stop_pos - start_pos + 1 if missing)
+    """
+    segments, lengths = [], array('Q')
+    with open(orderfile, 'r') as o:
+        for line in o:
+            if line.strip() != '':
+                splits = line.rstrip("\n").split("\t")
+                start, stop = int(splits[2]), int(splits[3])
+                segments.append((splits[0], start, stop))
+                lengths.append(int(splits[4]) if len(splits) > 4 and splits[4] != '' else stop - start + 1)
+    return segments, lengths
+
+
 def make_beds_from_orderfile():
     """Use ref.order file to create bedfiles for parallelization.
     
-    Evenly distributes contigs across X number of files specified to calculate thresh.
+    Evenly distributes base pairs (the contig_length column) of the stitched segments across
+    jobs_per_pool files. Segments are kept whole - in file order (as for interval lists), or with
+    `--bedfile_mode balanced` packed longest first (see partition_lpt()).
     """
     orderfile = ref.replace(".fa", "") + '.order'
     print('\n\tCreating bedfiles from %s. Please confirm:\n\tAssuming .order file is of format:\n\t\tref_scaff<tab>contig_name<tab>start_pos<tab>stop_pos<tab>contig_length' % orderfile)
     askforinput(tab='\t', newline='')
-    with open(orderfile, 'r') as o:
-        text = o.read().split("\n")
-    thresh = math.ceil(len(text) / globals()['jobs_per_pool'])
-    lines = []
-    fcount = 0
-    for count, line in enumerate(text):
-        if not line == '':
-            splits = line.split("\t")
-            lines.append(([splits[0], int(splits[2]) - 1, int(splits[3]) - 1]))  # scaff start stop, zero-based
-        if len(lines) == thresh or (count + 1 == len(text)):
-            make_bedfile(lines, fcount, from_orderfile=True)
-            lines = []
-            fcount += 1
+    segments, lengths = read_orderfile(orderfile)
+    # partition segments by their index in the file, weighted by their length
+    items = list(enumerate(lengths))
+    if globals()['mode'] == 'balanced':
+        beds = partition_lpt(items, globals()['jobs_per_pool'], split=False)
+    else:
+        beds = partition_by_depth(items, dict(items), globals()['jobs_per_pool'], split=False)
+    for fcount, lines in enumerate(beds):
+        segs = [segments[i] for i, start, stop in lines]
+        if globals()['mode'] == 'balanced':
+            make_bed([(scaff, start - 1, stop) for scaff, start, stop in segs], fcount)  # zero-based, half-open
+        else:
+            make_bedfile([(scaff, start - 1, stop - 1) for scaff, start, stop in segs], fcount, from_orderfile=True)
+    if globals()['mode'] == 'balanced':
+        bname, beddir = make_beddir()
+        ratio = write_partition_report(beds, op.join(beddir, '%s_partition_report.txt' % bname))
+        print('\t\tmax/mean base pairs per bedfile = %.4f' % ratio)
+    print('\t\tcreated %s bedfiles for %s from %s' % (len(beds), ref, orderfile))
 
 
 def find_positions():
@@ -125,19 +180,25 @@ def find_positions():
     if op.exists(orderfile):
         make_beds_from_orderfile()
         return
-    # create ref.fa.length if it doesn't exist
-    if not op.exists('%(ref)s.length' % globals()):
-        print("\tcreating %s.length file (this will take a few minutes)" % op.basename(ref))
-        os.system('''cat  %(ref)s | awk '$0 ~ ">" {print c; c=0;printf substr($0,2,100) "\t"; } $0 !~ ">" {c+=length($0);} END { print c; }' | sed 1d >  %(ref)s.length''' % globals())
+    # use contig lengths from ref.fa.fai, or ref.fa.length (create it if neither exists)
+    if op.exists('%(ref)s.fai' % globals()):
+        names, lengths = read_fai(ref)
+        print("\tusing %s.fai for contig lengths\n\t\twhich has %s contigs" % (ref, len(names)))
     else:
-        text = openlenfile('%(ref)s.length' % globals())
-        print("\tref.length file already created for %s\n\t\twhich has %s contigs" % (ref, len(text)-1))
-    if not op.exists("%(ref)s.length" % globals()):
-        print("something went wrong with creating the ref.length file for %s\nexiting %s" % (ref, sys.argv[0]))
-        exit()
-
-    # spread contigs across 1000 bed files using the ref.fa.length file
-    fcount = make_bedfiles()
+        if not op.exists('%(ref)s.length' % globals()):
+            print("\tcreating %s.length file (this will take a few minutes)" % op.basename(ref))
+            os.system('''cat  %(ref)s | awk '$0 ~ ">" {print c; c=0;printf substr($0,2,100) "\t"; } $0 !~ ">" {c+=length($0);} END { print c; }' | sed 1d >  %(ref)s.length''' % globals())
+        if not op.exists("%(ref)s.length" % globals()):
+            print("something went wrong with creating the ref.length file for %s\nexiting %s" % (ref, sys.argv[0]))
+            exit()
+        names, lengths = read_lenfile('%(ref)s.length' % globals())
+        print("\tref.length file already created for %s\n\t\twhich has %s contigs" % (ref, len(names)))
+
+    # spread contigs across bed files using the contig lengths
+    if globals()['mode'] == 'balanced':
+        fcount = make_balanced_bedfiles(names, lengths)
+    else:
+        fcount = make_bedfiles(names, lengths)
 
     print('\t\tcreated %s bedfiles for %s' % (fcount, ref))
 
@@ -163,21 +224,23 @@ def make_bedfile(lines, fcount, from_orderfile=False):
         o.write("\n".join(text))
 
 
-def make_bedfiles():
-    """Use ref.fa.length file to create bedfiles.
+def make_bedfiles(names, lengths):
+    """Use contig lengths to create bedfiles.
     
     Evenly distributes base-pairs across X number of files specified to calculate thresh.
+
+    Positional arguments:
+    names - list of contig names in reference order
+    lengths - array of contig lengths in the same order as names
     """
-    df = pd.read_csv("%s.length" % ref, sep='\t', header=None)
-    thresh = math.ceil(sum(df[1]) / globals()['jobs_per_pool'])
+    thresh = math.ceil(sum(lengths) / globals()['jobs_per_pool'])
     lines = []
     fcount = 0
     fsum = 0
-    for count,row in enumerate(df.index):
-        contig, length = list(df.loc[row, :])
+    for count, (contig, length) in enumerate(zip(names, lengths)):
         fsum += length
         lines.append([contig, str(length)])
-        if fsum >= thresh or count + 1 == len(df.index):
+        if fsum >= thresh or count + 1 == len(names):
             make_bedfile(lines, fcount)
             lines = []
             fcount += 1
@@ -185,26 +248,478 @@ def make_bedfiles():
     return fcount
 
 
-def check_beddir():
-    """Avoid accidentally using incorrect bedfiles by removing any that exist."""
+def split_intervals(contigs, maxlen):
+    """Split contigs longer than maxlen into ~equal intervals of at most maxlen bp.
+
+    Positional arguments:
+    contigs - list of (contig, length)
+    maxlen - the longest interval
+
+    Returns:
+    intervals - list of (contig, start, stop) - zero-based, half-open
+    """
+    intervals = []
+    for contig, length in contigs:
+        pieces = max(1, math.ceil(length / maxlen))
+        for i in range(pieces):
+            intervals.append((contig, length * i // pieces, length * (i + 1) // pieces))
+    return intervals
+
+
+def partition_lpt(contigs, nbeds, pieces=PIECES, split=True):
+    """Spread base pairs across nbeds bedfiles with longest-processing-time-first bin packing.
+
+    Contigs are split so no interval is longer than 1/pieces of a bedfile's share (or MIN_PIECE), then each
+    interval (longest first) goes to the bedfile with the fewest base pairs so far. The largest
+    bedfile is then at most 1/pieces of a share larger than the mean.
+
+    Positional arguments:
+    contigs - list of (contig, length) in reference order
+    nbeds - the max number of bedfiles
+
+    Keyword arguments:
+    pieces - contigs are split into intervals of at most 1/pieces of a bedfile's share
+    split - if False, contigs are always kept whole
+
+    Returns:
+    beds - list of bedfiles, each a list of (contig, start, stop) in reference order -
+           zero-based, half-open
+    """
+    share = sum(length for contig, length in contigs) / nbeds
+    if split is True:
+        intervals = split_intervals(contigs, max(math.ceil(share / pieces), MIN_PIECE))
+    else:
+        intervals = [(contig, 0, length) for contig, length in contigs]
+    intervals.sort(key=lambda interval: interval[2] - interval[1], reverse=True)
+    beds = [[] for i in range(min(nbeds, len(intervals)))]
+    heap = [(0, i) for i in range(len(beds))]
+    heapify(heap)
+    for contig, start, stop in intervals:
+        load, i = heappop(heap)
+        beds[i].append((contig, start, stop))
+        heappush(heap, (load + stop - start, i))
+    order = dict((contig, i) for i, (contig, length) in enumerate(contigs))
+    return [sorted(lines, key=lambda line: (order[line[0]], line[1])) for lines in beds]
+
+
+def write_partition_report(beds, reportfile):
+    """Write the number of intervals and base pairs in each bedfile, and how even they are.
+
+    Returns:
+    ratio - base pairs of the largest bedfile / mean base pairs per bedfile
+    """
+    loads = [sum(stop - start for contig, start, stop in lines) for lines in beds]
+    mean = sum(loads) / len(loads)
+    ratio = max(loads) / mean if mean > 0 else 1
+    contigs = {}
+    for lines in beds:
+        for contig, start, stop in lines:
+            contigs[contig] = contigs.get(contig, 0) + 1
+    text = ['bedfiles\t%s' % len(beds),
+            'intervals\t%s' % sum(len(lines) for lines in beds),
+            'split_contigs\t%s' % sum(1 for count in contigs.values() if count > 1),
+            'total_bp\t%s' % sum(loads),
+            'mean_bp\t%.1f' % mean,
+            'min_bp\t%s' % min(loads),
+            'max_bp\t%s' % max(loads),
+            'max/mean\t%.4f' % ratio,
+            '',
+            'bedfile\tintervals\tbp']
+    text.extend(['%s\t%s\t%s' % (str(num).zfill(4), len(lines), load) for num, (lines, load) in enumerate(zip(beds, loads))])
+    with open(reportfile, 'w') as o:
+        o.write("\n".join(text) + "\n")
+    return ratio
+
+
+def make_balanced_bedfiles(names, lengths):
+    """Use contig lengths to create bedfiles with LPT bin packing of (split) contigs.
+
+    Positional arguments:
+    names - list of contig names in reference order
+    lengths - array of contig lengths in the same order as names
+    """
+    beds = partition_lpt(list(zip(names, lengths)), globals()['jobs_per_pool'])
+    for num, lines in enumerate(beds):
+        make_bed(lines, num)
     bname, beddir = make_beddir()
-    files = [f for f in fs(beddir) if f.endswith('.bed')]
-    if len(files) > 0:
-        text = '\tThere are already existing bedfiles in %s. These will be deleted.' % beddir
-        print(Bcolors.WARNING + text + Bcolors.ENDC)
-        askforinput(tab='\t', newline='')
-        for f in files:
+    reportfile = op.join(beddir, '%s_partition_report.txt' % bname)
+    ratio = write_partition_report(beds, reportfile)
+    print('\t\tmax/mean base pairs per bedfile = %.4f (see %s)' % (ratio, op.basename(reportfile)))
+    return len(beds)
+
+
+def get_cache_key(ref, mode, jobs_per_pool):
+    """Hash what find_positions() makes bedfiles for ref from, with mode and jobs_per_pool.
+
+    The source is the intervals .list files, the .order file, the .fai (or .length) file, or
+    if there is none of these (a .length file will be created), the size and mtime of ref.
+    """
+    h = hashlib.sha1(('%s\t%s\n' % (mode, jobs_per_pool)).encode('utf-8'))
+    intdir = op.join(op.dirname(ref), 'intervals')
+    orderfile = ref.replace(".fa", "") + '.order'
+    if op.exists(intdir):
+        sources = sorted(f for f in fs(intdir) if f.endswith('.list'))
+    elif op.exists(orderfile):
+        sources = [orderfile]
+    else:
+        sources = [f for f in ['%s.fai' % ref, '%s.length' % ref] if op.exists(f)][:1]
+    if len(sources) == 0:
+        h.update(('%s\t%s' % (op.getsize(ref), op.getmtime(ref))).encode('utf-8'))
+    for source in sources:
+        h.update(op.basename(source).encode('utf-8'))
+        with open(source, 'rb') as o:
+            for block in iter(lambda: o.read(1 << 20), b''):
+                h.update(block)
+    return h.hexdigest()[:12]
+
+
+def get_cache_dir(ref, mode, jobs_per_pool):
+    """Get the directory of cached bedfiles for ref, mode, and jobs_per_pool (it may not exist yet).
+
+    Cached bedfiles are kept next to ref in bedfiles_<ref>/<ref>_<key>, so projects that use
+    the same reference share them.
+    """
+    bname = op.basename(ref).split(".fa")[0]
+    return op.join(op.dirname(ref), 'bedfiles_%s' % bname, '%s_%s' % (bname, get_cache_key(ref, mode, jobs_per_pool)))
+
+
+def get_pinned(parentdir, ref):
+    """Get the bedfile directory pinned for ref by this run, None if there isn't one."""
+    pkl = op.join(parentdir, 'beddirs.pkl')
+    return pklload(pkl).get(ref, None) if op.exists(pkl) else None
+
+
+def get_pinfile(parentdir, beddir):
+    """Get the marker that records parentdir's use of the cached bedfiles in beddir."""
+    return op.join(beddir, 'pins', hashlib.sha1(op.abspath(parentdir).encode('utf-8')).hexdigest()[:12])
+
+
+def touch_pin(parentdir, beddir):
+    """Mark that the run in parentdir still uses the bedfiles in beddir (see prune_cache()).
+
+    Each run has its own marker in beddir/pins (which any user can write to), so runs of other
+    users can mark entries they did not create. Returns False if the marker could not be written.
+    """
+    pinfile = get_pinfile(parentdir, beddir)
+    try:
+        if not op.exists(op.dirname(pinfile)):
+            # like /tmp, any user can add a pin but not remove the pins of others
+            os.chmod(makedir(op.dirname(pinfile)), 0o1777)
+        with open(pinfile, 'w') as o:
+            o.write(op.abspath(parentdir))
+    except OSError as e:
+        print('\tcould not mark bedfiles in %s as in use: %s' % (beddir, e))
+        return False
+    return True
+
+
+def pin_beddir(parentdir, ref, beddir):
+    """Record that this run uses the bedfiles in beddir for ref (see get_beddir())."""
+    pkl = op.join(parentdir, 'beddirs.pkl')
+    beddirs = pklload(pkl) if op.exists(pkl) else {}
+    beddirs[ref] = beddir
+    pkldump(beddirs, pkl)
+    touch_pin(parentdir, beddir)
+
+
+def is_pin_live(pinfile, beddir, now):
+    """Determine if the run that wrote pinfile used beddir in the last CACHE_DAYS, or still pins it."""
+    if (now - op.getmtime(pinfile)) / 86400 <= CACHE_DAYS:
+        return True
+    try:
+        with open(pinfile, 'r') as o:
+            parentdir = o.read().strip()
+        pkl = op.join(parentdir, 'beddirs.pkl')
+        return op.exists(pkl) and beddir in pklload(pkl).values()
+    except Exception:
+        # can't tell (eg the beddirs.pkl of another user's run is not readable), so keep it
+        return True
+
+
+def prune_cache(ref, keep):
+    """Remove cached bedfiles for ref that no run uses, and temporary dirs older than a day (left
+    by runs that were killed while making bedfiles).
+
+    An entry is in use while any of its pins is live (see is_pin_live()). Entries without pins
+    (made outside of a run) are in use if they were made in the last CACHE_DAYS.
+
+    Positional arguments:
+    ref - path to reference
+    keep - cache entry that is never removed (the one this run uses)
+    """
+    now = time.time()
+    for d in fs(op.dirname(keep)):
+        if d == keep or not op.isdir(d):
+            continue
+        if d.endswith('.tmp'):
+            if (now - op.getmtime(d)) / 86400 <= 1:
+                continue
+        else:
+            pindir = op.join(d, 'pins')
+            pinfiles = fs(pindir) if op.isdir(pindir) else []
+            if len(pinfiles) > 0 and any(is_pin_live(pinfile, d, now) for pinfile in pinfiles):
+                continue
+            if len(pinfiles) == 0 and (now - op.getmtime(d)) / 86400 <= CACHE_DAYS:
+                continue
+        shutil.rmtree(d, ignore_errors=True)
+        if not op.exists(d):
+            print('\tremoved unused bedfiles for %s: %s' % (op.basename(ref), d))
+
+
+def get_beddir(parentdir, pool):
+    """Get the directory with the bedfiles that varscan uses for pool."""
+    if get_start_opt(parentdir, 'bedfile_mode', 'length') == 'depth':
+        return op.join(parentdir, pool, 'bedfiles_depth')
+    ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
+    beddir = get_pinned(parentdir, ref)
+    if beddir is not None:
+        if op.exists(beddir):
+            touch_pin(parentdir, beddir)  # still in use (see prune_cache())
+        return beddir
+    # runs started before bedfiles were cached
+    return op.join(op.dirname(ref), 'bedfiles_%s' % op.basename(ref).split(".fa")[0])
+
+
+def get_bam_depths(bamfiles):
+    """Sum the number of mapped reads on each contig across bamfiles using their .bai indexes.
+
+    Positional arguments:
+    bamfiles - list of paths to indexed bamfiles that were mapped to the same ref.fa
+
+    Returns:
+    depths - dict with key = contig, val = number of mapped reads; None if an index
+             does not have read counts
+    """
+    depths = {}
+    for bamfile in bamfiles:
+        for contig, length, mapped, unmapped in idxstats(bamfile):
+            if mapped is None:
+                return None
+            if contig != '*':
+                depths[contig] = depths.get(contig, 0) + mapped
+    return depths
+
+
+def get_coord_depths(coordfiles):
+    """Count the number of reads on each contig in the `bedtools bamtobed` files from 02_bwa.
+
+    Positional arguments:
+    coordfiles - list of paths to bamtobed output (one line per read, first column is contig)
+    """
+    depths = {}
+    for coordfile in coordfiles:
+        with open(coordfile, 'r') as o:
+            for line in o:
+                contig = line.split("\t", 1)[0]
+                depths[contig] = depths.get(contig, 0) + 1
+    return depths
+
+
+def partition_by_depth(contigs, depths, nbeds, split=True):
+    """Spread reads evenly across nbeds bedfiles, keeping contigs in reference order.
+
+    Contigs with more reads than a bedfile's share are split into intervals, assuming
+    reads are evenly spread within the contig. Other contigs are kept whole.
+
+    Positional arguments:
+    contigs - list of (contig, length) in reference order
+    depths - dict with key = contig, val = number of reads
+    nbeds - the max number of bedfiles the reads should be spread across
+
+    Keyword arguments:
+    split - if False, contigs are always kept whole (so a bedfile can have more than its share)
+
+    Returns:
+    beds - list of bedfiles, each a list of (contig, start, stop) - zero-based, half-open
+    """
+    thresh = max(sum(depths.get(contig, 0) for contig, length in contigs) / nbeds, 1)
+    beds = [[]]
+    fsum = 0
+    for contig, length in contigs:
+        depth = depths.get(contig, 0)
+        if depth <= thresh or split is False:
+            # close the bedfile first if adding this contig would overshoot more than it undershoots
+            if fsum > 0 and fsum + depth - thresh > thresh - fsum and len(beds) < nbeds:
+                beds.append([])
+                fsum = 0
+            beds[-1].append((contig, 0, length))
+            fsum += depth
+        else:
+            # cut the contig wherever the current bedfile reaches its share of reads
+            start = 0
+            while start < length:
+                stop = length
+                if len(beds) < nbeds:
+                    stop = min(start + max(math.ceil((thresh - fsum) * length / depth), 1), length)
+                beds[-1].append((contig, start, stop))
+                fsum += depth * (stop - start) / length
+                start = stop
+                if fsum >= thresh and len(beds) < nbeds:
+                    beds.append([])
+                    fsum = 0
+        if fsum >= thresh and len(beds) < nbeds:
+            beds.append([])
+            fsum = 0
+    return [lines for lines in beds if len(lines) > 0]
+
+
+def make_depth_bedfiles(parentdir, pool, bamfiles):
+    """Create bedfiles for pool that each have ~equal numbers of reads across bamfiles.
+
+    Read counts come from the .bai index of each (realigned) bamfile, or if an index does
+    not have counts, from the covsummary.py .cov files written by 02_bwa (or the
+    `bedtools bamtobed` coord files written by 02_bwa before .cov files were used).
+
+    Positional arguments:
+    parentdir - directory with datatable.txt and pipeline .pkl files
+    pool - pool_name from datatable.txt
+    bamfiles - list of paths to the realigned bamfiles for pool
+    """
+    print(Bcolors.BOLD + '\ncreating depth-balanced bedfiles for %s' % pool + Bcolors.ENDC)
+    bamfiles = sorted(bamfiles)
+    contigs = read_references(bamfiles[0])
+    depths = get_bam_depths(bamfiles)
+    if depths is None:
+        sortdir = op.join(parentdir, pool, '02c_sorted_bamfiles')
+        covfiles = [f for f in fs(sortdir) if f.endswith('.cov')]
+        if len(covfiles) > 0:
+            print('\tbam indexes do not have read counts, counting reads in coverage summaries instead')
+            depths = get_depths(covfiles)
+        else:
+            print('\tbam indexes do not have read counts, counting reads in coord files instead')
+            depths = get_coord_depths([f for f in fs(sortdir) if f.endswith('.coord')])
+
+    # remove any bedfiles from a previous attempt
+    beddir = makedir(get_beddir(parentdir, pool))
+    for f in fs(beddir):
+        if f.endswith('.bed'):
             os.remove(f)
-        print('\t\tRemoved %s bedfiles.' % len(files))
 
+    numpools = len(pklload(op.join(parentdir, 'poolref.pkl')))
+    beds = partition_by_depth(contigs, depths, determine_jobs_per_pool(numpools, parentdir=parentdir))
+    for fcount, lines in enumerate(beds):
+        f = op.join(beddir, "%s_bedfile_%s.bed" % (pool, str(fcount).zfill(4)))
+        with open(f, 'w') as o:
+            o.write("\n".join(["%s\t%s\t%s" % line for line in lines]))
+    print('\tcreated %s bedfiles for %s in %s' % (len(beds), pool, beddir))
+    return beddir
+
+
+def read_fai(ref):
+    """Get contig names and lengths in reference order from the samtools faidx index of ref.
+
+    Lengths are kept in a typed array so that references with millions of contigs stay small.
+
+    Returns:
+    names - list of contig names
+    lengths - array('Q') of contig lengths
+    """
+    names, lengths = [], array('Q')
+    with open('%s.fai' % ref, 'r') as o:
+        for line in o:
+            if line.strip() != '':
+                contig, length = line.split("\t")[:2]
+                names.append(contig)
+                lengths.append(int(length))
+    return names, lengths
+
+
+def read_lenfile(lenfile):
+    """Get contig names and lengths in reference order from a ref.fa.length file (see read_fai())."""
+    names, lengths = [], array('Q')
+    for line in openlenfile(lenfile):
+        if line.strip() != '':
+            contig, length = line.rsplit("\t", 1)
+            names.append(contig)
+            lengths.append(int(length))
+    return names, lengths
 
-def determine_jobs_per_pool(numpools, totaljobs):
-    """Use cluster ID and numpools to determine how many bedfiles to create.
 
-    cluster ID can be: 'cedar', 'graham', 'beluga'
+def get_fai_contigs(ref):
+    """Get a list of (contig, length) in reference order from the samtools faidx index of ref."""
+    return list(zip(*read_fai(ref)))
+
+
+def make_interval_lists(ref, intdir, nchunks):
+    """Spread base pairs of ref across nchunks GATK .list files of whole contigs, in reference order.
+
+    The files are written to a temporary name and then renamed, so that stage scripts for
+    different samples can (re)create the same lists at the same time.
+
+    Positional arguments:
+    ref - path to ref.fa, indexed with samtools faidx
+    intdir - directory for the .list files
+    nchunks - the max number of .list files
+
+    Returns:
+    intfiles - list of paths to .list files, in reference order
+    """
+    makedir(intdir)
+    contigs = get_fai_contigs(ref)
+    bname = op.basename(ref).split(".fa")[0]
+    intfiles = []
+    for fcount, lines in enumerate(partition_by_depth(contigs, dict(contigs), nchunks, split=False)):
+        f = op.join(intdir, "%s_interval_%s.list" % (bname, str(fcount).zfill(4)))
+        tmp = '%s.%s.tmp' % (f, os.getpid())
+        with open(tmp, 'w') as o:
+            o.write("\n".join(["%s:%s-%s" % (contig, start + 1, stop) for contig, start, stop in lines]))
+        os.replace(tmp, f)
+        intfiles.append(f)
+    return intfiles
+
+
+def get_job_budget(parentdir=None, refresh=False):
+    """Get how many more jobs the executor can take (see executor job_budget()).
+
+    The budget is saved in parentdir/job_budget.pkl so that every pool of a run is sized
+    from the same budget (00_start-pipeline.py refreshes it at the start of each run).
+
+    Keyword arguments:
+    parentdir - directory with datatable.txt and pipeline .pkl files; if None, nothing is saved
+    refresh - if True, ask the executor even if a budget was saved
+
+    Returns:
+    budget - dict with key 'executor' = name of executor, key 'jobs' = number of jobs, key
+             'limit' = number of jobs if none were queued (None if the executor has no limit or
+             could not be asked)
+    """
+    pkl = op.join(parentdir, 'job_budget.pkl') if parentdir is not None else None
+    if pkl is not None and op.exists(pkl) and refresh is False:
+        return pklload(pkl)
+    executor = get_executor()
+    try:
+        jobs, limit = executor.job_budget(), executor.job_limit()
+    except (subprocess.CalledProcessError, TypeError, KeyError) as e:
+        print('\tcould not get job limits from %s: %s' % (executor.name, e))
+        jobs, limit = None, None
+    budget = {'executor': executor.name, 'jobs': jobs, 'limit': limit}
+    if pkl is not None:
+        pkldump(budget, pkl)
+    return budget
+
+
+def determine_jobs_per_pool(numpools, totaljobs=975, parentdir=None):
+    """Use the executor's job budget and numpools to determine how many bedfiles to create.
+
+    At most totaljobs bedfiles are made for each pool. The number is sized from the executor's
+    limit as if no jobs were queued, so that it (and so the cache entry of the bedfiles, see
+    get_cache_dir()) is the same from run to run - varscan jobs are not submitted until
+    realignment is done, when the queue has usually emptied. If the executor does not report
+    a budget, use cluster ID: cluster ID can be: 'cedar', 'graham', 'beluga'
     If graham/beluga, job limit is 1000 jobs. If cedar, unlimited job number.
     """
-    cluster = os.environ['CC_CLUSTER']
+    budget = get_job_budget(parentdir)
+    limit = budget.get('limit', budget['jobs'])  # budgets saved before limits were
+    if limit is not None:
+        jobs_per_pool = min(totaljobs, max(1, math.floor(limit / numpools)))
+        print('\t%s can have %s jobs queued, creating %s bedfiles per pool' % (budget['executor'], limit, jobs_per_pool))
+        if budget['jobs'] < jobs_per_pool * numpools:
+            print(Bcolors.WARNING + '\tWARNING: the queue can only take %s more jobs now, fewer than the %s '
+                  'varscan jobs of all pools.' % (budget['jobs'], jobs_per_pool * numpools) + '\n\tIf it is '
+                  'still this full when varscan jobs are submitted (after realignment), some will fail to '
+                  'submit.' + Bcolors.ENDC)
+        return jobs_per_pool
+    cluster = os.environ.get('CC_CLUSTER', '')
     if cluster in ['graham', 'beluga']:
         jobs_per_pool = math.floor(totaljobs / numpools)
     else:
@@ -212,20 +727,43 @@ def determine_jobs_per_pool(numpools, totaljobs):
     return jobs_per_pool
 
 
-def main(ref, numpools=1, totaljobs=975):
+def main(ref, numpools=1, totaljobs=975, mode='length', parentdir=None):
     # determine how many bedfiles to create
-    jobs_per_pool = determine_jobs_per_pool(numpools, totaljobs)
+    jobs_per_pool = determine_jobs_per_pool(numpools, totaljobs, parentdir)
 
-    globals().update({'ref': ref, 'jobs_per_pool': jobs_per_pool})
+    globals().update({'ref': ref, 'jobs_per_pool': jobs_per_pool, 'mode': mode})
 
-    # warn about overwriting
-    check_beddir()
-
-    # get sequence lengths
-    find_positions()
+    # reuse bedfiles made for the same reference, mode, and number of bedfiles
+    cachedir = get_cache_dir(ref, mode, jobs_per_pool)
+    if op.exists(cachedir):
+        print('\tusing existing bedfiles for %s in %s' % (ref, cachedir))
+    else:
+        # write to a temporary dir then rename, so runs never see (or clobber) unfinished bedfiles
+        tmpdir = '%s.%s.tmp' % (cachedir, os.getpid())
+        globals()['beddir'] = makedir(tmpdir)
+        find_positions()
+        try:
+            os.rename(tmpdir, cachedir)
+        except OSError:
+            # another run finished the same bedfiles first
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        print('\t\tbedfiles are in %s' % cachedir)
+
+    # pin the bedfiles this run uses
+    if parentdir is not None:
+        pin_beddir(parentdir, ref, cachedir)
+    prune_cache(ref, cachedir)
+    return cachedir
 
 
 if __name__ == "__main__":
     # args
-    thisfile, ref = sys.argv
-    main(ref)
+    if len(sys.argv) == 4:
+        thisfile, mode, parentdir, pool = sys.argv
+        samps = pklload(op.join(parentdir, 'poolsamps.pkl'))[pool]
+        aligndir = op.join(parentdir, pool, '04_realign')
+        make_depth_bedfiles(parentdir, pool, [op.join(aligndir, '%s_realigned_reads.bam' % samp)
+                                              for samp in samps])
+    else:
+        thisfile, ref, *mode = sys.argv
+        main(ref, mode=mode[0] if len(mode) > 0 else 'length')
@@ -0,0 +1,464 @@
+"""Submit and query jobs with slurm, or with a local pool of processes.
+
+### purpose
+# every stage of the pipeline sbatches .sh files and asks slurm about jobs (squeue,
+#    sshare, seff, sacct, sacctmgr, scontrol). These calls go through an executor so that the pipeline
+#    can also run on a single server without slurm (eg for small projects or testing):
+#    - SlurmExecutor calls the slurm commands (default)
+#    - LocalExecutor keeps jobs in a spool directory, where `python executor.py run`
+#      runs them on a bounded pool of processes, honoring the cpus and memory requested
+#      by the #SBATCH header of each .sh file and any job dependencies
+###
+
+### usage
+# from executor import get_executor
+# pid = get_executor().submit('/path/to/file.sh')
+# pid = get_executor().submit('/path/to/next.sh', dependencies=[pid])
+#
+# to run jobs submitted to the local executor (leave running, eg in screen or tmux):
+# python executor.py run [cpus] [mem_in_MB]
+###
+
+### assumes
+# to use the local executor, the following is in parentdir/bash_variables, and sourced:
+#    export PIPELINE_EXECUTOR=local
+#    export PIPELINE_SPOOL=/path/to/spooldir  (optional, default: $HOME/.pipeline_spool)
+# jobs run by the local executor find bwa, samtools, etc on $PATH (if the `module` command does
+#    not exist on the server, `module load` lines in .sh files do nothing)
+###
+"""
+
+import os, sys, re, json, math, time, fcntl, shutil, tempfile, subprocess
+from os import path as op
+from coadaptree import makedir
+
+# fields (and their squeue format codes) of delimited squeue output, in the order of SQUEUE_FORMAT
+SQUEUE_FIELDS = [('jobid', '%i'), ('user', '%u'), ('account', '%a'), ('name', '%j'), ('state', '%t'),
+                 ('start', '%S'), ('timeleft', '%L'), ('nodes', '%D'), ('cpus', '%C'), ('gres', '%b'),
+                 ('mem', '%m'), ('nodelist', '%N'), ('reason', '%r')]
+SQUEUE_DELIM = '|'
+
+# fields of sacct output (separated by |, memory in MB) used to size jobs from previous usage
+SACCT_FIELDS = ['JobID', 'JobName', 'State', 'Elapsed', 'MaxRSS']
+
+# submit limit of the scheduler kept free for jobs of the pipeline's other stages (see job_budget())
+RESERVE_JOBS = 25
+
+
+def read_sbatch_header(shfile):
+    """Get the #SBATCH options from the header of a .sh file.
+
+    Returns:
+    opts - dict with key = option name (eg 'mem', 'cpus-per-task'), val = str
+    """
+    opts = {}
+    with open(shfile, 'r') as o:
+        for line in o:
+            if line.startswith('#SBATCH'):
+                opt = line.split()[1].lstrip('-')
+                key, val = opt.split('=', 1) if '=' in opt else (opt, '')
+                opts[key] = val.strip("'").strip('"')
+    return opts
+
+
+def get_mem(mem):
+    """Convert a slurm memory request (eg 5000M, 30G) to MB."""
+    units = {'K': 1/1024, 'M': 1, 'G': 1024, 'T': 1024**2}
+    if mem[-1].upper() in units:
+        return math.ceil(float(mem[:-1]) * units[mem[-1].upper()])
+    return int(mem)
+
+
+def get_dependencies(dependency):
+    """Get job ids from a slurm --dependency string (eg afterok:123:456,afterok:789)."""
+    return [pid for pid in re.split('[,:?]', dependency) if pid.isdigit()]
+
+
+class SlurmExecutor:
+    """Submit and query jobs with slurm commands."""
+    name = 'slurm'
+
+    def submit(self, shfile, dependencies=None):
+        """Sbatch shfile from its directory (so outfiles are written there), return the job id.
+
+        Positional arguments:
+        shfile - path to .sh file with #SBATCH header
+
+        Keyword arguments:
+        dependencies - list of job ids that must finish without error before shfile can start
+        """
+        os.chdir(op.dirname(shfile))
+        cmd = [shutil.which('sbatch')]
+        if dependencies:
+            # if a dependency fails, cancel this job instead of leaving it pending forever
+            cmd.extend(['--dependency=afterok:%s' % ':'.join(dependencies), '--kill-on-invalid-dep=yes'])
+        out = subprocess.check_output(cmd + [shfile]).decode('utf-8')
+        print(out.strip())
+        return out.replace("\n", "").split()[-1]
+
+    def squeue(self, states=[], delimited=False):
+        """Get lines of squeue output for user's jobs.
+
+        Lines are formatted by exported SQUEUE_FORMAT, or if delimited is True, are the
+        SQUEUE_FIELDS separated by SQUEUE_DELIM.
+        """
+        cmd = [shutil.which('squeue'),
+               '-u',
+               os.environ['USER'],
+               '-h']
+        if delimited is True:
+            cmd.extend(['-o', SQUEUE_DELIM.join(code for field, code in SQUEUE_FIELDS)])
+        if 'running' in states:
+            cmd.extend(['-t', 'RUNNING'])
+        elif 'pending' in states:
+            cmd.extend(['-t', 'PD'])
+        return subprocess.check_output(cmd).decode('utf-8').split('\n')
+
+    def sshare(self, fields=['Account']):
+        """Get lines of sshare output with the accounts available to user (and other fields)."""
+        return subprocess.check_output([shutil.which('sshare'),
+                                        '-U',
+                                        '--user',
+                                        os.environ['USER'],
+                                        '--format=%s' % ','.join(fields)]).decode('utf-8').split('\n')
+
+    def seff(self, pid):
+        """Get lines of seff output for job pid."""
+        return subprocess.check_output([shutil.which('seff'), pid]).decode('utf-8').split('\n')
+
+    def sacct(self, starttime):
+        """Get lines of sacct output (SACCT_FIELDS separated by |) for user's jobs and job steps.
+
+        Positional arguments:
+        starttime - only get jobs that started after this date (YYYY-MM-DD)
+        """
+        return subprocess.check_output([shutil.which('sacct'),
+                                        '-u',
+                                        os.environ['USER'],
+                                        '-S',
+                                        starttime,
+                                        '-n',
+                                        '-P',
+                                        '--units=M',
+                                        '--format=%s' % ','.join(SACCT_FIELDS)]).decode('utf-8').split('\n')
+
+    def job_limit(self):
+        """Get how many jobs user can have in the queue, None if slurm has no submit limit for user.
+
+        The limit is the lowest MaxSubmitJobs or GrpSubmitJobs of user's associations, less
+        RESERVE_JOBS (jobs already in the queue are not counted).
+        """
+        if shutil.which('sacctmgr') is None:
+            return None
+        lines = subprocess.check_output([shutil.which('sacctmgr'),
+                                         'show',
+                                         'assoc',
+                                         'where',
+                                         'user=%s' % os.environ['USER'],
+                                         'format=MaxSubmitJobs,GrpSubmitJobs',
+                                         '-n',
+                                         '-P']).decode('utf-8').split('\n')
+        limits = [int(x) for line in lines for x in line.strip().split('|') if x.isdigit()]
+        if len(limits) == 0:
+            return None
+        return max(0, min(limits) - RESERVE_JOBS)
+
+    def job_budget(self):
+        """Get how many more jobs user can submit, None if slurm has no submit limit for user.
+
+        This is job_limit() less the jobs user already has in the queue.
+        """
+        limit = self.job_limit()
+        if limit is None:
+            return None
+        queued = len([line for line in self.squeue() if line.strip() != ''])
+        return max(0, limit - queued)
+
+    def update_accounts(self, account, pids):
+        """Move pending jobs pids to account with one scontrol call, return its exit status.
+
+        scontrol exits with a non-zero status if any of the jobs could not be moved.
+        """
+        return subprocess.call([shutil.which('scontrol'),
+                                'update',
+                                'Account=%s' % account,
+                                'JobId=%s' % ','.join(str(pid) for pid in pids)],
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+
+
+class LocalExecutor:
+    """Keep jobs in a spool directory, run them with `python executor.py run`.
+
+    Each job is a .json file in spooldir/jobs. States follow squeue: PD, R, CD (exit code 0),
+    F (non-zero exit code), CA (cancelled because a dependency did not finish without error).
+    """
+    name = 'local'
+    account = 'local_cpu'
+
+    def __init__(self, spooldir=None):
+        if spooldir is None:
+            spooldir = os.environ.get('PIPELINE_SPOOL', op.join(os.environ['HOME'], '.pipeline_spool'))
+        self.spooldir = spooldir
+        self.jobdir = makedir(op.join(spooldir, 'jobs'))
+        self.lockfile = op.join(spooldir, 'lock')
+
+    def lock(self):
+        """Lock the spool so that only one process changes jobs at a time."""
+        o = open(self.lockfile, 'a')
+        fcntl.flock(o, fcntl.LOCK_EX)
+        return o
+
+    def jobfile(self, pid):
+        return op.join(self.jobdir, '%s.json' % pid)
+
+    def load(self, pid):
+        with open(self.jobfile(pid), 'r') as o:
+            return json.load(o)
+
+    def save(self, job):
+        """Write job to the spool, replacing any previous version in one step."""
+        tmp = self.jobfile(job['id']) + '.tmp'
+        with open(tmp, 'w') as o:
+            json.dump(job, o)
+        os.replace(tmp, self.jobfile(job['id']))
+
+    def jobs(self):
+        """Get all jobs in the spool, ordered by job id."""
+        pids = sorted(int(f.replace('.json', '')) for f in os.listdir(self.jobdir) if f.endswith('.json'))
+        return [self.load(pid) for pid in pids]
+
+    def newpid(self):
+        """Get the next job id (call while the spool is locked)."""
+        counter = op.join(self.spooldir, 'lastpid')
+        pid = int(open(counter).read()) + 1 if op.exists(counter) else 1
+        with open(counter, 'w') as o:
+            o.write(str(pid))
+        return str(pid)
+
+    def submit(self, shfile, dependencies=None):
+        """Add shfile to the spool, return the job id. See SlurmExecutor.submit()."""
+        opts = read_sbatch_header(shfile)
+        deps = get_dependencies(opts.get('dependency', ''))
+        if dependencies:
+            deps = list(dependencies)
+        with self.lock():
+            pid = self.newpid()
+            name = opts.get('job-name', op.basename(shfile))
+            output = opts.get('output', 'slurm-%j.out').replace('%j', pid)
+            job = {'id': pid,
+                   'name': name,
+                   'user': os.environ['USER'],
+                   'account': self.account,
+                   'shfile': op.abspath(shfile),
+                   'output': op.join(op.dirname(op.abspath(shfile)), output),
+                   'cpus': int(opts.get('ntasks', 1)) * int(opts.get('cpus-per-task', 1)),
+                   'mem': get_mem(opts.get('mem', '1000M')),
+                   'time': opts.get('time', 'UNLIMITED'),
+                   'dependencies': deps,
+                   'state': 'PD',
+                   'reason': 'Dependency' if len(deps) > 0 else 'Priority',
+                   'exit_code': None,
+                   'submit': time.time(),
+                   'start': None,
+                   'end': None,
+                   'maxrss': None}
+            self.save(job)
+        print('Submitted batch job %s' % pid)
+        return pid
+
+    def squeue(self, states=[], delimited=False):
+        """Get lines of queued jobs, in the same layout as SQUEUE_FORMAT in bash_variables.
+
+        If delimited is True, lines are the SQUEUE_FIELDS separated by SQUEUE_DELIM.
+        """
+        keep = ['R'] if 'running' in states else ['PD'] if 'pending' in states else ['PD', 'R']
+        lines = []
+        for job in self.jobs():
+            if job['state'] in keep:
+                start = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(job['start'])) if job['start'] else 'N/A'
+                values = (job['id'], job['user'], job['account'], job['name'], job['state'], start,
+                          job['time'], 1, job['cpus'], 'N/A', '%sM' % job['mem'],
+                          'localhost' if job['state'] == 'R' else '', job['reason'])
+                if delimited is True:
+                    lines.append(SQUEUE_DELIM.join(str(value) for value in values))
+                else:
+                    lines.append('%8s %8s %15s %68s %3s %16s %10s %5s %4s %6s %7s %s (%s)' % values)
+        return lines
+
+    def sshare(self, fields=['Account']):
+        """The local executor has a single account, with a FairShare of 1."""
+        values = {'Account': self.account, 'FairShare': '1.000000'}
+        return [' '.join(fields),
+                ' '.join('-' * 20 for field in fields),
+                ' '.join(values.get(field, '') for field in fields)]
+
+    def seff(self, pid):
+        """Get lines of job info for pid, with the State line used by start_varscan.check_seff()."""
+        job = self.load(pid)
+        states = {'PD': 'PENDING', 'R': 'RUNNING', 'CD': 'COMPLETED', 'F': 'FAILED', 'CA': 'CANCELLED'}
+        state = states[job['state']]
+        if job['exit_code'] is not None:
+            state = state + ' (exit code %s)' % job['exit_code']
+        return ['Job ID: %s' % pid,
+                'Job Name: %s' % job['name'],
+                'State: %s' % state,
+                'Memory Utilized: %s' % ('%sK' % job['maxrss'] if job['maxrss'] is not None else 'N/A')]
+
+    def sacct(self, starttime):
+        """Get lines of finished jobs in the layout of SlurmExecutor.sacct() (without job steps)."""
+        states = {'CD': 'COMPLETED', 'F': 'FAILED', 'CA': 'CANCELLED'}
+        start = time.mktime(time.strptime(starttime, '%Y-%m-%d'))
+        lines = []
+        for job in self.jobs():
+            if job['state'] in states and job['start'] is not None and job['start'] >= start:
+                elapsed = int(job['end'] - job['start'])
+                lines.append('|'.join([job['id'],
+                                       job['name'],
+                                       states[job['state']],
+                                       '%02d:%02d:%02d' % (elapsed // 3600, elapsed % 3600 // 60, elapsed % 60),
+                                       '%.2fM' % (job['maxrss'] / 1024) if job['maxrss'] is not None else '']))
+        return lines
+
+    def job_budget(self):
+        """Get the number of jobs the runner can run at once (the cpus it runs with, else all cpus).
+
+        There is no submit limit, so jobs already in the spool are not counted.
+        """
+        f = op.join(self.spooldir, 'capacity.json')
+        if op.exists(f):
+            with open(f, 'r') as o:
+                return json.load(o)['cpus']
+        return os.cpu_count()
+
+    def job_limit(self):
+        """Get the number of jobs the runner can run at once (same as job_budget())."""
+        return self.job_budget()
+
+    def update_accounts(self, account, pids):
+        """Move pending jobs pids to account (accounts have no effect on local scheduling).
+
+        Like scontrol, return 1 if any of the jobs could not be moved, otherwise 0.
+        """
+        status = 0
+        with self.lock():
+            for pid in pids:
+                if not op.exists(self.jobfile(pid)):
+                    status = 1
+                    continue
+                job = self.load(pid)
+                if job['state'] != 'PD':
+                    # slurm can only change the account of pending jobs
+                    status = 1
+                    continue
+                job['account'] = account
+                self.save(job)
+        return status
+
+    def start(self, job):
+        """Start running job, return the process."""
+        tmpdir = tempfile.mkdtemp(prefix='pipeline_%s_' % job['id'])
+        env = dict(os.environ,
+                   SLURM_JOB_ID=job['id'],
+                   SLURM_JOB_NAME=job['name'],
+                   SLURM_CPUS_PER_TASK=str(job['cpus']),
+                   SLURM_TMPDIR=tmpdir)
+        if 'BASH_FUNC_module%%' not in env and shutil.which('module') is None:
+            # .sh files stop at the first failed command, so `module load` can't fail without modules
+            env['BASH_FUNC_module%%'] = '() {  :\n}'
+        with open(job['output'], 'w') as out:
+            proc = subprocess.Popen(['bash', job['shfile']],
+                                    cwd=op.dirname(job['shfile']),
+                                    stdout=out,
+                                    stderr=subprocess.STDOUT,
+                                    env=env)
+        proc.tmpdir = tmpdir
+        job.update({'state': 'R', 'reason': 'None', 'start': time.time()})
+        return proc
+
+    def run(self, cpus=None, mem=None, interval=5):
+        """Run jobs in the spool as resources and dependencies allow. Loops until killed.
+
+        Keyword arguments:
+        cpus - total number of cpus jobs can use at once (default: all cpus)
+        mem - total MB of memory jobs can use at once (default: all memory)
+        interval - seconds between checks of the spool
+        """
+        if cpus is None:
+            cpus = os.cpu_count()
+        if mem is None:
+            mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024**2
+        print('running local jobs in %s with %s cpus and %sM memory' % (self.spooldir, cpus, mem))
+        with open(op.join(self.spooldir, 'capacity.json'), 'w') as o:
+            json.dump({'cpus': cpus, 'mem': mem}, o)
+        procs = {}  # key = pid, val = subprocess.Popen
+        with self.lock():
+            # jobs that were running when a previous runner died will never finish
+            for job in self.jobs():
+                if job['state'] == 'R':
+                    job.update({'state': 'F', 'reason': 'NodeFail', 'end': time.time()})
+                    self.save(job)
+        while True:
+            with self.lock():
+                jobs = self.jobs()
+                states = dict((job['id'], job['state']) for job in jobs)
+                # finish jobs that have exited
+                for job in jobs:
+                    if job['id'] in procs:
+                        pid, status, rusage = os.wait4(procs[job['id']].pid, os.WNOHANG)
+                        if pid == 0:
+                            continue
+                        shutil.rmtree(procs.pop(job['id']).tmpdir, ignore_errors=True)
+                        code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 128 + os.WTERMSIG(status)
+                        job.update({'state': 'CD' if code == 0 else 'F', 'exit_code': code,
+                                    'end': time.time(), 'maxrss': rusage.ru_maxrss, 'reason': 'None'})
+                        states[job['id']] = job['state']
+                        self.save(job)
+                # requests larger than the runner are clamped to it, as when the jobs were started
+                usedcpus = sum(min(job['cpus'], cpus) for job in jobs if job['id'] in procs)
+                usedmem = sum(min(job['mem'], mem) for job in jobs if job['id'] in procs)
+                # start pending jobs, oldest first
+                for job in jobs:
+                    if job['state'] != 'PD':
+                        continue
+                    before = (job['state'], job['reason'])
+                    depstates = [states.get(dep, 'CD') for dep in job['dependencies']]
+                    if any(state in ['F', 'CA'] for state in depstates):
+                        job.update({'state': 'CA', 'reason': 'DependencyNeverSatisfied', 'end': time.time()})
+                        states[job['id']] = 'CA'
+                    elif any(state != 'CD' for state in depstates):
+                        job['reason'] = 'Dependency'
+                    elif (usedcpus + min(job['cpus'], cpus) > cpus) or (usedmem + min(job['mem'], mem) > mem):
+                        job['reason'] = 'Resources'
+                    else:
+                        procs[job['id']] = self.start(job)
+                        states[job['id']] = 'R'
+                        usedcpus += min(job['cpus'], cpus)
+                        usedmem += min(job['mem'], mem)
+                    if (job['state'], job['reason']) != before:
+                        self.save(job)
+            time.sleep(interval)
+
+
+def get_executor():
+    """Get the executor chosen with the PIPELINE_EXECUTOR environment variable (default slurm)."""
+    global _executor
+    if _executor is None:
+        which = os.environ.get('PIPELINE_EXECUTOR', 'slurm')
+        if which not in ['slurm', 'local']:
+            print('PIPELINE_EXECUTOR must be one of slurm or local, not %s. exiting.' % which)
+            exit()
+        _executor = LocalExecutor() if which == 'local' else SlurmExecutor()
+    return _executor
+
+
+_executor = None
+
+
+if __name__ == '__main__':
+    # args
+    thisfile, cmd, *resources = sys.argv
+    if cmd != 'run':
+        print('usage: python executor.py run [cpus] [mem_in_MB]')
+        exit()
+    LocalExecutor().run(*[int(x) for x in resources])
@@ -0,0 +1,106 @@
+"""Record the outputs of each stage for each sample so that a restarted run can skip finished work.
+
+### purpose
+# at the end of each stage's .sh file (01 trim through 05 indelRealign), record the size and
+#    mtime of the stage's output files along with a hash of the commands that produced them
+# .sh files run with `set -eo pipefail`, so a stage is only recorded after all of its commands
+#    succeed; recording fails (and so stops the .sh file) if any output is missing
+# when the pipeline is restarted with `00_start-pipeline.py --resume`, a stage is complete if
+#    its record exists, the commands in its regenerated .sh file hash the same, and its outputs
+#    have not changed since they were recorded - each sample is resubmitted from its first
+#    incomplete stage
+###
+
+### usage
+# as run at the end of each stage's .sh file:
+#    python manifest.py /path/to/pooldir samp stage /path/to/stage.sh outfile1 [outfile2 ...]
+###
+
+### assumes
+# records are kept in pooldir/manifest (so they are removed along with the pooldir when
+#    the pipeline is started without --resume)
+# #SBATCH lines, comments, and calls to other pipeline scripts do not change stage outputs
+###
+"""
+
+import sys, time, hashlib
+from os import path as op
+from coadaptree import makedir, pkldump, pklload
+
+STAGES = ['trim', 'bwa', 'mark', 'realign', 'indelRealign']
+
+
+def get_recordfile(pooldir, samp, stage):
+    return op.join(pooldir, 'manifest', '%s-%s.pkl' % (samp, stage))
+
+
+def get_params(shfile):
+    """Hash the commands in shfile that determine the stage's outputs."""
+    with open(shfile, 'r') as o:
+        lines = o.read().split("\n")
+    keep = [line.strip() for line in lines
+            if line.strip() != ''
+            and not line.startswith('#')
+            and '$HOME/pipeline/' not in line]
+    return hashlib.sha1("\n".join(keep).encode('utf-8')).hexdigest()
+
+
+def get_filestats(outputs):
+    """Get size and mtime of each output file, None for files that do not exist."""
+    stats = {}
+    for f in outputs:
+        stats[f] = (op.getsize(f), op.getmtime(f)) if op.exists(f) else None
+    return stats
+
+
+def record(pooldir, samp, stage, shfile, outputs):
+    """Record that stage finished for samp, unless any of its outputs are missing."""
+    stats = get_filestats(outputs)
+    missing = [f for f, stat in stats.items() if stat is None]
+    if len(missing) > 0:
+        print('not recording %s for %s, could not find outputs:' % (stage, samp))
+        for f in missing:
+            print('\t%s' % f)
+        exit(1)
+    makedir(op.join(pooldir, 'manifest'))
+    pkldump({'samp': samp,
+             'stage': stage,
+             'shfile': shfile,
+             'params': get_params(shfile),
+             'outputs': stats,
+             'time': time.time()},
+            get_recordfile(pooldir, samp, stage))
+    print('recorded %s outputs for %s' % (stage, samp))
+
+
+def is_complete(pooldir, samp, stage, shfile):
+    """Determine if stage's record matches shfile and its outputs are unchanged since recording."""
+    recordfile = get_recordfile(pooldir, samp, stage)
+    if not op.exists(recordfile):
+        return False
+    rec = pklload(recordfile)
+    if rec['params'] != get_params(shfile):
+        return False
+    return get_filestats(rec['outputs'].keys()) == rec['outputs']
+
+
+def first_incomplete(pooldir, samp, shfiles):
+    """Get the index of the first stage that needs to be rerun for samp, None if all are complete.
+
+    Positional arguments:
+    shfiles - list of .sh files, one for each stage in STAGES (see 00_start-pipeline.get_chain_shfiles)
+    """
+    for i, (stage, shfile) in enumerate(zip(STAGES, shfiles)):
+        if not is_complete(pooldir, samp, stage, shfile):
+            return i
+    return None
+
+
+if __name__ == '__main__':
+    # args
+    thisfile, pooldir, samp, stage, shfile, *outputs = sys.argv
+    if stage not in STAGES:
+        print('stage must be one of %s, not %s' % (STAGES, stage))
+        exit(1)
+
+    record(pooldir, samp, stage, shfile, outputs)
@@ -0,0 +1,174 @@
+"""A fake slurm controller for testing the pipeline's scheduling code off-cluster.
+
+### purpose
+# stand in for sbatch, squeue, sshare, seff, sacct, and scontrol so that balance_queue.py,
+#    start_varscan.py, etc can be run (and measured) with thousands of jobs without a cluster
+# jobs are kept in a state directory (same layout as the spool of executor.LocalExecutor),
+#    but are never run - whoever uses the mock decides when jobs start and finish
+# every call to a slurm command is logged to statedir/calls.log (one line per call)
+###
+
+### usage
+# to create executables (squeue, sshare, ...) in bindir that call this file:
+#    python mock_slurm.py install /path/to/bindir
+#    export PATH=/path/to/bindir:$PATH MOCK_SLURM_STATE=/path/to/statedir
+# commands are then called as usual, or directly:
+#    python mock_slurm.py squeue -u $USER -h
+# to set the accounts returned by sshare (optionally with their FairShare, default 1.0):
+#    python mock_slurm.py accounts def-someuser:0.2 rrg-someuser:0.9
+# to run a pipeline script with its time.sleep() calls scaled (eg 0.01 = 100x faster):
+#    MOCK_SLURM_TIMESCALE=0.01 python mock_slurm.py tail /path/to/start_varscan.py parentdir pool
+###
+
+### assumes
+# output of squeue is in the layout of SQUEUE_FORMAT in bash_variables
+###
+"""
+
+import os, sys, json, time, runpy
+from os import path as op
+from executor import LocalExecutor
+
+COMMANDS = ['sbatch', 'squeue', 'sshare', 'seff', 'sacct', 'scontrol']
+
+
+class MockSlurm(LocalExecutor):
+    """Slurm commands answered from a state directory of jobs.
+
+    Job states are changed with set_state(), jobs are never run.
+    """
+    name = 'mock'
+
+    def __init__(self, statedir=None):
+        if statedir is None:
+            statedir = os.environ['MOCK_SLURM_STATE']
+        super().__init__(statedir)
+
+    def log(self, cmd):
+        """Record a call to a slurm command (appends of one short line do not interleave)."""
+        with open(op.join(self.spooldir, 'calls.log'), 'a') as o:
+            o.write('%s\t%s\n' % (cmd, time.time()))
+
+    def get_fairshare(self):
+        """Get a dict with key = account, val = FairShare."""
+        f = op.join(self.spooldir, 'accounts.json')
+        return json.load(open(f)) if op.exists(f) else {'def-someuser_cpu': 1.0}
+
+    def get_accounts(self):
+        return list(self.get_fairshare().keys())
+
+    def set_accounts(self, accounts):
+        """Set accounts from a list of 'account' or 'account:fairshare'."""
+        fairshare = {}
+        for acct in accounts:
+            name, fs = acct.split(':') if ':' in acct else (acct, 1.0)
+            fairshare[name if name.endswith('_cpu') else '%s_cpu' % name] = float(fs)
+        with open(op.join(self.spooldir, 'accounts.json'), 'w') as o:
+            json.dump(fairshare, o)
+
+    def set_state(self, pid, state, reason='None', exit_code=None):
+        """Change the state of job pid (eg to 'R', or 'CD' with exit_code 0)."""
+        with self.lock():
+            job = self.load(pid)
+            job.update({'state': state, 'reason': reason, 'exit_code': exit_code})
+            if state == 'R':
+                job['start'] = time.time()
+            elif state in ['CD', 'F', 'CA']:
+                job['end'] = time.time()
+            self.save(job)
+
+    def submit(self, shfile, dependencies=None, account=None):
+        pid = super().submit(shfile, dependencies)
+        with self.lock():
+            job = self.load(pid)
+            if account is None:
+                account = os.environ.get('SBATCH_ACCOUNT', self.get_accounts()[0].split('_')[0])
+            job['account'] = account if account.endswith('_cpu') else '%s_cpu' % account
+            self.save(job)
+        return pid
+
+    def sshare(self, fields=['Account']):
+        lines = [' '.join(fields), ' '.join('-' * 20 for field in fields)]
+        for account, fairshare in self.get_fairshare().items():
+            values = {'Account': account, 'FairShare': '%f' % fairshare}
+            lines.append(' '.join(values.get(field, '') for field in fields))
+        return lines
+
+    def sbatch(self, args):
+        """Parse sbatch command line arguments, submit the file."""
+        dependencies, account = None, None
+        for arg in args[:-1]:
+            if arg.startswith('--dependency='):
+                dependencies = [pid for pid in arg.split(':')[1:] if pid.isdigit()]
+            elif arg.startswith('--account='):
+                account = arg.split('=')[1]
+        self.submit(op.abspath(args[-1]), dependencies, account)
+
+    def scontrol(self, args):
+        """Handle `scontrol update Account=x JobId=y[,z]`."""
+        if args[0] != 'update':
+            print('mock_slurm.py: only scontrol update is supported')
+            exit(1)
+        opts = dict(arg.split('=', 1) for arg in args[1:])
+        status = self.update_accounts(opts['Account'], opts['JobId'].split(','))
+        if status != 0:
+            print('scontrol: error: Job has already started or does not exist', file=sys.stderr)
+        return status
+
+    def call(self, cmd, args):
+        """Run a slurm command as it would be run from a shell, print its output."""
+        self.log(cmd)
+        if cmd == 'sbatch':
+            self.sbatch(args)
+        elif cmd == 'squeue':
+            states = ['running'] if 'RUNNING' in args else ['pending'] if 'PD' in args else []
+            lines = self.squeue(states, delimited='-o' in args)
+            if '-h' not in args:
+                lines.insert(0, os.environ.get('SQUEUE_FORMAT', 'JOBID USER ACCOUNT NAME ST'))
+            print('\n'.join(lines))
+        elif cmd == 'sshare':
+            fields = [arg.split('=')[1].split(',') for arg in args if arg.startswith('--format=')]
+            print('\n'.join(self.sshare(*fields)))
+        elif cmd == 'seff':
+            print('\n'.join(self.seff(args[0])))
+        elif cmd == 'sacct':
+            print('\n'.join(self.sacct(args[args.index('-S') + 1])))
+        elif cmd == 'scontrol':
+            exit(self.scontrol(args))
+
+
+def install(bindir):
+    """Create executables in bindir that call this file for each slurm command."""
+    os.makedirs(bindir, exist_ok=True)
+    for cmd in COMMANDS:
+        f = op.join(bindir, cmd)
+        with open(f, 'w') as o:
+            o.write('#!/bin/bash\nexec %s %s %s "$@"\n' % (sys.executable, op.abspath(__file__), cmd))
+        os.chmod(f, 0o755)
+    return bindir
+
+
+def run_tail(script, args):
+    """Run a pipeline script as __main__, with time.sleep() scaled by $MOCK_SLURM_TIMESCALE."""
+    scale = float(os.environ.get('MOCK_SLURM_TIMESCALE', 1))
+    sleep = time.sleep
+    time.sleep = lambda seconds: sleep(seconds * scale)
+    sys.argv = [script] + args
+    sys.path.insert(0, op.dirname(op.abspath(script)))
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    # args
+    thisfile, cmd, *args = sys.argv
+    if cmd == 'install':
+        install(args[0])
+    elif cmd == 'accounts':
+        MockSlurm().set_accounts(args)
+    elif cmd == 'tail':
+        run_tail(args[0], args[1:])
+    elif cmd in COMMANDS:
+        MockSlurm().call(cmd, args)
+    else:
+        print('unknown command: %s' % cmd)
+        exit(1)
@@ -0,0 +1,205 @@
+"""Trim a very large pair of fastq.gz files in chunks, several chunks at a time.
+
+### purpose
+# fastp's threading plateaus well below the 16 cpus of a trim job, so the deepest libraries
+#    time out. If the pipeline was started with `--chunked_trimming`, 01_trim-fastq.py uses this
+#    file for each pair whose R1 is larger than CHUNK_MIN_BYTES:
+#    - R1 and R2 are split (zcat | split) into chunks of CHUNK_READS reads in $SLURM_TMPDIR, so
+#      that the nth chunk of R1 and the nth chunk of R2 have the same reads
+#    - chunks are trimmed with the usual fastp options, PROCS fastp processes at a time
+#    - the trimmed chunks are concatenated (as gzip members) into the usual trimmed outfiles,
+#      fastp .json stats of the chunks are merged into the usual .json file, and their logs are
+#      concatenated into the usual logfile
+# the fastp .html report is made from the first chunk only
+###
+
+### usage
+# python parallel_trim.py r1 r2 r1out r2out jsonfile htmlfile logfile "fastp options"
+###
+
+### assumes
+# R1 and R2 list reads in the same order (as fastp also assumes), with 4 lines per read
+# $SLURM_TMPDIR (else the system tmp dir) has room for all of R1 and R2 uncompressed at once, plus
+#    their trimmed chunks - roughly TMP_RATIO times the size of the two fastq.gz files (chunks are
+#    removed as they are trimmed). A warning is printed if there looks to be less free space
+###
+"""
+
+import os, sys, json, shutil, tempfile, subprocess
+from os import path as op
+from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_MIN_BYTES = 2 * 1024**3  # R1 files larger than this are trimmed in chunks
+CHUNK_READS = 10000000
+PROCS = 4  # fastp processes at a time
+THREADS = 4  # threads per fastp process
+TMP_RATIO = 5  # tmp space needed per byte of fastq.gz (~4 bytes uncompressed, ~1 byte of trimmed chunks)
+
+
+def split_fastq(fastq, prefix, reads=CHUNK_READS):
+    """Start splitting fastq.gz into uncompressed chunks prefix0000.fastq, prefix0001.fastq, ...
+
+    Returns the process, so that R1 and R2 can be split at the same time.
+    """
+    # pipefail, so that a corrupt or truncated fastq.gz fails the split instead of leaving short chunks
+    return subprocess.Popen(['bash', '-o', 'pipefail', '-c',
+                             'zcat %s | split -l %s -d -a 4 --additional-suffix=.fastq - %s'
+                             % (fastq, reads * 4, prefix)])
+
+
+def get_chunks(tmpdir):
+    """Get a list of (r1chunk, r2chunk), and make sure each R1 chunk has an R2 chunk."""
+    r1chunks = sorted(f for f in os.listdir(tmpdir) if f.startswith('R1_') and f.endswith('.fastq'))
+    r2chunks = sorted(f for f in os.listdir(tmpdir) if f.startswith('R2_') and f.endswith('.fastq'))
+    if [f[3:] for f in r1chunks] != [f[3:] for f in r2chunks]:
+        print('FAIL: R1 and R2 were not split into the same chunks, do they have the same number of reads?')
+        exit(1)
+    return [(op.join(tmpdir, r1chunk), op.join(tmpdir, r2chunk)) for r1chunk, r2chunk in zip(r1chunks, r2chunks)]
+
+
+def trim_chunk(r1chunk, r2chunk, options):
+    """Trim a pair of chunks with fastp, remove the untrimmed chunks.
+
+    Returns:
+    outfiles - (r1 out, r2 out, json, html, log) for the chunk
+    """
+    base = op.join(op.dirname(r1chunk), op.basename(r1chunk).replace('.fastq', '').replace('R1_', ''))
+    outfiles = tuple('%s_%s' % (base, suffix)
+                     for suffix in ['R1_trimmed.fastq.gz', 'R2_trimmed.fastq.gz', 'stats.json', 'stats.html', 'stats.log'])
+    r1out, r2out, jsonfile, htmlfile, logfile = outfiles
+    cmd = 'fastp -i %s -o %s -I %s -O %s %s --thread %s --json %s -h %s > %s 2>&1' % (
+        r1chunk, r1out, r2chunk, r2out, options, THREADS, jsonfile, htmlfile, logfile)
+    status = subprocess.call(cmd, shell=True)
+    if status != 0:
+        print('FAIL: fastp exited with status %s for %s' % (status, r1chunk))
+        print(open(logfile).read())
+        exit(1)
+    for f in [r1chunk, r2chunk]:
+        os.remove(f)
+    return outfiles
+
+
+def weighted(values, weights):
+    """Get the mean of values weighted by weights (0 if all weights are 0)."""
+    return sum(v * w for v, w in zip(values, weights)) / sum(weights) if sum(weights) > 0 else 0
+
+
+def add_counts(dicts):
+    """Sum dicts of counts (eg kmer_count, overrepresented_sequences)."""
+    counts = {}
+    for d in dicts:
+        for key, count in d.items():
+            counts[key] = counts.get(key, 0) + count
+    return counts
+
+
+def merge_reads(sections):
+    """Merge per-read stats of chunks (eg read1_before_filtering) - curves are weighted by reads."""
+    merged = deepcopy(sections[0])
+    reads = [section['total_reads'] for section in sections]
+    for key in ['total_reads', 'total_bases']:
+        merged[key] = sum(section[key] for section in sections)
+    for curves in ['quality_curves', 'content_curves']:
+        for base, curve in merged.get(curves, {}).items():
+            length = max(len(section[curves][base]) for section in sections)
+            merged[curves][base] = [weighted([section[curves][base][i] if i < len(section[curves][base]) else 0
+                                              for section in sections], reads)
+                                    for i in range(length)]
+    for counts in ['kmer_count', 'overrepresented_sequences']:
+        if counts in merged:
+            merged[counts] = add_counts([section[counts] for section in sections])
+    return merged
+
+
+def merge_stats(stats):
+    """Merge the fastp .json stats of each chunk into stats for the whole pair of files.
+
+    Positional arguments:
+    stats - list of dicts loaded from fastp .json files
+    """
+    merged = deepcopy(stats[0])
+    for when in ['before_filtering', 'after_filtering']:
+        summaries = [s['summary'][when] for s in stats]
+        summary = merged['summary'][when]
+        for key in ['total_reads', 'total_bases', 'q20_bases', 'q30_bases']:
+            summary[key] = sum(s[key] for s in summaries)
+        for key in ['q20', 'q30']:
+            summary['%s_rate' % key] = summary['%s_bases' % key] / summary['total_bases'] if summary['total_bases'] else 0
+        for key in ['read1_mean_length', 'read2_mean_length']:
+            if key in summary:
+                summary[key] = round(weighted([s[key] for s in summaries], [s['total_reads'] for s in summaries]))
+        summary['gc_content'] = weighted([s['gc_content'] for s in summaries], [s['total_bases'] for s in summaries])
+    if 'filtering_result' in merged:
+        merged['filtering_result'] = add_counts([s['filtering_result'] for s in stats])
+    if 'duplication' in merged:
+        merged['duplication']['rate'] = weighted([s['duplication']['rate'] for s in stats],
+                                                 [s['summary']['before_filtering']['total_reads'] for s in stats])
+    if 'insert_size' in merged:
+        histogram = [sum(counts) for counts in zip(*[s['insert_size']['histogram'] for s in stats])]
+        merged['insert_size'].update({'unknown': sum(s['insert_size']['unknown'] for s in stats),
+                                      'histogram': histogram,
+                                      'peak': histogram.index(max(histogram)) if len(histogram) > 0 else 0})
+    if 'adapter_cutting' in merged:
+        cutting = merged['adapter_cutting']
+        for key in ['adapter_trimmed_reads', 'adapter_trimmed_bases']:
+            cutting[key] = sum(s['adapter_cutting'].get(key, 0) for s in stats)
+        for key in ['read1_adapter_counts', 'read2_adapter_counts']:
+            if key in cutting:
+                cutting[key] = add_counts([s['adapter_cutting'].get(key, {}) for s in stats])
+    for key in ['read1_before_filtering', 'read2_before_filtering', 'read1_after_filtering', 'read2_after_filtering']:
+        if key in merged:
+            merged[key] = merge_reads([s[key] for s in stats])
+    return merged
+
+
+def concatenate(files, outfile):
+    """Write files one after another to outfile (gzip files stay valid as multiple gzip members)."""
+    with open(outfile, 'wb') as o:
+        for f in files:
+            with open(f, 'rb') as i:
+                shutil.copyfileobj(i, o)
+
+
+def main(r1, r2, r1out, r2out, jsonfile, htmlfile, logfile, options):
+    tmpdir = tempfile.mkdtemp(prefix='trim_', dir=os.environ.get('SLURM_TMPDIR', None))
+    needed = TMP_RATIO * (op.getsize(r1) + op.getsize(r2))
+    free = shutil.disk_usage(tmpdir).free
+    if free < needed:
+        print('WARNING: splitting %s and %s may need ~%.1fG in %s, but only %.1fG is free'
+              % (r1, r2, needed / 1024**3, op.dirname(tmpdir), free / 1024**3))
+    try:
+        # split R1 and R2 at the same time
+        procs = [split_fastq(r, op.join(tmpdir, '%s_' % read), CHUNK_READS) for r, read in [(r1, 'R1'), (r2, 'R2')]]
+        if any(proc.wait() != 0 for proc in procs):
+            print('FAIL: could not split %s and %s' % (r1, r2))
+            exit(1)
+        chunks = get_chunks(tmpdir)
+        print('trimming %s chunks of %s reads, %s at a time' % (len(chunks), CHUNK_READS, PROCS))
+
+        with ThreadPoolExecutor(max_workers=PROCS) as pool:
+            outfiles = list(pool.map(lambda chunk: trim_chunk(*chunk, options), chunks))
+
+        # gather outfiles in chunk order
+        r1outs, r2outs, jsons, htmls, logs = zip(*outfiles)
+        concatenate(r1outs, r1out)
+        concatenate(r2outs, r2out)
+        concatenate(logs, logfile)
+        shutil.copy(htmls[0], htmlfile)
+        stats = merge_stats([json.load(open(f)) for f in jsons])
+        command = stats['command']
+        for chunkfile, f in [(chunks[0][0], r1), (chunks[0][1], r2), (r1outs[0], r1out), (r2outs[0], r2out),
+                             (jsons[0], jsonfile), (htmls[0], htmlfile)]:
+            command = command.replace(chunkfile, f)
+        stats['command'] = command + ' (in %s chunks with parallel_trim.py)' % len(chunks)
+        with open(jsonfile, 'w') as o:
+            json.dump(stats, o, indent=4)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    print('trimmed %s and %s' % (r1, r2))
+
+
+if __name__ == '__main__':
+    # args
+    thisfile, r1, r2, r1out, r2out, jsonfile, htmlfile, logfile, options = sys.argv
+    main(r1, r2, r1out, r2out, jsonfile, htmlfile, logfile, options)
@@ -0,0 +1,211 @@
+"""Size the --mem and --time of each job from its input size and the usage of previous jobs.
+
+### purpose
+# each stage asks for a fixed --mem and --time (eg 55000M and 23:59:00 for bwa), so jobs of small
+#    samples waste their allocation (and wait longer to backfill) while large samples time out
+# if the pipeline was started with `--adaptive_resources`, get_resources() instead sizes each job:
+#    - the size of a job is the number of reads its samples kept after trimming (from the fastp
+#      .json files) or, before the samples are trimmed, the bytes of their fastq.gz files
+#    - the size of each job is saved in parentdir/resource_sizes, and the memory and time used
+#      by finished jobs are read from sacct (saved in parentdir/resource_usage.pkl, and reused
+#      for USAGE_MAXAGE seconds)
+#    - once MIN_HISTORY jobs of a stage have completed, time is scaled linearly from the slowest
+#      rate (minutes per read or byte) of previous jobs, and memory from the largest MaxRSS
+#      (scaled up only for jobs larger than any seen before), each with some headroom
+#    - memory is never more than the stage's usual request (java -Xmx and node sizes are set for
+#      it), time can be up to MAX_TIME so that large samples no longer time out
+# otherwise the usual --mem and --time of each stage are used
+###
+
+### usage
+# from resources import get_resources
+# mem, walltime = get_resources(parentdir, 'bwa', f'{pool}-{samp}-bwa', [samp], '55000M', '23:59:00')
+###
+
+### assumes
+# job names are unique within parentdir (eg pool-samp-stage)
+###
+"""
+
+import os, json, math, time, subprocess
+from os import path as op
+from functools import lru_cache
+from coadaptree import makedir, pkldump, pklload, get_start_opt
+from executor import get_executor, get_mem
+
+USAGE_MAXAGE = 900  # seconds before saved sacct usage is queried again
+HISTORY_DAYS = 60  # how far back to look for finished jobs
+MIN_HISTORY = 3  # completed jobs of a stage needed before its requests are changed
+TIME_HEADROOM = 1.5
+MEM_HEADROOM = 1.25
+MIN_TIME = 60  # minutes
+MAX_TIME = 7 * 24 * 60  # minutes
+MIN_MEM = 1000  # MB
+
+
+def get_minutes(walltime):
+    """Convert a slurm time (eg 23:59:00, 7-00:00:00, 05:30) to minutes."""
+    days, hms = walltime.split('-') if '-' in walltime else (0, walltime)
+    hms = [int(x) for x in hms.split(':')]
+    hours, minutes, seconds = [0] * (3 - len(hms)) + hms
+    return int(days) * 24 * 60 + hours * 60 + minutes + seconds / 60
+
+
+def format_minutes(minutes):
+    """Convert minutes to a slurm time (D-HH:MM:SS)."""
+    minutes = math.ceil(minutes)
+    return '%s-%02d:%02d:00' % (minutes // (24 * 60), minutes % (24 * 60) // 60, minutes % 60)
+
+
+def get_reads(pooldir, samp):
+    """Count the reads samp kept after trimming, None if any of its fastp .json files are missing."""
+    r1r2outs = op.join(pooldir, 'samp2_r1r2out.pkl')
+    if not op.exists(r1r2outs):
+        return None
+    reads = 0
+    for r1out, r2out in pklload(r1r2outs).get(samp, []):
+        jsonfile = r1out.replace("R1", "").replace(".fastq.gz", "_R1_R2") + '.json'
+        if not op.exists(jsonfile):
+            return None
+        with open(jsonfile, 'r') as o:
+            reads += json.load(o)['summary']['after_filtering']['total_reads']
+    return reads if reads > 0 else None
+
+
+@lru_cache(maxsize=None)
+def get_size(parentdir, samps):
+    """Get the size of a job that uses the reads of samps (a tuple, so sizes can be reused in a process).
+
+    Returns:
+    size - dict with key 'bytes' = total size of the samps' fastq.gz files,
+           key 'reads' = total reads after trimming (None if not all samps have been trimmed)
+    """
+    f2samp = pklload(op.join(parentdir, 'f2samp.pkl'))
+    samp2pool = pklload(op.join(parentdir, 'samp2pool.pkl'))
+    size = {'bytes': sum(op.getsize(f) for f, samp in f2samp.items() if samp in samps and op.exists(f)),
+            'reads': 0}
+    for samp in samps:
+        reads = get_reads(op.join(parentdir, samp2pool[samp]), samp)
+        if reads is None:
+            size['reads'] = None
+            break
+        size['reads'] += reads
+    return size
+
+
+def save_size(parentdir, jobname, stage, size):
+    """Save the size of jobname so its usage can be compared to other jobs once it finishes."""
+    sizedir = makedir(op.join(parentdir, 'resource_sizes'))
+    pkldump(dict(size, stage=stage), op.join(sizedir, '%s.pkl' % jobname))
+
+
+def parse_sacct(lines):
+    """Get the memory and time used by each completed job from sacct output.
+
+    A job's MaxRSS is the largest of its job steps (eg .batch).
+
+    Returns:
+    usage - dict with key = job name, val = (MB, minutes) - the last job with that name
+    """
+    jobs = {}  # key = jobid, val = [name, state, minutes, MB]
+    for line in lines:
+        splits = line.strip().split('|')
+        if len(splits) != 5:
+            continue
+        jobid, name, state, elapsed, maxrss = splits
+        pid = jobid.split('.')[0]
+        if pid not in jobs:
+            jobs[pid] = [None, None, 0, 0]
+        if '.' not in jobid:
+            jobs[pid][:3] = [name, state.split()[0], get_minutes(elapsed)]
+        if maxrss != '':
+            jobs[pid][3] = max(jobs[pid][3], get_mem(maxrss))
+    usage = {}
+    for pid in sorted(jobs, key=lambda pid: int(pid) if pid.isdigit() else 0):
+        name, state, minutes, mem = jobs[pid]
+        if state == 'COMPLETED' and mem > 0:
+            usage[name] = (mem, minutes)
+    return usage
+
+
+def get_usage(parentdir):
+    """Get the memory and time used by completed jobs, saved for USAGE_MAXAGE seconds."""
+    pkl = op.join(parentdir, 'resource_usage.pkl')
+    if op.exists(pkl) and time.time() - op.getmtime(pkl) < USAGE_MAXAGE:
+        return pklload(pkl)
+    starttime = time.strftime('%Y-%m-%d', time.localtime(time.time() - HISTORY_DAYS * 24 * 60 * 60))
+    try:
+        usage = parse_sacct(get_executor().sacct(starttime))
+    except (subprocess.CalledProcessError, TypeError) as e:
+        print('could not get usage of previous jobs from sacct: %s' % e)
+        return {}
+    # write then rename so stage scripts running at the same time never read a partial file
+    tmp = '%s.%s.tmp' % (pkl, os.getpid())
+    pkldump(usage, tmp)
+    os.replace(tmp, pkl)
+    return usage
+
+
+@lru_cache(maxsize=None)
+def get_history(parentdir, stage):
+    """Get the size and usage of completed jobs of stage (once per process, eg for many bedfiles).
+
+    Returns:
+    history - list of (size, MB, minutes), where size is a dict from get_size()
+    """
+    sizedir = op.join(parentdir, 'resource_sizes')
+    if not op.exists(sizedir):
+        return []
+    usage = get_usage(parentdir)
+    history = []
+    for f in os.listdir(sizedir):
+        jobname = f.replace('.pkl', '')
+        if f.endswith('.pkl') and jobname in usage:
+            size = pklload(op.join(sizedir, f))
+            if size['stage'] == stage:
+                history.append((size, *usage[jobname]))
+    return history
+
+
+def predict(history, size, mem, walltime):
+    """Size a job from the usage of previous jobs of its stage.
+
+    Positional arguments:
+    history - list of (size, MB, minutes) of completed jobs (see get_history())
+    size - dict from get_size() for the job
+    mem - the stage's usual --mem, the most memory that will be requested
+    walltime - the stage's usual --time, used if there is not enough history
+
+    Returns:
+    mem, walltime - slurm --mem and --time for the job
+    """
+    # compare reads if they are known for this job and all previous jobs, otherwise bytes
+    key = 'reads' if size['reads'] is not None and all(s['reads'] for s, m, t in history) else 'bytes'
+    history = [(s[key], m, t) for s, m, t in history if s[key]]
+    if len(history) < MIN_HISTORY or not size[key]:
+        return mem, walltime
+    rate = max(minutes / s for s, m, minutes in history)
+    minutes = min(MAX_TIME, max(MIN_TIME, TIME_HEADROOM * rate * size[key]))
+    peak = max(m for s, m, minutes in history) * max(1, size[key] / max(s for s, m, t in history))
+    mb = min(get_mem(mem), max(MIN_MEM, math.ceil(MEM_HEADROOM * peak)))
+    return '%sM' % mb, format_minutes(minutes)
+
+
+def get_resources(parentdir, stage, jobname, samps, mem, walltime):
+    """Get the --mem and --time for jobname.
+
+    If the pipeline was not started with --adaptive_resources, mem and walltime are returned.
+
+    Positional arguments:
+    parentdir - directory with datatable.txt and pipeline .pkl files
+    stage - name used to compare the job to others (eg 'bwa', 'realign-scatter', 'varscan')
+    jobname - the --job-name of the job
+    samps - list of samples whose reads the job uses
+    mem - the stage's usual --mem (eg '55000M')
+    walltime - the stage's usual --time (eg '23:59:00')
+    """
+    if get_start_opt(parentdir, 'adaptive_resources', False) is False:
+        return mem, walltime
+    size = get_size(parentdir, tuple(samps))
+    save_size(parentdir, jobname, stage, size)
+    return predict(get_history(parentdir, stage), size, mem, walltime)
@@ -14,11 +14,14 @@ If multiple samps per pool_name:
 """
 
 
-import sys, os, time, random, subprocess, shutil
+import sys, os, time, random
+import create_bedfiles
 from os import path as op
 from datetime import datetime as dt
-from coadaptree import makedir, fs, pklload, get_email_info
+from coadaptree import makedir, fs, pklload, get_email_info, get_start_opt
 from balance_queue import getsq
+from executor import get_executor
+from resources import get_resources
 
 
 def gettimestamp(f):
@@ -56,9 +59,12 @@ def getfiles(samps, shdir, grep):
 
     Returns:
     files - dictionary where key = sh file, val = most recent outfile
+
+    Scatter jobs of --scatter_realign (*-scatter_NNNN.sh) are not counted, only the job of each
+    sample that gathers their output.
     """
-    found = [sh for sh in fs(shdir) if sh.endswith(".sh") and grep in sh]
-    outs = [out for out in fs(shdir) if out.endswith('.out') and grep in out]
+    found = [sh for sh in fs(shdir) if sh.endswith(".sh") and grep in sh and '-scatter_' not in sh]
+    outs = [out for out in fs(shdir) if out.endswith('.out') and grep in out and '-scatter_' not in out]
     if len(found) != len(samps):
         print('not all shfiles have been created, exiting %s' % sys.argv[0])
         exit()
@@ -82,7 +88,7 @@ def check_seff(outs):
             seff, seffcount = '', 0
             while isinstance(seff, list) is False:
                 # sometimes slurm sucks
-                seff = subprocess.check_output([shutil.which('seff'), pid]).decode('utf-8').split('\n')
+                seff = get_executor().seff(pid)
                 if seffcount == 10:
                     print('slurm is screwing something up with seff, exiting %s' % sys.argv[0])
                     exit()
@@ -202,7 +208,9 @@ def get_varscan_cmd(bamfiles, bedfile, bednum, vcf, ref, pooldir, program):
     ploidy = pklload(op.join(parentdir, 'ploidy.pkl'))[pool]
     # if single-sample then set minfreq to 0, else use min possible allele freq
     minfreq = 1/sum(ploidy.values()) if len(ploidy.keys()) > 1 else 0
-    cmd = f'''samtools mpileup -B -f {ref} {smallbams} | java -Xmx15g -jar \
+    # depth- and length-balanced bedfiles can split contigs, only call positions within the bedfile intervals
+    regions = f'-l {bedfile} ' if get_start_opt(parentdir, 'bedfile_mode', 'length') in ['depth', 'balanced'] else ''
+    cmd = f'''samtools mpileup -B {regions}-f {ref} {smallbams} | java -Xmx15g -jar \
 $VARSCAN_DIR/VarScan.v2.4.3.jar mpileup2cns --min-coverage 8 --p-value 0.05 \
 --min-var-freq {minfreq} --strand-filter 1 --min-freq-for-hom 0.80 \
 --min-avg-qual 20 --output-vcf 1 > {vcf}
@@ -227,11 +235,14 @@ def make_sh(bamfiles, bedfile, shdir, pool, pooldir, program, parentdir):
 
     tablefile = finalvcf.replace(".vcf", "_table.txt")
     bash_variables = op.join(parentdir, 'bash_variables')
+    samps = pklload(op.join(parentdir, 'poolsamps.pkl'))[pool]
+    mem, walltime = get_resources(parentdir, program, f'{pool}-{program}_bedfile_{num}', samps,
+                                  '2000M', '7-00:00:00')
     text = f'''#!/bin/bash
 #SBATCH --ntasks=1
 #SBATCH --job-name={pool}-{program}_bedfile_{num}
-#SBATCH --time='7-00:00:00'
-#SBATCH --mem=2000M
+#SBATCH --time='{walltime}'
+#SBATCH --mem={mem}
 #SBATCH --output={pool}-{program}_bedfile_{num}_%j.out
 
 # run VarScan (v.2.4.2)
@@ -261,17 +272,15 @@ python $HOME/pipeline/balance_queue.py {program} {parentdir}
 
 def sbatch(file):
     """Sbatch file."""
-    os.chdir(op.dirname(file))
-    pid = subprocess.check_output([shutil.which('sbatch'), file]).decode('utf-8').replace("\n", "").split()[-1]
+    pid = get_executor().submit(file)
     print("sbatched %s" % file)
     time.sleep(10)
     return pid
 
 
 def get_bedfiles(parentdir, pool):
-    """Get a list of paths to all of the bed files for ref.fa."""
-    ref = pklload(op.join(parentdir, 'poolref.pkl'))[pool]
-    beddir = op.join(op.dirname(ref), 'bedfiles_%s' % op.basename(ref).split(".fa")[0])
+    """Get a list of paths to all of the bed files for ref.fa (or for pool if balanced by depth)."""
+    beddir = create_bedfiles.get_beddir(parentdir, pool)
     return [f for f in fs(beddir) if f.endswith('.bed')]
 
 
@@ -296,10 +305,13 @@ def create_combine(pids, parentdir, pool, program, shdir):
     email_text = get_email_info(parentdir, 'final')
     dependencies = '#SBATCH --dependency=afterok:' + ','.join(pids)
     bash_variables = op.join(parentdir, 'bash_variables')
+    samps = pklload(op.join(parentdir, 'poolsamps.pkl'))[pool]
+    mem, walltime = get_resources(parentdir, f'combine-{program}', f'{pool}-combine-{program}', samps,
+                                  '20000M', '12:00:00')
     text = f'''#!/bin/bash
 #SBATCH --job-name={pool}-combine-{program}
-#SBATCH --time=12:00:00
-#SBATCH --mem=20000M
+#SBATCH --time={walltime}
+#SBATCH --mem={mem}
 #SBATCH --cpus-per-task=1
 #SBATCH --output={pool}-combine-{program}_%j.out
 {dependencies}
@@ -327,6 +339,10 @@ def main(parentdir, pool):
     # create reservation so other files don't try and write files.sh, exit() if needed
     shdir = create_reservation(op.join(parentdir, pool))
 
+    # now that realignment is finished, balance bedfiles by read depth if requested
+    if get_start_opt(parentdir, 'bedfile_mode', 'length') == 'depth':
+        create_bedfiles.make_depth_bedfiles(parentdir, pool, bamfiles.values())
+
     # create .sh files
     for program in ['varscan']:
         print('starting %s commands' % program)
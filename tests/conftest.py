@@ -0,0 +1,5 @@
+import sys
+from os import path as op
+
+# pipeline scripts are run from $HOME/pipeline, not installed
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
@@ -0,0 +1,49 @@
+"""Tests of balance_queue.py."""
+
+import balance_queue
+from executor import SQUEUE_FIELDS
+
+
+def make_job(jobid, account, name='pool-samp-bwa'):
+    values = dict((field, '') for field, code in SQUEUE_FIELDS)
+    values.update({'jobid': jobid, 'account': account, 'name': name, 'state': 'PD', 'reason': 'Priority'})
+    return balance_queue.SqJob(**values)
+
+
+def test_getaccounts_skips_unknown_accounts():
+    sq = [make_job('1', 'def-a_cpu'), make_job('2', 'def-gone_cpu'), make_job('3', 'def-a_cpu')]
+
+    accounts = balance_queue.getaccounts(sq, 'bwa', ['def-a', 'def-b'])
+
+    assert sorted(accounts) == ['def-a']
+    assert sorted(accounts['def-a']) == ['1', '3']
+
+
+class FailingExecutor:
+    def squeue(self, states, delimited=False):
+        raise RuntimeError('squeue timed out')
+
+
+def test_daemon_logs_errors_and_keeps_running(tmp_path, monkeypatch):
+    monkeypatch.setattr(balance_queue, 'DAEMON_LOCK', str(tmp_path / 'lock'))
+    monkeypatch.setattr(balance_queue, 'DAEMON_LOG', str(tmp_path / 'log'))
+    monkeypatch.setattr(balance_queue, 'get_avail_accounts', lambda parentdir: ['def-a', 'def-b'])
+    monkeypatch.setattr(balance_queue, 'get_balance_mode', lambda parentdir: 'even')
+    monkeypatch.setattr(balance_queue, 'get_executor', FailingExecutor)
+    rounds = []
+
+    def sleep(interval):
+        rounds.append(interval)
+        if len(rounds) == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(balance_queue.time, 'sleep', sleep)
+    try:
+        balance_queue.daemon(interval=1)
+    except KeyboardInterrupt:
+        pass
+
+    log = (tmp_path / 'log').read_text()
+    assert len(rounds) == 3
+    assert log.count('RuntimeError: squeue timed out') == 3
+    assert not (tmp_path / 'lock').exists()
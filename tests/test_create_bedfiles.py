@@ -0,0 +1,69 @@
+"""Tests of the shared bedfile cache in create_bedfiles.py."""
+
+import os, time, shutil
+from os import path as op
+import create_bedfiles
+from coadaptree import makedir
+
+
+def make_cache(tmp_path, names):
+    """Make a reference and empty cache entries bedfiles_ref/ref_<name> for each of names."""
+    ref = tmp_path / 'ref.fa'
+    ref.write_text('>c0\nACGT\n')
+    return str(ref), [makedir(str(tmp_path / 'bedfiles_ref' / ('ref_%s' % name))) for name in names]
+
+
+def make_old(beddir, days=create_bedfiles.CACHE_DAYS + 1):
+    """Set the mtime of beddir and its pins to days ago."""
+    then = time.time() - days * 86400
+    pindir = op.join(beddir, 'pins')
+    for f in os.listdir(pindir) if op.isdir(pindir) else []:
+        os.utime(op.join(pindir, f), (then, then))
+    os.utime(beddir, (then, then))
+
+
+def test_prune_keeps_entries_still_pinned_by_other_runs(tmp_path):
+    ref, (keep, a, b) = make_cache(tmp_path, ['keep', 'a', 'b'])
+    run1, run2 = [makedir(str(tmp_path / run)) for run in ['run1', 'run2']]
+    create_bedfiles.pin_beddir(run1, ref, a)
+    create_bedfiles.pin_beddir(run2, ref, b)
+    create_bedfiles.pin_beddir(run2, ref, keep)  # run2 has moved on from b
+    for beddir in [a, b]:
+        make_old(beddir)
+
+    create_bedfiles.prune_cache(ref, keep)
+
+    assert op.exists(a)  # run1 has not used a for CACHE_DAYS, but still pins it
+    assert not op.exists(b)
+    assert op.exists(keep)
+
+
+def test_prune_keeps_entries_used_recently(tmp_path):
+    ref, (keep, a) = make_cache(tmp_path, ['keep', 'a'])
+    run = makedir(str(tmp_path / 'run'))
+    create_bedfiles.pin_beddir(run, ref, a)
+    shutil.rmtree(run)  # the run was removed, but used a recently
+
+    create_bedfiles.prune_cache(ref, keep)
+    assert op.exists(a)
+
+    make_old(a)
+    create_bedfiles.prune_cache(ref, keep)
+    assert not op.exists(a)
+
+
+def test_prune_removes_old_tmp_and_unpinned_entries(tmp_path):
+    ref, (keep, old, new, oldtmp, newtmp) = make_cache(tmp_path, ['keep', 'old', 'new', 'old.1.tmp', 'new.2.tmp'])
+    make_old(old)
+    make_old(oldtmp, days=2)
+
+    create_bedfiles.prune_cache(ref, keep)
+
+    assert [op.exists(d) for d in [keep, old, new, oldtmp, newtmp]] == [True, False, True, False, True]
+
+
+def test_touch_pin_does_not_raise_on_unwritable_entry(tmp_path):
+    ref, (beddir,) = make_cache(tmp_path, ['a'])
+    open(op.join(beddir, 'pins'), 'w').close()  # pins can't be made (as for entries of another user)
+
+    assert create_bedfiles.touch_pin(str(tmp_path), beddir) is False
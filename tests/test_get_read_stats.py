@@ -0,0 +1,51 @@
+"""Tests of counting bamfile reads in 98_get_read_stats.py."""
+
+import os, struct
+from os import path as op
+
+
+def load_read_stats():
+    """Get the functions of 98_get_read_stats.py (the rest of the file makes the report)."""
+    f = op.join(op.dirname(op.dirname(op.abspath(__file__))), '98_get_read_stats.py')
+    with open(f, 'r') as o:
+        source = o.read().split('\n# args\n')[0]
+    ns = {'__name__': 'get_read_stats'}
+    exec(compile(source, f, 'exec'), ns)
+    return ns
+
+
+def make_truncated_bai(tmp_path):
+    """Make a bamfile with a .bai that is newer than it, but ends part way through the first contig."""
+    bamfile = str(tmp_path / 'samp_sorted.bam')
+    with open(bamfile, 'wb') as o:
+        o.write(b'not read')
+    with open(bamfile + '.bai', 'wb') as o:
+        o.write(b'BAI\x01' + struct.pack('<i', 2) + b'\x01')
+    os.utime(bamfile, (0, 0))
+    return bamfile
+
+
+def fake_samtools(tmp_path, monkeypatch, script):
+    """Put a samtools that runs script first on $PATH."""
+    bindir = tmp_path / 'bin'
+    bindir.mkdir()
+    samtools = bindir / 'samtools'
+    samtools.write_text('#!/bin/sh\n%s\n' % script)
+    samtools.chmod(0o755)
+    monkeypatch.setenv('PATH', '%s:%s' % (bindir, os.environ['PATH']))
+
+
+def test_count_reads_truncated_index_falls_back_to_samtools(tmp_path, monkeypatch):
+    count_reads = load_read_stats()['count_reads']
+    bamfile = make_truncated_bai(tmp_path)
+    fake_samtools(tmp_path, monkeypatch, 'echo 42')
+
+    assert count_reads(bamfile) == (42, 'samtools')
+
+
+def test_count_reads_unreadable_bamfile_is_failed(tmp_path, monkeypatch):
+    count_reads = load_read_stats()['count_reads']
+    bamfile = make_truncated_bai(tmp_path)
+    fake_samtools(tmp_path, monkeypatch, 'echo "[E::hts_open_format] truncated file" >&2; exit 1')
+
+    assert count_reads(bamfile) == (None, 'failed')
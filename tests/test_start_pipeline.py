@@ -0,0 +1,35 @@
+"""Tests of reading RGIDs from R1 files in 00_start-pipeline.py."""
+
+import gzip
+import pytest
+from os import path as op
+
+
+def load_start_pipeline():
+    """Get the functions of 00_start-pipeline.py (without running it)."""
+    f = op.join(op.dirname(op.dirname(op.abspath(__file__))), '00_start-pipeline.py')
+    with open(f, 'r') as o:
+        source = o.read().split("\nif __name__ == '__main__':")[0]
+    ns = {'__name__': 'start_pipeline'}
+    exec(compile(source, f, 'exec'), ns)
+    return ns
+
+
+def test_get_rgids(tmp_path):
+    get_rgids = load_start_pipeline()['get_rgids']
+    r1 = str(tmp_path / 'samp_R1.fastq.gz')
+    with gzip.open(r1, 'wt') as o:
+        o.write('@A00123:8:H5KJ2DSXX:1:1101:1000:1000 1:N:0:ACGT\nACGT\n+\nIIII\n')
+
+    assert get_rgids([r1, str(tmp_path / 'missing_R1.fastq.gz')]) == {r1: '@A00123_8_H5KJ2DSXX_1'}
+
+
+def test_get_rgids_exits_on_corrupt_file(tmp_path, capsys):
+    get_rgids = load_start_pipeline()['get_rgids']
+    r1 = str(tmp_path / 'samp_R1.fastq.gz')
+    with open(r1, 'w') as o:
+        o.write('@not gzipped\n')
+
+    with pytest.raises(SystemExit):
+        get_rgids([r1])
+    assert 'FAIL: %s' % r1 in capsys.readouterr().out